@@ -0,0 +1,58 @@
+import time
+
+import click
+import numpy as np
+
+from knn import utils, wire
+
+
+def time_per_result(f, n_results, num_trials):
+    start_time = time.perf_counter()
+    for _ in range(num_trials):
+        f()
+    return (time.perf_counter() - start_time) / num_trials / n_results
+
+
+@click.command()
+@click.option("-d", "--dim", default=1024)
+@click.option("-c", "--chunk_size", default=3)
+@click.option("-n", "--num_trials", default=10000)
+@click.option("-t", "--target", default=5.0)
+def main(dim, chunk_size, num_trials, target):
+    arrays = [np.random.randn(dim).astype(np.float32) for _ in range(chunk_size)]
+    encoded = [utils.numpy_to_base64(a) for a in arrays]
+    frame = wire.dumps(arrays)
+    decoder = utils.NumpyDecoder()
+
+    results = {
+        "base64_to_numpy": lambda: [utils.base64_to_numpy(e) for e in encoded],
+        "NumpyDecoder.decode": lambda: [decoder.decode(e) for e in encoded],
+        "NumpyDecoder.decode_many": lambda: decoder.decode_many(encoded),
+        "wire.loads (binary frames)": lambda: wire.loads(frame),
+    }
+
+    baseline = None
+    speedups = {}
+    for name, f in results.items():
+        assert all(np.array_equal(a, b) for a, b in zip(f(), arrays))
+        t = time_per_result(f, chunk_size, num_trials)
+        baseline = baseline or t
+        speedups[name] = baseline / t
+        print(f"{name}: {t * 1e6:.2f} us per result ({speedups[name]:.1f}x)")
+
+    # Binary frames are the default wire format; base64 (JSON) results are only
+    # decoded for mappers or jobs that don't use them. Decoding base64 itself
+    # takes most of the time on that path, which caps the speedup there.
+    json_speedup = max(
+        speedups["NumpyDecoder.decode"], speedups["NumpyDecoder.decode_many"]
+    )
+    for path, speedup in (
+        ("binary frames (default)", speedups["wire.loads (binary frames)"]),
+        ("JSON", json_speedup),
+    ):
+        status = "meets" if speedup >= target else f"{target - speedup:.1f}x short of"
+        print(f"{path} path: {speedup:.1f}x, {status} the {target:.1f}x target")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import time
+
+import click
+import numpy as np
+
+from knn.index import IVFIndex
+from knn.reducers import TopKReducer
+
+
+def make_dataset(n, dim, n_clusters, noise, rng):
+    # Clustered, L2-normalized vectors, roughly like patch embeddings
+    centers = rng.randn(n_clusters, dim)
+    vectors = centers[rng.randint(n_clusters, size=n)] + noise * rng.randn(n, dim)
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def exhaustive_scan(vectors, query, k, chunk_size):
+    # What a query costs the coordinator today: every result streams through a
+    # TopKReducer, one chunk at a time (not counting the mappers' own work)
+    reducer = TopKReducer(k)
+    for start in range(0, len(vectors), chunk_size):
+        scores = vectors[start : start + chunk_size] @ query
+        inputs = list(range(start, start + len(scores)))
+        reducer.handle_results(inputs, [float(s) for s in scores])
+    return [r.input for r in reducer.result]
+
+
+@click.command()
+@click.option("-n", "--n_vectors", default=100000)
+@click.option("-d", "--dim", default=1024)
+@click.option("-c", "--n_clusters", default=1000)
+@click.option("-l", "--n_lists", default=1024)
+@click.option("-k", "--k", default=50)
+@click.option("-q", "--n_queries", default=20)
+@click.option("--chunk_size", default=3)
+@click.option("--noise", default=0.5)
+def main(n_vectors, dim, n_clusters, n_lists, k, n_queries, chunk_size, noise):
+    rng = np.random.RandomState(0)
+    vectors = make_dataset(n_vectors, dim, n_clusters, noise, rng)
+    queries = vectors[rng.choice(n_vectors, n_queries, replace=False)]
+    queries = queries + 0.1 * rng.randn(*queries.shape).astype(np.float32)
+
+    start_time = time.perf_counter()
+    ground_truth = [exhaustive_scan(vectors, q, k, chunk_size) for q in queries]
+    scan_time = (time.perf_counter() - start_time) / n_queries
+    print(f"TopKReducer scan: recall@{k} 1.000, {scan_time * 1e3:.2f} ms per query")
+
+    start_time = time.perf_counter()
+    index = IVFIndex(dim, n_lists)
+    for start in range(0, n_vectors, 10000):  # incremental insertion
+        index.add(vectors[start : start + 10000], range(start, start + 10000))
+    print(f"IVFIndex build: {time.perf_counter() - start_time:.1f} s")
+
+    for n_probe in (1, 4, 16, 64, 256):
+        start_time = time.perf_counter()
+        results = [index.search(q, k, n_probe)[0] for q in queries]
+        search_time = (time.perf_counter() - start_time) / n_queries
+
+        recall = np.mean(
+            [
+                len(set(truth) & {i for _, i in result}) / k
+                for truth, result in zip(ground_truth, results)
+            ]
+        )
+        print(
+            f"IVFIndex n_probe={n_probe}: recall@{k} {recall:.3f}, "
+            f"{search_time * 1e3:.2f} ms per query ({scan_time / search_time:.0f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
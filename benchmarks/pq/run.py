@@ -0,0 +1,96 @@
+import time
+
+import click
+import numpy as np
+
+from knn.index import OptimizedProductQuantizer, PQIndex, ProductQuantizer
+
+
+def make_dataset(n, dim, n_clusters, noise, rng):
+    # Clustered, L2-normalized vectors, roughly like patch embeddings: most of the
+    # variance is in a few directions, mixed across all dimensions by a random
+    # rotation (which is what OPQ learns to undo)
+    centers = rng.randn(n_clusters, dim)
+    vectors = centers[rng.randint(n_clusters, size=n)] + noise * rng.randn(n, dim)
+    vectors *= 1 / np.sqrt(1 + np.arange(dim))
+    rotation, _ = np.linalg.qr(rng.randn(dim, dim))
+    vectors = vectors @ rotation
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def top_k(scores, k):
+    return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+
+@click.command()
+@click.option("-n", "--n_vectors", default=50000)
+@click.option("-d", "--dim", default=256)
+@click.option("-c", "--n_clusters", default=500)
+@click.option("-m", "--n_subvectors", multiple=True, default=[8, 16, 32])
+@click.option("-k", "--k", default=10)
+@click.option("-r", "--n_candidates", default=100)
+@click.option("-q", "--n_queries", default=50)
+@click.option("--train_size", default=10000)
+@click.option("--noise", default=0.5)
+@click.option("--opq/--no_opq", default=True)
+def main(
+    n_vectors,
+    dim,
+    n_clusters,
+    n_subvectors,
+    k,
+    n_candidates,
+    n_queries,
+    train_size,
+    noise,
+    opq,
+):
+    rng = np.random.RandomState(0)
+    vectors = make_dataset(n_vectors, dim, n_clusters, noise, rng)
+    queries = vectors[rng.choice(n_vectors, n_queries, replace=False)]
+    queries = queries + 0.1 * rng.randn(*queries.shape).astype(np.float32)
+
+    start_time = time.perf_counter()
+    ground_truth = [set(row) for row in top_k(queries @ vectors.T, k)]
+    exact_time = (time.perf_counter() - start_time) / n_queries
+    print(
+        f"float32: {vectors.nbytes // n_vectors} bytes per vector, "
+        f"{exact_time * 1e3:.2f} ms per query"
+    )
+
+    quantizer_types = [ProductQuantizer] + ([OptimizedProductQuantizer] if opq else [])
+    for quantizer_cls in quantizer_types:
+        for m in n_subvectors:
+            start_time = time.perf_counter()
+            index = PQIndex(quantizer_cls(dim, m), train_size=train_size)
+            for start in range(0, n_vectors, 10000):  # incremental insertion
+                index.add(vectors[start : start + 10000], range(start, start + 10000))
+            build_time = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            results = index.search(queries, n_candidates)
+            search_time = (time.perf_counter() - start_time) / n_queries
+
+            # Recall of the top k among the top k codes, and among n_candidates codes
+            # (i.e., if those are re-ranked with exact embeddings)
+            recalls = [
+                np.mean(
+                    [
+                        len(truth & {i for _, i in result[:r]}) / k
+                        for truth, result in zip(ground_truth, results)
+                    ]
+                )
+                for r in (k, n_candidates)
+            ]
+            print(
+                f"{quantizer_cls.__name__} M={m}: "
+                f"{index.nbytes // n_vectors} bytes per vector "
+                f"({vectors.nbytes / index.nbytes:.0f}x smaller), "
+                f"recall {k}@{k} {recalls[0]:.3f}, "
+                f"{k}@{n_candidates} {recalls[1]:.3f}, "
+                f"{search_time * 1e3:.2f} ms per query, build {build_time:.1f} s"
+            )
+
+
+if __name__ == "__main__":
+    main()
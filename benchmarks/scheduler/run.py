@@ -0,0 +1,73 @@
+import asyncio
+import itertools
+import random
+import time
+
+import click
+
+from knn import utils
+
+
+def polling_limited_as_completed(coros, limit):
+    # Previous busy-polling implementation, kept here as a baseline
+    futures = [asyncio.create_task(c) for c in itertools.islice(coros, 0, limit)]
+    pending = [len(futures)]
+
+    async def first_to_finish():
+        while True:
+            await asyncio.sleep(0)
+            for i, f in enumerate(futures):
+                if f is not None and f.done():
+                    try:
+                        newf = next(coros)
+                        futures[i] = asyncio.create_task(newf)
+                    except StopIteration:
+                        futures[i] = None
+                        pending[0] -= 1
+                    return f.result()
+
+    while pending[0] > 0:
+        yield first_to_finish()
+
+
+async def stub_request(mean_latency):
+    # Stands in for a mapper round trip without touching the network
+    await asyncio.sleep(random.expovariate(1 / mean_latency))
+    return None
+
+
+async def run_polling(coros, limit):
+    for result in polling_limited_as_completed(coros, limit):
+        await result
+
+
+async def run_event_driven(coros, limit):
+    async for _ in utils.limited_as_completed(coros, limit):
+        pass
+
+
+SCHEDULERS = {"polling": run_polling, "event": run_event_driven}
+
+
+@click.command()
+@click.option("-s", "--scheduler", type=click.Choice(SCHEDULERS), default="event")
+@click.option("-w", "--workers", default=1000)
+@click.option("-n", "--num_chunks", default=100000)
+@click.option("-l", "--latency", default=0.05)  # seconds
+@utils.unasync
+async def main(scheduler, workers, num_chunks, latency):
+    coros = (stub_request(latency) for _ in range(num_chunks))
+
+    start_wall = time.time()
+    start_cpu = time.process_time()
+    await SCHEDULERS[scheduler](coros, workers)
+    cpu_time = time.process_time() - start_cpu
+    wall_time = time.time() - start_wall
+
+    print(f"Wall time: {wall_time:.2f} s")
+    print(f"Coordinator CPU time: {cpu_time:.2f} s")
+    print(f"CPU time per 100k chunks: {cpu_time * 100000 / num_chunks:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import json
+import time
+
+import click
+import numpy as np
+
+from knn import utils, wire
+
+
+def json_roundtrip(response):
+    encoded = json.dumps(wire.to_jsonable(response)).encode("utf-8")
+    decoded = json.loads(encoded)
+    return encoded, [utils.as_numpy(output) for output in decoded["outputs"]]
+
+
+def frame_roundtrip(response):
+    encoded = wire.dumps(response)
+    decoded = wire.loads(encoded)
+    return encoded, decoded["outputs"]
+
+
+FORMATS = {"json": json_roundtrip, "frame": frame_roundtrip}
+
+
+@click.command()
+@click.option("-d", "--dim", default=1024)
+@click.option("-c", "--chunk_size", default=3)
+@click.option("-n", "--num_trials", default=10000)
+def main(dim, chunk_size, num_trials):
+    # Shaped like an ImageEmbeddingMapper response
+    response = {
+        "worker_id": "00000000-0000-0000-0000-000000000000",
+        "profiling": {"billed_time": 0.1, "request_time": 0.1, "compute_time": 0.1},
+        "outputs": [np.random.randn(dim).astype(np.float32) for _ in range(chunk_size)],
+    }
+
+    for name, roundtrip in FORMATS.items():
+        encoded, outputs = roundtrip(response)
+        assert all(np.array_equal(a, b) for a, b in zip(outputs, response["outputs"]))
+
+        start_time = time.perf_counter()
+        for _ in range(num_trials):
+            roundtrip(response)
+        elapsed_time = time.perf_counter() - start_time
+
+        print(f"{name}:")
+        print(f"  Bytes per response: {len(encoded)}")
+        print(f"  Encode + decode time: {elapsed_time / num_trials * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,8 @@ import json
 
 from knn.jobs import MapReduceJob
 from knn.reducers import Reducer
-from knn.utils import FileListIterator, unasync
+from knn.datasets import open_dataset
+from knn.utils import unasync
 
 import config
 
@@ -42,7 +43,7 @@ async def main(mapper, workers, interval, output):
         n_retries=1,
     )
 
-    dataset = FileListIterator(config.IMAGE_LIST_PATH)
+    dataset = open_dataset(config.IMAGE_LIST_PATH)
     await query_job.start(dataset, dataset.close)
 
     results = []
@@ -0,0 +1,71 @@
+import click
+import itertools
+
+from knn.index import IVFIndex, OptimizedProductQuantizer, PQIndex
+from knn.jobs import MapReduceJob
+from knn.reducers import IndexReducer
+from knn.datasets import open_dataset
+from knn.utils import unasync
+
+import config
+
+
+def patch_grid(image_paths, grid_size):
+    # Every image, split into grid_size x grid_size patches (in relative coordinates)
+    step = 1 / grid_size
+    for image_path in image_paths:
+        for i, j in itertools.product(range(grid_size), repeat=2):
+            patch = [i * step, j * step, (i + 1) * step, (j + 1) * step]
+            yield {"image": image_path, "patch": patch}
+
+
+@click.command()
+@click.option("-m", "--mapper", default=config.TEMPLATE_ENDPOINT)
+@click.option("-w", "--workers", default=1000)
+@click.option("-g", "--grid-size", default=config.ANN_PATCH_GRID_SIZE)
+@click.option("-l", "--n-lists", default=1024)
+@click.option("-p", "--pq-subvectors", type=int, default=None)
+@click.option("-c", "--checkpoint", default=None)
+@click.option("--resume", is_flag=True)
+@click.argument("output")
+@unasync
+async def main(
+    mapper, workers, grid_size, n_lists, pq_subvectors, checkpoint, resume, output
+):
+    # Embed a grid of patches from every image with the image-embedding mapper and
+    # insert them into an IVF index, which the server then loads from
+    # ANN_INDEX_PATH to answer /search_index queries without a scan. With
+    # --pq-subvectors, store OPQ codes of that many bytes per patch instead. With
+    # --checkpoint, progress is saved as we go, and --resume picks up from there.
+    if pq_subvectors is not None:
+        quantizer = OptimizedProductQuantizer(config.EMBEDDING_DIM, pq_subvectors)
+        index = PQIndex(quantizer)
+    else:
+        index = IVFIndex(config.EMBEDDING_DIM, n_lists)
+    reducer = IndexReducer(index)
+    index_job = MapReduceJob(
+        mapper,
+        reducer,
+        {"input_bucket": config.IMAGE_BUCKET},
+        n_mappers=workers,
+        checkpoint_path=checkpoint,
+    )
+
+    dataset = open_dataset(config.IMAGE_LIST_PATH)
+    try:
+        inputs = patch_grid(dataset, grid_size)
+        if resume:
+            index = await index_job.resume(inputs)
+        else:
+            index = await index_job.run_until_complete(inputs)
+    finally:
+        dataset.close()
+
+    if not index.is_trained:  # < train_size vectors
+        index.train()
+    index.save(output)
+    print(f"Indexed {len(index)} patches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import click
+import json
+
+from knn.jobs import MapReduceJob
+from knn.reducers import EmbeddingWriterReducer
+from knn.datasets import open_dataset
+from knn.utils import unasync
+
+import config
+
+
+@click.command()
+@click.option("-m", "--mapper", default=config.INDEX_ENDPOINT)
+@click.option("-w", "--workers", default=1000)
+@click.option("-s", "--max-shard-bytes", default=2 ** 30)
+@click.argument("output_dir")
+@unasync
+async def main(mapper, workers, max_shard_bytes, output_dir):
+    # Precompute backbone feature maps for every image in the dataset, so queries
+    # can read them (see INDEX_PATH in config.py) instead of running the backbone.
+    # Upload output_dir to INDEX_BUCKET/INDEX_PATH, or mount it into the mappers.
+    reducer = EmbeddingWriterReducer(output_dir, max_shard_bytes=max_shard_bytes)
+    index_job = MapReduceJob(
+        mapper, reducer, {"input_bucket": config.IMAGE_BUCKET}, n_mappers=workers
+    )
+
+    dataset = open_dataset(config.IMAGE_LIST_PATH)
+    try:
+        await index_job.run_until_complete(dataset)
+    finally:
+        dataset.close()
+        reducer.close()
+
+    print(json.dumps(index_job.job_result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,25 @@ OUTPUT_BUCKET = IMAGE_BUCKET
 OUTPUT_PATH = "results/"
 N_DISTANCES_TO_AVERAGE = 50
 
+# Requests in flight to the mappers at once, shared (by weight) among all queries
+MAX_IN_FLIGHT = 1000
+
 N_RESULTS_TO_DISPLAY = 50
+RESULTS_PUSH_INTERVAL = 1.0  # seconds between /results_stream events
 
 QUERY_CLEANUP_TIME = 60 * 60  # seconds
+
+# Precomputed embedding index (see build_index.py); if INDEX_PATH is set, queries read
+# feature maps from INDEX_BUCKET/INDEX_PATH (or the local directory INDEX_PATH if
+# INDEX_BUCKET is None) instead of running the backbone
+INDEX_ENDPOINT = "https://mihir-spatial-embedding-master-g6rwrca4fq-uc.a.run.app"
+INDEX_BUCKET = IMAGE_BUCKET
+INDEX_PATH = None
+
+# Approximate nearest neighbor index over image patches (see build_ann_index.py),
+# queried by /search_index; ANN_N_PROBE trades recall for latency
+ANN_INDEX_PATH = None
+ANN_INDEX_COMPRESSED = False  # built with --pq-subvectors (a PQIndex)
+ANN_PATCH_GRID_SIZE = 3
+ANN_N_PROBE = 16
+EMBEDDING_DIM = 1024
@@ -1,16 +1,18 @@
 import asyncio
-import functools
+from functools import partial
+from json import dumps
 from operator import itemgetter
+import time
 
 from typing import Dict
 
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 from sanic import Sanic
-from sanic.response import json, html, text
+from sanic.response import json, html, stream, text
 
-from knn.jobs import MapReduceJob
+from knn.index import IVFIndex, PQIndex
+from knn.jobs import JobScheduler, MapReduceJob, SharedScanQuery, SharedScans
 from knn.reducers import TopKReducer, PoolingReducer
-from knn.utils import FileListIterator, numpy_to_base64
 
 import config
 
@@ -22,7 +24,26 @@ jinja = Environment(
     loader=FileSystemLoader("./templates"), autoescape=select_autoescape(["html"]),
 )
 
-current_queries = {}  # type: Dict[str, MapReduceJob]
+current_queries: Dict[str, SharedScanQuery] = {}
+scheduler = JobScheduler(config.MAX_IN_FLIGHT)  # shared by all concurrent queries
+
+
+def split_query_output(output, template_index):
+    # Output of the query mapper's multi-template mode -> the single-template format
+    return {
+        "score": output["scores"][template_index],
+        "score_map_path": output["score_map_paths"][template_index],
+        "score_map_pending": output["score_maps_pending"][template_index],
+    }
+
+
+# Concurrent queries share one scan over the image list (see SharedScanJob)
+shared_scans = SharedScans(
+    scheduler=scheduler, n_retries=1, split_func=split_query_output
+)
+
+ann_index_cls = PQIndex if config.ANN_INDEX_COMPRESSED else IVFIndex
+ann_index = ann_index_cls.load(config.ANN_INDEX_PATH) if config.ANN_INDEX_PATH else None
 
 
 @app.route("/")
@@ -39,6 +60,7 @@ async def homepage(request):
 @app.route("/start", methods=["POST"])
 async def start(request):
     n_mappers = request.json["n_concurrent_workers"]
+    weight = float(request.json.get("weight", 1.0))  # share of MAX_IN_FLIGHT
 
     # Get template
     template_job = MapReduceJob(
@@ -46,35 +68,74 @@ async def start(request):
         PoolingReducer(PoolingReducer.PoolingType.AVG),
         {"input_bucket": config.IMAGE_BUCKET},
         n_mappers=n_mappers,
+        scheduler=scheduler,
+        weight=weight,
     )
     template_request = request.json["template"]
-    template_result = await template_job.run_until_complete([template_request])
-    template = numpy_to_base64(template_result)
+    template = await template_job.run_until_complete([template_request])
 
-    # Run query
-    query_job = MapReduceJob(
+    # Run query, joining the scan of any other query that's running (n_mappers only
+    # applies if this one starts a new scan)
+    query = await shared_scans.attach(
         config.QUERY_ENDPOINT,
-        TopKReducer(config.N_RESULTS_TO_DISPLAY, itemgetter("score")),
+        config.IMAGE_LIST_PATH,
         {
             "input_bucket": config.IMAGE_BUCKET,
             "output_bucket": config.OUTPUT_BUCKET,
             "output_path": config.OUTPUT_PATH,
             "n_distances_to_average": config.N_DISTANCES_TO_AVERAGE,
-            "template": template,
+            "score_map_top_k": config.N_RESULTS_TO_DISPLAY,  # only save shown maps
+            "background_uploads": True,
+            "index_bucket": config.INDEX_BUCKET,
+            "index_path": config.INDEX_PATH,
         },
+        template,
+        TopKReducer(config.N_RESULTS_TO_DISPLAY, itemgetter("score")),
+        weight=weight,
+        callback=lambda _: cleanup_query(query.job_id),  # called once it's finished
         n_mappers=n_mappers,
-        n_retries=1,
     )
-    query_id = query_job.job_id
-    current_queries[query_id] = query_job
-
-    dataset = FileListIterator(config.IMAGE_LIST_PATH)
-    cleanup_func = functools.partial(cleanup_query, query_id=query_id, dataset=dataset)
-    await query_job.start(dataset, cleanup_func)
+    query_id = query.job_id
+    current_queries[query_id] = query
 
     return json({"query_id": query_id})
 
 
+@app.route("/search_index", methods=["POST"])
+async def search_index(request):
+    # Answers a query from the prebuilt patch index instead of scanning the dataset;
+    # "n_probe" (number of index lists to scan) trades recall for latency
+    assert ann_index is not None
+    n_probe = int(request.json.get("n_probe", config.ANN_N_PROBE))
+
+    template_job = MapReduceJob(
+        config.TEMPLATE_ENDPOINT,
+        PoolingReducer(PoolingReducer.PoolingType.AVG),
+        {"input_bucket": config.IMAGE_BUCKET},
+        n_mappers=1,
+    )
+    template = await template_job.run_until_complete([request.json["template"]])
+
+    # Searching is CPU-bound, so keep it off the event loop
+    if isinstance(ann_index, IVFIndex):
+        search = partial(
+            ann_index.search, template, config.N_RESULTS_TO_DISPLAY, n_probe
+        )
+    else:  # PQIndex scans all codes
+        search = partial(ann_index.search, template, config.N_RESULTS_TO_DISPLAY)
+    start_time = time.time()
+    (results,) = await asyncio.get_running_loop().run_in_executor(None, search)
+    search_time = time.time() - start_time
+
+    return json(
+        {
+            "result": [{"score": s, "input": i, "output": {}} for s, i in results],
+            "search_time": search_time,
+            "n_probe": n_probe,
+        }
+    )
+
+
 @app.route("/results", methods=["GET"])
 async def get_results(request):
     query_id = request.args["query_id"][0]
@@ -87,6 +148,39 @@ async def get_results(request):
     return json(results)
 
 
+@app.route("/results_stream", methods=["GET"])
+async def stream_results(request):
+    # Server-sent events: the full results first, then only what changed since the
+    # previous event (see MapReduceJob.snapshot), until the query finishes
+    query_id = request.args["query_id"][0]
+    query_job = current_queries[query_id]
+
+    async def push_snapshots(response):
+        version = None
+        while True:
+            snapshot = query_job.snapshot(version)
+            version = snapshot["version"]
+            for field in ("items", "added"):
+                if field in snapshot["result"]:
+                    snapshot["result"][field] = {
+                        k: r.to_dict() for k, r in snapshot["result"][field].items()
+                    }
+            await response.write(f"data: {dumps(snapshot)}\n\n")
+
+            if snapshot["progress"]["finished"] or query_id not in current_queries:
+                break
+            await asyncio.sleep(config.RESULTS_PUSH_INTERVAL)
+
+    return stream(push_snapshots, content_type="text/event-stream")
+
+
+@app.route("/scheduler", methods=["GET"])
+async def get_scheduler_stats(request):
+    # Weight, fair share, requests in flight and throughput of every running job,
+    # and for shared scans, of each of their queries
+    return json(scheduler.stats())
+
+
 @app.route("/stop", methods=["PUT"])
 async def stop(request):
     query_id = request.json["query_id"]
@@ -94,8 +188,13 @@ async def stop(request):
     return text("", status=204)
 
 
-def cleanup_query(_, query_id: str, dataset: FileListIterator):
-    dataset.close()
+@app.listener("after_server_stop")
+async def close_shared_jobs(app, loop):
+    await shared_scans.close()
+    await scheduler.close()
+
+
+def cleanup_query(query_id: str):
     asyncio.create_task(final_query_cleanup(query_id))
 
 
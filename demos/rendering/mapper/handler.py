@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import io
 
@@ -35,27 +36,41 @@ class SegmentationMapper(Mapper):
     async def process_element(
         self, input, job_id, job_args, request_id, element_index,
     ):
-        # Download image
+        # Download image (storage.Client is blocking, so use the loop's I/O threads)
         image_bucket = job_args["input_bucket"]
         image_path = input
+        image_bytes = await asyncio.get_running_loop().run_in_executor(
+            None, self.download_image, image_bucket, image_path
+        )
+
+        # Segment and render on the compute executor
+        return await self.run_in_executor(
+            self.render_image, image_bytes, request_id=request_id
+        )
+
+    def download_image(self, image_bucket, image_path):
         with io.BytesIO() as input_buffer:
             self.storage_client.download_blob_to_file(
                 f"gs://{image_bucket}/{image_path}", input_buffer
             )
+            return input_buffer.getvalue()
+
+    def render_image(self, image_bytes):
+        with io.BytesIO(image_bytes) as input_buffer:
             frame = np.asarray(Image.open(input_buffer))
 
-            # RGB -> BGR
-            frame_bgr = frame[:, :, ::-1]
+        # RGB -> BGR
+        frame_bgr = frame[:, :, ::-1]
 
-            # Perform segmentation
-            result = self.model(frame_bgr)
+        # Perform segmentation
+        result = self.model(frame_bgr)
 
-            # Render output
-            visualizer = Visualizer(frame, self.metadata)
-            vis_output = visualizer.draw_instance_predictions(
-                predictions=result["instances"]
-            )
-            rendered = vis_output.get_image()
+        # Render output
+        visualizer = Visualizer(frame, self.metadata)
+        vis_output = visualizer.draw_instance_predictions(
+            predictions=result["instances"]
+        )
+        rendered = vis_output.get_image()
 
         # Encode image
         output = Image.fromarray(rendered)
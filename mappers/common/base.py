@@ -1,5 +1,10 @@
+import asyncio
+import collections
+import hashlib
 import io
+import math
 import os
+import time
 
 import aiohttp
 from gcloud.aio.storage import Storage
@@ -13,12 +18,25 @@ from detectron2.modeling.backbone.resnet import build_resnet_backbone
 
 from knn.mappers import Mapper
 
+from cache import DiskLRUCache
+
 
 class ResNetBackboneMapper(Mapper):
-    def initialize_container(self, cfg, weights_path):
+    def initialize_container(
+        self,
+        cfg,
+        weights_path,
+        max_batch_size=8,
+        max_batch_delay=0.05,
+        pad_batches=False,
+        cache_dir=None,
+        image_cache_bytes=2 ** 30,
+        embedding_cache_bytes=2 ** 30,
+    ):
         # Create model
         shape = ShapeSpec(channels=3)
-        self.model = torch.nn.Sequential(build_resnet_backbone(cfg, shape))
+        backbone = build_resnet_backbone(cfg, shape)
+        self.model = torch.nn.Sequential(backbone)
 
         # Load model weights
         checkpointer = DetectionCheckpointer(self.model, save_to_disk=False)
@@ -31,38 +49,217 @@ class ResNetBackboneMapper(Mapper):
         pixel_std = torch.Tensor(cfg.MODEL.PIXEL_STD).view(-1, 1, 1)
         self.normalize = lambda image: (image - pixel_mean) / pixel_std
         self.input_format = cfg.INPUT.FORMAT
+        (output_shape,) = backbone.output_shape().values()
+        self.output_stride = output_shape.stride
+
+        # Micro-batching: images are queued after preprocessing and run through the
+        # backbone together. Only images of the same size share a batch unless
+        # pad_batches is set, in which case they're padded to the largest one and
+        # the outputs are cropped back (slightly changing features near the edges).
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.pad_batches = pad_batches
+        self._n_preprocessing = 0  # images that may still join the next batch
+        self._batch_queues = collections.defaultdict(list)
+        self._batch_timers = {}
+        self._batch_tasks = set()  # keep running batches referenced
+
+        # Optional local caches of downloaded images and of backbone outputs, so
+        # repeat queries over the same images skip the download and the forward
+        # pass. Embeddings are keyed by everything that affects them as well.
+        if cache_dir is not None:
+            self.image_cache = DiskLRUCache(
+                os.path.join(cache_dir, "images"), image_cache_bytes
+            )
+            self.embedding_cache = DiskLRUCache(
+                os.path.join(cache_dir, "embeddings"), embedding_cache_bytes
+            )
+        else:
+            self.image_cache = self.embedding_cache = None
+        self.model_hash = hashlib.sha256(
+            f"{cfg.dump()}|{weights_path}|{pad_batches}".encode("utf-8")
+        ).hexdigest()
 
         # Create connection pools
         self.session = aiohttp.ClientSession()
         self.storage_client = Storage(session=self.session)
 
-    async def download_and_process_image(self, image_bucket, image_path, request_id):
-        # Download image
+    async def download_image(self, image_bucket, image_path, request_id=None):
+        loop = asyncio.get_running_loop()
+        key = os.path.join(image_bucket, image_path)
+        if self.image_cache is not None:
+            image_bytes = await loop.run_in_executor(
+                None, self.image_cache.get_bytes, key
+            )
+            if request_id is not None:
+                hit = image_bytes is not None
+                category = "image_cache_hits" if hit else "image_cache_misses"
+                self.add_profiling(request_id, category, 1)
+            if image_bytes is not None:
+                return image_bytes
+
         async with self.session.get(
-            f"https://storage.googleapis.com/{os.path.join(image_bucket, image_path)}"
+            f"https://storage.googleapis.com/{key}"
         ) as response:
             assert response.status == 200
             image_bytes = await response.read()
 
-        # Preprocess image
-        with self.profiler(request_id, "compute_time"):
-            with io.BytesIO(image_bytes) as image_buffer:
-                image = Image.open(image_buffer)
-
-                # Preprocess
-                assert image.mode == "RGB"
-                image = torch.as_tensor(
-                    np.asarray(image), dtype=torch.float32
-                )  # -> tensor
-                image = image.permute(2, 0, 1)  # HWC -> CHW
-                if self.input_format == "BGR":
-                    image = torch.flip(image, dims=(0,))  # RGB -> BGR
-                image = image.contiguous()
-                image = self.normalize(image)
+        if self.image_cache is not None:
+            await loop.run_in_executor(
+                None, self.image_cache.put_bytes, key, image_bytes
+            )
+        return image_bytes
+
+    async def prefetch_image(self, image_bucket, image_path, request_id):
+        # What subclasses should return from prefetch_element; nothing to fetch if
+        # the embeddings are cached already
+        if self._embeddings_cached(image_bucket, image_path):
+            return None
+        return await self.download_image(image_bucket, image_path, request_id)
+
+    async def download_and_process_image(
+        self, image_bucket, image_path, request_id, element_index=None
+    ):
+        # If prefetching, subclasses should return prefetch_image(...) from
+        # prefetch_element and pass element_index here to pick up its result
+        self._n_preprocessing += 1
+        try:
+            image_bytes = None
+            if self.is_prefetching and element_index is not None:
+                image_bytes = await self.prefetched(request_id, element_index)
+
+            # Look for cached embeddings
+            if self.embedding_cache is not None:
+                spatial_embeddings = self.embedding_cache.get_array(
+                    self._embedding_key(image_bucket, image_path)
+                )
+                hit = spatial_embeddings is not None
+                category = "embedding_cache_hits" if hit else "embedding_cache_misses"
+                self.add_profiling(request_id, category, 1)
+                if spatial_embeddings is not None:
+                    return torch.from_numpy(spatial_embeddings)
+
+            # Download image
+            if image_bytes is None:
+                with self.profiler(request_id, "io_wait"):
+                    image_bytes = await self.download_image(
+                        image_bucket, image_path, request_id
+                    )
+
+            # Preprocess image
+            image = await self.run_in_executor(
+                self.preprocess_image, image_bytes, request_id=request_id
+            )
+        finally:
+            self._n_preprocessing -= 1
+            self._flush_batches_if_ready()
 
         # Perform inference
-        with self.profiler(request_id, "compute_time"):
-            result = self.model(image.unsqueeze(dim=0))
-            assert len(result) == 1
-            spatial_embeddings = next(iter(result.values())).squeeze(dim=0)
-            return spatial_embeddings
+        spatial_embeddings = await self.compute_spatial_embeddings(image, request_id)
+
+        if self.embedding_cache is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                self.embedding_cache.put_array,
+                self._embedding_key(image_bucket, image_path),
+                spatial_embeddings.numpy(),
+            )
+        return spatial_embeddings
+
+    def preprocess_image(self, image_bytes):
+        with io.BytesIO(image_bytes) as image_buffer:
+            image = Image.open(image_buffer)
+
+            # Preprocess
+            assert image.mode == "RGB"
+            image = torch.as_tensor(np.asarray(image), dtype=torch.float32)  # -> tensor
+            image = image.permute(2, 0, 1)  # HWC -> CHW
+            if self.input_format == "BGR":
+                image = torch.flip(image, dims=(0,))  # RGB -> BGR
+            image = image.contiguous()
+            image = self.normalize(image)
+            return image
+
+    async def compute_spatial_embeddings(self, image, request_id):
+        key = None if self.pad_batches else tuple(image.shape[-2:])
+        future = asyncio.get_event_loop().create_future()
+        self._batch_queues[key].append((image, request_id, future))
+
+        if len(self._batch_queues[key]) >= self.max_batch_size:
+            self._run_batch(key)
+        elif key not in self._batch_timers:  # don't wait forever for stragglers
+            self._batch_timers[key] = asyncio.get_event_loop().call_later(
+                self.max_batch_delay, self._run_batch, key
+            )
+        self._flush_batches_if_ready()
+
+        return await future
+
+    def _flush_batches_if_ready(self):
+        # Once no more images are on their way, waiting can't grow any batch
+        if self._n_preprocessing == 0:
+            for key in list(self._batch_queues):
+                self._run_batch(key)
+
+    def _run_batch(self, key):
+        timer = self._batch_timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        queued = self._batch_queues.pop(key, [])
+        if not queued:
+            return
+
+        task = asyncio.ensure_future(self._infer_batch(queued))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _infer_batch(self, queued):
+        try:
+            spatial_embeddings, batch_time = await self.run_in_executor(
+                self._forward_batch, [image for image, _, _ in queued]
+            )
+        except Exception as e:
+            for _, _, future in queued:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # Attribute an equal share of the batch to each image, and also record the
+        # batch as a whole so per-batch and per-image figures can be recovered
+        for request_id in {request_id for _, request_id, _ in queued}:
+            self.add_profiling(request_id, "inference_batch_time", batch_time)
+            self.add_profiling(request_id, "inference_n_batches", 1)
+        for (image, request_id, future), embeddings in zip(queued, spatial_embeddings):
+            self.add_profiling(request_id, "compute_time", batch_time / len(queued))
+            self.add_profiling(request_id, "inference_n_images", 1)
+            if self.pad_batches:
+                h = math.ceil(image.size(1) / self.output_stride)
+                w = math.ceil(image.size(2) / self.output_stride)
+                embeddings = embeddings[:, :h, :w]
+            if not future.done():
+                future.set_result(embeddings)
+
+    def _forward_batch(self, images):
+        # Runs on the compute executor
+        start_time = time.time()
+        if self.pad_batches:
+            max_h = max(image.size(1) for image in images)
+            max_w = max(image.size(2) for image in images)
+            images = [
+                torch.nn.functional.pad(
+                    image, (0, max_w - image.size(2), 0, max_h - image.size(1))
+                )
+                for image in images
+            ]
+        with torch.no_grad():  # grad mode is per-thread
+            result = self.model(torch.stack(images))
+        assert len(result) == 1
+        return next(iter(result.values())), time.time() - start_time
+
+    def _embedding_key(self, image_bucket, image_path):
+        return os.path.join(self.model_hash, image_bucket, image_path)
+
+    def _embeddings_cached(self, image_bucket, image_path):
+        return self.embedding_cache is not None and self.embedding_cache.has_array(
+            self._embedding_key(image_bucket, image_path)
+        )
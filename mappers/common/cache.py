@@ -0,0 +1,114 @@
+import collections
+import hashlib
+import os
+import threading
+import uuid
+
+import numpy as np
+
+
+class DiskLRUCache:
+    # Size-bounded, least-recently-used cache of files in a local directory. Values
+    # are either raw bytes or ndarrays; arrays are stored as .npy files and loaded
+    # memory-mapped, so a hit only pages in what's actually read. The index lives in
+    # memory, but files left over from an earlier process are picked up (oldest
+    # first) so a restarted container stays warm. Safe to use from several threads.
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._entries = collections.OrderedDict()  # filename -> size, LRU first
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        existing = []
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            if filename.startswith("."):  # interrupted write
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            existing.append((stat.st_mtime, filename, stat.st_size))
+        with self._lock:
+            for _, filename, size in sorted(existing):
+                self._entries[filename] = size
+                self._total_bytes += size
+            self._evict()
+
+    def get_bytes(self, key):
+        path = self._lookup(self._filename(key, ".bin"))
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:  # evicted in the meantime
+            return None
+
+    def put_bytes(self, key, data):
+        def write(f):
+            f.write(data)
+
+        self._put(self._filename(key, ".bin"), write)
+
+    def get_array(self, key):
+        # Copy-on-write mapping: callers can modify the result without touching the
+        # cached file
+        path = self._lookup(self._filename(key, ".npy"))
+        if path is None:
+            return None
+        try:
+            return np.load(path, mmap_mode="c")
+        except FileNotFoundError:
+            return None
+
+    def has_array(self, key):
+        with self._lock:
+            return self._filename(key, ".npy") in self._entries
+
+    def put_array(self, key, array):
+        def write(f):
+            np.save(f, np.ascontiguousarray(array))
+
+        self._put(self._filename(key, ".npy"), write)
+
+    # INTERNAL
+
+    @staticmethod
+    def _filename(key, suffix):
+        return hashlib.sha256(key.encode("utf-8")).hexdigest() + suffix
+
+    def _lookup(self, filename):
+        with self._lock:
+            if filename not in self._entries:
+                return None
+            self._entries.move_to_end(filename)
+        return os.path.join(self.directory, filename)
+
+    def _put(self, filename, write):
+        # Write under a temporary name, then rename, so readers never see a
+        # partially-written file
+        tmp_path = os.path.join(self.directory, f".{uuid.uuid4().hex}")
+        with open(tmp_path, "wb") as f:
+            write(f)
+        size = os.path.getsize(tmp_path)
+        if size > self.max_bytes:
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, os.path.join(self.directory, filename))
+
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(filename, 0)
+            self._entries[filename] = size
+            self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes:
+            filename, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
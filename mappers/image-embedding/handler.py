@@ -2,7 +2,6 @@ import math
 
 import torch
 
-from knn import utils
 from knn.mappers import Mapper
 
 from base import ResNetBackboneMapper
@@ -10,6 +9,11 @@ import config
 
 
 class ImageEmbeddingMapper(ResNetBackboneMapper):
+    async def prefetch_element(self, input, job_id, job_args, request_id):
+        return await self.prefetch_image(
+            job_args["input_bucket"], input["image"], request_id
+        )
+
     @Mapper.SkipIfAssertionError
     async def process_element(self, input, job_id, job_args, request_id, element_index):
         image_bucket = job_args["input_bucket"]
@@ -17,7 +21,7 @@ class ImageEmbeddingMapper(ResNetBackboneMapper):
         x1, y1, x2, y2 = input.get("patch", (0, 0, 1, 1))
 
         spatial_embeddings = await self.download_and_process_image(
-            image_bucket, image_path, request_id
+            image_bucket, image_path, request_id, element_index
         )
 
         with self.profiler(request_id, "compute_time"):
@@ -31,7 +35,7 @@ class ImageEmbeddingMapper(ResNetBackboneMapper):
             embedding = spatial_embeddings[:, y1:y2, x1:x2].mean(dim=-1).mean(dim=-1)
             embedding = torch.nn.functional.normalize(embedding, p=2, dim=0)
 
-        return utils.numpy_to_base64(embedding.numpy())
+        return embedding.numpy()  # serialized according to the wire format
 
 
 mapper = ImageEmbeddingMapper(config.RESNET_CONFIG, config.WEIGHTS_PATH)
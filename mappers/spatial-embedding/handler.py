@@ -0,0 +1,25 @@
+import numpy as np
+
+from knn.mappers import Mapper
+
+from base import ResNetBackboneMapper
+import config
+
+
+class SpatialEmbeddingMapper(ResNetBackboneMapper):
+    # Computes whole backbone feature maps for building an embedding index (see
+    # knn.reducers.EmbeddingWriterReducer), which spatial search can then read
+    # instead of running the backbone itself
+
+    async def prefetch_element(self, input, job_id, job_args, request_id):
+        return await self.prefetch_image(job_args["input_bucket"], input, request_id)
+
+    @Mapper.SkipIfAssertionError
+    async def process_element(self, input, job_id, job_args, request_id, element_index):
+        spatial_embeddings = await self.download_and_process_image(
+            job_args["input_bucket"], input, request_id, element_index
+        )
+        return spatial_embeddings.numpy().astype(np.float16)
+
+
+mapper = SpatialEmbeddingMapper(config.RESNET_CONFIG, config.WEIGHTS_PATH)
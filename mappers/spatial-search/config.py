@@ -5,3 +5,5 @@ RESNET_CONFIG = get_default_detectron_config()
 
 MIN_VIZ_SCORE = 0.25
 MAX_VIZ_SCORE = 0.75
+
+MAX_CONCURRENT_UPLOADS = 16  # for background score map uploads
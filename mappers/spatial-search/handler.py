@@ -1,3 +1,5 @@
+import asyncio
+import heapq
 import io
 import os
 
@@ -6,6 +8,11 @@ from PIL import Image
 import torch
 
 from knn import utils
+from knn.embedding_shards import (
+    EmbeddingShards,
+    MANIFEST_FILENAME,
+    METADATA_FILENAME,
+)
 from knn.mappers import Mapper
 
 from base import ResNetBackboneMapper
@@ -13,16 +20,54 @@ import config
 
 
 class SpatialSearchMapper(ResNetBackboneMapper):
+    def initialize_container(self, *args, **kwargs):
+        super().initialize_container(*args, **kwargs)
+        self._upload_slots = None  # created on the event loop
+        self._upload_tasks = set()  # keep background uploads referenced
+        self._n_failed_uploads = 0  # background uploads not yet reported
+
     async def initialize_job(self, job_args):
-        return {
+        # Either one template, or (multi-template mode) a list or stack of them that
+        # are all scored against each feature map at once
+        if "templates" in job_args:
+            templates = job_args["templates"]
+            if isinstance(templates, list):
+                templates = np.stack([utils.as_numpy(t) for t in templates])
+            else:
+                templates = utils.as_numpy(templates)
+        else:
+            templates = utils.as_numpy(job_args["template"])[np.newaxis]
+        job_args = {
             **job_args,
-            "template": torch.as_tensor(
-                utils.base64_to_numpy(job_args["template"])
-            ).unsqueeze(0),
+            "templates": torch.as_tensor(np.array(templates)),  # writable copy
+            "multi_template": "templates" in job_args,
+            "top_scores": [[] for _ in range(len(templates))],
         }
 
+        # Query mode: read precomputed feature maps from an embedding index (built
+        # with the spatial-embedding mapper) instead of running the backbone. The
+        # index is either a local directory or a path in index_bucket.
+        if job_args.get("index_path"):
+            job_args["index"] = await self.load_index(
+                job_args.get("index_bucket"), job_args["index_path"]
+            )
+        return job_args
+
+    async def prefetch_element(self, input, job_id, job_args, request_id):
+        if input in job_args.get("index", ()):
+            return await self.read_indexed_embeddings(job_args, input, request_id)
+        return await self.prefetch_image(job_args["input_bucket"], input, request_id)
+
     @Mapper.SkipIfAssertionError
     async def process_element(self, input, job_id, job_args, request_id, element_index):
+        # Background uploads that failed after their response was sent are reported
+        # with the next request
+        if self._n_failed_uploads:
+            self.add_profiling(
+                request_id, "score_map_upload_failures", self._n_failed_uploads
+            )
+            self._n_failed_uploads = 0
+
         image_bucket = job_args["input_bucket"]
         image_path = input
         image_name = image_path[image_path.rfind("/") + 1 : image_path.rfind(".")]
@@ -30,34 +75,170 @@ class SpatialSearchMapper(ResNetBackboneMapper):
         output_bucket = job_args["output_bucket"]
         output_path = os.path.join(job_args["output_path"], job_id, image_name)
 
-        spatial_embeddings = await self.download_and_process_image(
-            image_bucket, image_path, request_id
-        )
-        with self.profiler(request_id, "compute_time"):
-            score, score_map = self.compute_knn_score(
-                spatial_embeddings,
-                job_args["template"],
-                job_args["n_distances_to_average"],
+        if image_path in job_args.get("index", ()):
+            if self.is_prefetching:
+                spatial_embeddings = await self.prefetched(request_id, element_index)
+            else:
+                with self.profiler(request_id, "io_wait"):
+                    spatial_embeddings = await self.read_indexed_embeddings(
+                        job_args, image_path, request_id
+                    )
+        else:
+            spatial_embeddings = await self.download_and_process_image(
+                image_bucket, image_path, request_id, element_index
             )
+        scores, score_maps = await self.run_in_executor(
+            self.compute_knn_scores,
+            spatial_embeddings,
+            job_args["templates"],
+            job_args["n_distances_to_average"],
+            request_id=request_id,
+        )
 
-        # Save score map
-        score_map_path = os.path.join(output_path, "scores.jpg")
-        await self.save_score_map(score_map, output_bucket, score_map_path)
-
-        return {"score": score, "score_map_path": score_map_path}
+        # Save score maps, except ones that can't make it into the results. Maps
+        # uploaded in the background are marked pending, since they may not exist
+        # yet (or ever, if the upload fails) when the response arrives; maps that
+        # failed to upload in the foreground have no path.
+        score_map_paths = []
+        score_maps_pending = []
+        uploads = {}
+        for i, (score, score_map) in enumerate(zip(scores, score_maps)):
+            score_maps_pending.append(False)
+            if not self.should_save_score_map(job_args, i, score):
+                score_map_paths.append(None)
+                continue
+
+            filename = f"scores-{i}.jpg" if job_args["multi_template"] else "scores.jpg"
+            score_map_path = os.path.join(output_path, filename)
+            score_map_paths.append(score_map_path)
+            if job_args.get("background_uploads"):
+                self.save_score_map_in_background(
+                    score_map, output_bucket, score_map_path
+                )
+                score_maps_pending[i] = True
+            else:
+                uploads[i] = self.save_score_map(
+                    score_map, output_bucket, score_map_path
+                )
+
+        upload_results = await asyncio.gather(*uploads.values(), return_exceptions=True)
+        for i, upload_result in zip(uploads, upload_results):
+            if isinstance(upload_result, Exception):
+                score_map_paths[i] = None
+                self.add_profiling(request_id, "score_map_upload_failures", 1)
+
+        if job_args["multi_template"]:
+            output = {
+                "scores": scores,
+                "score_map_paths": score_map_paths,
+                "score_maps_pending": score_maps_pending,
+            }
+            if job_args.get("return_score_maps"):
+                output["score_maps"] = score_maps.numpy().astype(np.float16)
+        else:
+            output = {
+                "score": scores[0],
+                "score_map_path": score_map_paths[0],
+                "score_map_pending": score_maps_pending[0],
+            }
+            if job_args.get("return_score_maps"):
+                output["score_map"] = score_maps[0].numpy().astype(np.float16)
+        return output
+
+    def should_save_score_map(self, job_args, template_index, score):
+        # Optional filters from job_args: a minimum score, and/or a number of results
+        # k that will actually be shown. For the latter, we keep a running top k of
+        # the scores this container has seen for the job; anything in the job's
+        # overall top k is necessarily in it, so no displayed result loses its map.
+        threshold = job_args.get("score_map_threshold")
+        if threshold is not None and score < threshold:
+            return False
+
+        k = job_args.get("score_map_top_k")
+        if k is not None:
+            top_scores = job_args["top_scores"][template_index]  # min-heap
+            if len(top_scores) < k:
+                heapq.heappush(top_scores, score)
+            elif score > top_scores[0]:
+                heapq.heapreplace(top_scores, score)
+            else:
+                return False
+        return True
+
+    async def load_index(self, index_bucket, index_path):
+        if index_bucket is None:
+            return EmbeddingShards.open(index_path)
+
+        metadata, manifest = await asyncio.gather(
+            self.read_object(index_bucket, os.path.join(index_path, METADATA_FILENAME)),
+            self.read_object(index_bucket, os.path.join(index_path, MANIFEST_FILENAME)),
+        )
+        return EmbeddingShards.parse(metadata, manifest)
 
-    def compute_knn_score(self, embeddings, template, n_distances):
+    async def read_indexed_embeddings(self, job_args, image_path, request_id):
+        index = job_args["index"]
+        if index.directory is not None:  # memory-mapped; reading may hit the disk
+            embeddings = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: index.get(image_path).astype(np.float32)
+            )
+        else:
+            shard, offset, length = index.locate(image_path)
+            data = await self.read_object(
+                job_args["index_bucket"],
+                os.path.join(job_args["index_path"], shard),
+                (offset, length),
+            )
+            embeddings = index.from_bytes(image_path, data).astype(np.float32)
+        self.add_profiling(request_id, "index_hits", 1)
+        return torch.from_numpy(embeddings)
+
+    async def read_object(self, bucket, path, byte_range=None):
+        headers = {}
+        if byte_range is not None:
+            offset, length = byte_range
+            headers["Range"] = f"bytes={offset}-{offset + length - 1}"
+        async with self.session.get(
+            f"https://storage.googleapis.com/{os.path.join(bucket, path)}",
+            headers=headers,
+        ) as response:
+            assert response.status in (200, 206)
+            return await response.read()
+
+    def compute_knn_scores(self, embeddings, templates, n_distances):
+        # All templates at once: one (T x C) @ (C x HW) matmul, then a top-k per row
         def cosine_similarity(x1_n, x2_t_n):  # n = L2 normalized, t = transposed
             return torch.mm(x1_n, x2_t_n)
 
-        embeddings_flat = embeddings.view(embeddings.size(0), -1)
+        embeddings_flat = embeddings.reshape(embeddings.size(0), -1)
         embeddings_flat = torch.nn.functional.normalize(embeddings_flat, p=2, dim=0)
-        scores = cosine_similarity(template, embeddings_flat).view(-1)
-        score = torch.topk(scores, n_distances).values.mean().item()
-        score_map = scores.view(embeddings.size(1), embeddings.size(2))
-        return score, score_map
+        scores = cosine_similarity(templates, embeddings_flat)
+        score = torch.topk(scores, n_distances, dim=1).values.mean(dim=1)
+        score_maps = scores.view(-1, embeddings.size(1), embeddings.size(2))
+        return score.tolist(), score_maps
+
+    def save_score_map_in_background(self, score_map, bucket, path):
+        # Returns immediately; at most MAX_CONCURRENT_UPLOADS maps are encoded and
+        # uploaded at once, and the rest wait their turn
+        if self._upload_slots is None:
+            self._upload_slots = asyncio.Semaphore(config.MAX_CONCURRENT_UPLOADS)
+
+        async def upload():
+            async with self._upload_slots:
+                try:
+                    await self.save_score_map(score_map, bucket, path)
+                except Exception:
+                    self._n_failed_uploads += 1
+
+        task = asyncio.ensure_future(upload())
+        self._upload_tasks.add(task)
+        task.add_done_callback(self._upload_tasks.discard)
 
     async def save_score_map(self, score_map, bucket, path):
+        image_bytes = await self.run_in_executor(self.encode_score_map, score_map)
+        with io.BytesIO(image_bytes) as image_buffer:
+            await self.storage_client.upload(bucket, path, image_buffer)
+
+    def encode_score_map(self, score_map):
         clamped_map = torch.clamp(score_map, config.MIN_VIZ_SCORE, config.MAX_VIZ_SCORE)
         rescaled_map = (
             255
@@ -68,8 +249,7 @@ class SpatialSearchMapper(ResNetBackboneMapper):
         image = Image.fromarray(rescaled_map.numpy().astype(np.uint8))
         with io.BytesIO() as image_buffer:
             image.save(image_buffer, "jpeg")
-            image_buffer.seek(0)
-            await self.storage_client.upload(bucket, path, image_buffer)
+            return image_buffer.getvalue()
 
 
 mapper = SpatialSearchMapper(config.RESNET_CONFIG, config.WEIGHTS_PATH)
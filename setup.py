@@ -10,6 +10,7 @@ setup(
     package_dir={"": "src"},
     packages=find_packages("src"),
     install_requires=["aiohttp", "dataclasses-json", "numpy", "runstats"],
+    extras_require={"parquet": ["pyarrow"]},
     python_requires=">=3.7",
     zip_safe=True,
 )
@@ -0,0 +1,250 @@
+import abc
+import bz2
+import copy
+import gzip
+import lzma
+import mmap
+import os
+import shutil
+
+import numpy as np
+
+from typing import Any, Iterable, Iterator, List, Optional
+
+# Random-access job inputs. Unlike a plain iterator, a Dataset knows its length
+# without reading everything, can fetch any element or contiguous range directly,
+# and can be sliced into views (e.g., to skip what's already done, or to shard a
+# job by range) that share the underlying storage. Datasets can be passed straight
+# to MapReduceJob.run_until_complete.
+#
+#   LineDataset       newline-separated text file, with a persisted line-offset index
+#   ArrayDataset      NumPy array, e.g., a memory-mapped .npy of fixed-width strings
+#   ParquetDataset    one column of a Parquet file (requires pyarrow)
+#
+# open_dataset() picks one based on the file extension, decompressing .gz, .bz2 and
+# .xz lists once into a cached copy next to them.
+
+READ_BATCH_SIZE = 4096  # elements read at a time when iterating
+SCAN_BLOCK_SIZE = 2 ** 26  # bytes scanned at a time when indexing a text file
+INDEX_SUFFIX = ".idx.npy"
+DECOMPRESSED_SUFFIX = ".lines"
+
+_DECOMPRESSORS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+_WHITESPACE = np.frombuffer(b" \t\r\n\x0b\x0c", dtype=np.uint8)
+
+
+class Dataset(abc.ABC):
+    # Subclasses implement _get() and (for faster iteration) _get_range() in terms of
+    # absolute indices into the full dataset; this class maps those onto the view's
+    # [start, stop) range.
+
+    def __init__(self, length: int) -> None:
+        self._start = 0
+        self._stop = length
+
+    @abc.abstractmethod
+    def _get(self, index: int) -> Any:
+        pass
+
+    def _get_range(self, start: int, stop: int) -> List[Any]:
+        return [self._get(i) for i in range(start, stop)]
+
+    def close(self, *args, **kwargs) -> None:
+        pass
+
+    def __enter__(self) -> "Dataset":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            assert step == 1, "only contiguous slices are supported"
+            view = copy.copy(self)
+            view._start = self._start + start
+            view._stop = self._start + max(start, stop)
+            return view
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(key)
+        return self._get(self._start + key)
+
+    def __iter__(self) -> Iterator[Any]:
+        for start in range(self._start, self._stop, READ_BATCH_SIZE):
+            yield from self._get_range(start, min(start + READ_BATCH_SIZE, self._stop))
+
+    def shard(self, shard_index: int, n_shards: int) -> "Dataset":
+        # Contiguous range shard_index of n_shards (sizes differ by at most one)
+        assert 0 <= shard_index < n_shards
+        start = shard_index * len(self) // n_shards
+        stop = (shard_index + 1) * len(self) // n_shards
+        return self[start:stop]
+
+
+class LineDataset(Dataset):
+    # One element per line (stripped of surrounding whitespace), up to the first
+    # blank line or the end of the file. The byte offset of every line is stored in
+    # index_path (default: next to the file) the first time the file is opened, so
+    # later opens just memory-map it; the index is rebuilt if the file has been
+    # modified since. If index_path can't be written, the index is kept in memory.
+
+    def __init__(self, path: str, index_path: Optional[str] = None) -> None:
+        self.path = path
+        self.index_path = index_path or path + INDEX_SUFFIX
+
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._data = (
+            mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        )
+        self._offsets = self._load_index(size)
+        super().__init__(len(self._offsets) - 1)
+
+    @classmethod
+    def from_compressed(
+        cls, path: str, cache_path: Optional[str] = None, **kwargs
+    ) -> "LineDataset":
+        # Compressed streams can't be seeked, so decompress once to cache_path
+        # (default: next to the file) and read that instead
+        cache_path = cache_path or path + DECOMPRESSED_SUFFIX
+        if not _is_up_to_date(cache_path, path):
+            decompress = _DECOMPRESSORS[os.path.splitext(path)[1]]
+            temp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with decompress(path, "rb") as source, open(temp_path, "wb") as dest:
+                shutil.copyfileobj(source, dest)
+            os.replace(temp_path, cache_path)
+        return cls(cache_path, **kwargs)
+
+    def close(self, *args, **kwargs) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+    def _get(self, index: int) -> str:
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return self._data[start:end].strip().decode("utf-8")
+
+    def _get_range(self, start: int, stop: int) -> List[str]:
+        # One read for the whole range, split in place of per-line lookups
+        data = self._data[self._offsets[start] : self._offsets[stop]]
+        lines = data.split(b"\n")[: stop - start]
+        return [line.strip().decode("utf-8") for line in lines]
+
+    # INTERNAL
+
+    def _load_index(self, size: int) -> np.ndarray:
+        if _is_up_to_date(self.index_path, self.path):
+            offsets = np.load(self.index_path, mmap_mode="r")
+            if len(offsets) and offsets[-1] <= size:
+                return offsets
+
+        offsets = self._build_index(size)
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                np.save(f, offsets)
+            os.replace(temp_path, self.index_path)
+        except OSError:  # e.g., read-only directory
+            pass
+        return offsets
+
+    def _build_index(self, size: int) -> np.ndarray:
+        # -> n + 1 offsets; line i spans [offsets[i], offsets[i + 1]) including its
+        # trailing newline
+        if not size:
+            return np.zeros(1, dtype=np.int64)
+
+        newlines = [np.empty(0, dtype=np.int64)]
+        for start in range(0, size, SCAN_BLOCK_SIZE):
+            block = np.frombuffer(
+                self._data,
+                dtype=np.uint8,
+                count=min(SCAN_BLOCK_SIZE, size - start),
+                offset=start,
+            )
+            newlines.append(np.flatnonzero(block == ord("\n")) + start)
+        ends = np.concatenate(newlines) + 1
+        if not len(ends) or ends[-1] < size:  # last line has no trailing newline
+            ends = np.append(ends, size)
+        offsets = np.concatenate([[0], ends]).astype(np.int64)
+
+        # Stop at the first blank (whitespace-only) line. Only lines that start with
+        # whitespace can be blank, and lists rarely have any, so just those are
+        # checked one at a time.
+        data = np.frombuffer(self._data, dtype=np.uint8)
+        for i in np.flatnonzero(np.isin(data[offsets[:-1]], _WHITESPACE)):
+            if not self._data[offsets[i] : offsets[i + 1]].strip():
+                return offsets[: i + 1]
+        return offsets
+
+
+class ArrayDataset(Dataset):
+    # Elements of a 1-D NumPy array, converted to Python values (bytes are decoded
+    # as UTF-8). open() memory-maps a .npy file, so a list of tens of millions of
+    # paths opens instantly; write() creates one from any iterable of strings.
+
+    def __init__(self, array: np.ndarray) -> None:
+        assert array.ndim == 1
+        self.array = array
+        super().__init__(len(array))
+
+    @classmethod
+    def open(cls, path: str) -> "ArrayDataset":
+        return cls(np.load(path, mmap_mode="r"))
+
+    @staticmethod
+    def write(path: str, items: Iterable[str]) -> None:
+        # Fixed-width byte strings, padded to the longest item
+        np.save(path, np.array([item.encode("utf-8") for item in items], dtype="S"))
+
+    def _get(self, index: int) -> Any:
+        return self._get_range(index, index + 1)[0]
+
+    def _get_range(self, start: int, stop: int) -> List[Any]:
+        values = self.array[start:stop].tolist()
+        if self.array.dtype.kind == "S":
+            return [value.decode("utf-8") for value in values]
+        return values
+
+
+class ParquetDataset(Dataset):
+    # Values of one column of a Parquet file, which is memory-mapped; slicing only
+    # adjusts offsets into the column's Arrow buffers.
+
+    def __init__(self, path: str, column: str) -> None:
+        import pyarrow.parquet as pq  # optional dependency
+
+        table = pq.read_table(path, columns=[column], memory_map=True)
+        self.column = table.column(column)
+        super().__init__(len(self.column))
+
+    def _get(self, index: int) -> Any:
+        return self.column[index].as_py()
+
+    def _get_range(self, start: int, stop: int) -> List[Any]:
+        return self.column.slice(start, stop - start).to_pylist()
+
+
+def open_dataset(path: str, **kwargs) -> Dataset:
+    # kwargs are passed to the reader, e.g., column= for Parquet files
+    extension = os.path.splitext(path)[1]
+    if extension == ".npy":
+        return ArrayDataset.open(path, **kwargs)
+    elif extension in (".parquet", ".pq"):
+        return ParquetDataset(path, **kwargs)
+    elif extension in _DECOMPRESSORS:
+        return LineDataset.from_compressed(path, **kwargs)
+    return LineDataset(path, **kwargs)
+
+
+def _is_up_to_date(derived_path: str, source_path: str) -> bool:
+    return os.path.exists(derived_path) and os.path.getmtime(
+        derived_path
+    ) >= os.path.getmtime(source_path)
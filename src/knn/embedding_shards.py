@@ -0,0 +1,212 @@
+import json
+import os
+
+import numpy as np
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# On-disk format for precomputed embeddings (e.g., backbone feature maps), so later
+# jobs can read them instead of recomputing them. A directory holds:
+#
+#   metadata.json     {"version": 1, "dtype": "<f2"}
+#   shard-00000.bin   raw arrays of that dtype, back to back
+#   shard-00001.bin   ...
+#   manifest.jsonl    one [key, shard, offset, shape] line per array, where offset
+#                     counts elements from the start of the shard
+#
+# Shards are append-only and can be memory-mapped; the manifest is only appended to
+# after the data it points to has been written, so a partially-written directory is
+# still readable. Several writers (e.g., the processes of a sharded job) can append
+# to one directory at once: each creates shards of its own, and appends whole lines
+# to the manifest with one write each time it flushes.
+
+VERSION = 1
+METADATA_FILENAME = "metadata.json"
+MANIFEST_FILENAME = "manifest.jsonl"
+DEFAULT_MAX_SHARD_BYTES = 2 ** 30
+
+Entry = Tuple[int, int, Tuple[int, ...]]  # shard, offset, shape
+
+
+def shard_filename(shard_index: int) -> str:
+    return f"shard-{shard_index:05d}.bin"
+
+
+class EmbeddingShardWriter:
+    # Appends arrays to the shards in `directory`, starting a new shard whenever the
+    # current one would grow past max_shard_bytes. Reopening an existing directory
+    # appends to it, starting from a fresh shard. Files are only opened once there's
+    # something to write, so a writer that hasn't written yet can be copied.
+
+    def __init__(
+        self,
+        directory: str,
+        max_shard_bytes: int = DEFAULT_MAX_SHARD_BYTES,
+        dtype: np.dtype = np.float16,
+    ) -> None:
+        self.directory = directory
+        self.max_shard_bytes = max_shard_bytes
+        self.dtype = np.dtype(dtype)
+
+        os.makedirs(directory, exist_ok=True)
+        metadata_path = os.path.join(directory, METADATA_FILENAME)
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            assert metadata["version"] == VERSION
+            assert np.dtype(metadata["dtype"]) == self.dtype
+        else:
+            with open(metadata_path, "w") as f:
+                json.dump({"version": VERSION, "dtype": self.dtype.str}, f)
+
+        self._next_shard_index = 0  # first index that might be free
+
+        self._manifest_fd: Optional[int] = None
+        self._manifest_lines: List[str] = []  # not yet flushed
+        self._shard = None
+        self._shard_index = -1
+        self._shard_size = 0  # in elements
+        self.n_written = 0
+
+    def add(self, key: str, array: np.ndarray) -> None:
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        if (
+            self._shard is None
+            or self._shard_size > 0
+            and (self._shard_size + array.size) * self.dtype.itemsize
+            > self.max_shard_bytes
+        ):
+            self._start_shard()
+
+        self._shard.write(array.data)
+        entry = [key, self._shard_index, self._shard_size, list(array.shape)]
+        self._manifest_lines.append(json.dumps(entry, separators=(",", ":")) + "\n")
+        self._shard_size += array.size
+        self.n_written += 1
+
+    def flush(self) -> None:
+        # Data first, so flushed manifest lines never point past the end of a shard
+        if self._shard is not None:
+            self._shard.flush()
+        if not self._manifest_lines:
+            return
+
+        if self._manifest_fd is None:
+            self._manifest_fd = os.open(
+                os.path.join(self.directory, MANIFEST_FILENAME),
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0o644,
+            )
+        # One write, so lines from other writers can't end up in the middle
+        data = "".join(self._manifest_lines).encode()
+        self._manifest_lines = []
+        while data:
+            n_written = os.write(self._manifest_fd, data)
+            data = data[n_written:]
+
+    def close(self) -> None:
+        self.flush()
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+        if self._manifest_fd is not None:
+            os.close(self._manifest_fd)
+            self._manifest_fd = None
+
+    @property
+    def n_shards(self) -> int:
+        # In the directory, including other writers'
+        return sum(
+            name.startswith("shard-") and name.endswith(".bin")
+            for name in os.listdir(self.directory)
+        )
+
+    def _start_shard(self) -> None:
+        if self._shard is not None:
+            self._shard.close()
+        while True:  # claim the first free index; other writers may be racing us
+            try:
+                path = os.path.join(
+                    self.directory, shard_filename(self._next_shard_index)
+                )
+                self._shard = open(path, "xb")
+                break
+            except FileExistsError:
+                self._next_shard_index += 1
+        self._shard_index = self._next_shard_index
+        self._next_shard_index += 1
+        self._shard_size = 0
+
+
+class EmbeddingShards:
+    # Read side. The manifest is parsed up front; arrays are read from memory-mapped
+    # shards if `directory` is local. Otherwise (e.g., shards in a bucket) use
+    # locate() to find the byte range to fetch and from_bytes() to decode it.
+
+    def __init__(
+        self,
+        dtype: np.dtype,
+        entries: Dict[str, Entry],
+        directory: Optional[str] = None,
+    ) -> None:
+        self.dtype = np.dtype(dtype)
+        self.directory = directory
+        self._entries = entries
+        self._shards: Dict[int, np.memmap] = {}
+
+    @classmethod
+    def open(cls, directory: str) -> "EmbeddingShards":
+        with open(os.path.join(directory, METADATA_FILENAME), "rb") as f:
+            metadata = f.read()
+        with open(os.path.join(directory, MANIFEST_FILENAME), "rb") as f:
+            manifest = f.read()
+        return cls.parse(metadata, manifest, directory)
+
+    @classmethod
+    def parse(
+        cls, metadata: bytes, manifest: bytes, directory: Optional[str] = None
+    ) -> "EmbeddingShards":
+        metadata_dict = json.loads(metadata)
+        assert metadata_dict["version"] == VERSION
+
+        entries: Dict[str, Entry] = {}
+        for line in manifest.splitlines():
+            try:
+                key, shard, offset, shape = json.loads(line)
+            except ValueError:  # last line may be cut off if the writer died
+                continue
+            entries[key] = (shard, offset, tuple(shape))
+        return cls(np.dtype(metadata_dict["dtype"]), entries, directory)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def locate(self, key: str) -> Tuple[str, int, int]:
+        # -> shard filename, byte offset, number of bytes
+        shard, offset, shape = self._entries[key]
+        count = int(np.prod(shape, dtype=np.int64))
+        itemsize = self.dtype.itemsize
+        return shard_filename(shard), offset * itemsize, count * itemsize
+
+    def from_bytes(self, key: str, data: bytes) -> np.ndarray:
+        _, _, shape = self._entries[key]
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape)
+
+    def get(self, key: str) -> np.ndarray:
+        # Read-only view into the memory-mapped shard
+        assert self.directory is not None
+        shard, offset, shape = self._entries[key]
+        if shard not in self._shards:
+            self._shards[shard] = np.memmap(
+                os.path.join(self.directory, shard_filename(shard)),
+                dtype=self.dtype,
+                mode="r",
+            )
+        count = int(np.prod(shape, dtype=np.int64))
+        return self._shards[shard][offset : offset + count].reshape(shape)
@@ -0,0 +1,2 @@
+from .ivf import IVFIndex
+from .pq import ProductQuantizer, OptimizedProductQuantizer, PQIndex
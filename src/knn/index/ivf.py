@@ -0,0 +1,234 @@
+import json
+
+import numpy as np
+
+from typing import BinaryIO, List, Optional, Sequence, Tuple, Union
+
+from knn.utils import JSONType
+
+# Assign/score vectors in blocks of this many rows to bound temporary memory
+BLOCK_SIZE = 65536
+
+
+class _VectorList:
+    # Growable array of vectors plus the position of each one's id in the index
+
+    def __init__(self, dim: int) -> None:
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+        self._positions = np.empty(0, dtype=np.int64)
+        self.size = 0
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[: self.size]
+
+    @property
+    def positions(self) -> np.ndarray:
+        return self._positions[: self.size]
+
+    def extend(self, vectors: np.ndarray, positions: np.ndarray) -> None:
+        new_size = self.size + len(vectors)
+        if new_size > len(self._vectors):  # amortized O(1) appends
+            capacity = max(new_size, 2 * len(self._vectors))
+            vectors_buffer = np.empty((capacity, self._vectors.shape[1]), np.float32)
+            vectors_buffer[: self.size] = self.vectors
+            positions_buffer = np.empty(capacity, dtype=np.int64)
+            positions_buffer[: self.size] = self.positions
+            self._vectors, self._positions = vectors_buffer, positions_buffer
+        self._vectors[self.size : new_size] = vectors
+        self._positions[self.size : new_size] = positions
+        self.size = new_size
+
+
+class IVFIndex:
+    # Inverted-file index for maximum inner product search, i.e., cosine similarity
+    # for L2-normalized embeddings like ImageEmbeddingMapper's. Vectors are bucketed
+    # by their closest centroid (spherical k-means over a sample), and a query only
+    # scans the n_probe buckets whose centroids are closest to it: n_probe trades
+    # recall for latency, and n_probe = n_lists is an exhaustive search.
+    #
+    # Vectors can be added at any time. Until train_size of them have been added,
+    # they're kept in a single bucket and searched exhaustively; the centroids are
+    # then trained on them and everything is bucketed from there on.
+
+    def __init__(
+        self,
+        dim: int,
+        n_lists: int = 256,
+        *,
+        train_size: Optional[int] = None,
+        n_iter: int = 20,
+        seed: int = 0,
+    ) -> None:
+        self.dim = dim
+        self.n_lists = n_lists
+        self.train_size = train_size or 39 * n_lists  # a few dozen points per list
+        self.n_iter = n_iter
+        self.seed = seed
+
+        self.centroids: Optional[np.ndarray] = None
+        self._lists = [_VectorList(dim)]
+        self._ids: List[JSONType] = []
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def add(self, vectors: np.ndarray, ids: Sequence[JSONType]) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        assert len(vectors) == len(ids)
+        positions = np.arange(len(self._ids), len(self._ids) + len(ids))
+        self._ids.extend(ids)
+
+        if self.is_trained:
+            self._assign(vectors, positions)
+        else:
+            self._lists[0].extend(vectors, positions)
+            if self._lists[0].size >= self.train_size:
+                self.train()
+
+    def train(self) -> None:
+        # (Re)computes the centroids from a sample of everything added so far and
+        # rebuckets all vectors. With fewer vectors than lists (e.g., none) there's
+        # nothing to train on, so they stay in one exhaustively searched bucket.
+        if len(self) < self.n_lists:
+            return
+
+        vectors = np.concatenate([vector_list.vectors for vector_list in self._lists])
+        positions = np.concatenate(
+            [vector_list.positions for vector_list in self._lists]
+        )
+
+        rng = np.random.RandomState(self.seed)
+        sample = vectors[
+            rng.choice(len(vectors), min(len(vectors), self.train_size), replace=False)
+        ]
+        self.centroids = self._spherical_kmeans(sample, rng)
+
+        self._lists = [_VectorList(self.dim) for _ in range(self.n_lists)]
+        self._assign(vectors, positions)
+
+    def search(
+        self, queries: np.ndarray, k: int, n_probe: int = 8
+    ) -> List[List[Tuple[float, JSONType]]]:
+        # -> for each query, up to k (score, id) pairs, best first
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        if self.is_trained:
+            n_probe = min(n_probe, self.n_lists)
+            centroid_scores = queries @ self.centroids.T
+            probes = np.argpartition(-centroid_scores, n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probes = np.zeros((len(queries), 1), dtype=np.int64)
+
+        results = []
+        for query, lists in zip(queries, probes):
+            lists = [self._lists[i] for i in lists if self._lists[i].size]
+            if not lists:
+                results.append([])
+                continue
+
+            scores = np.concatenate(
+                [vector_list.vectors @ query for vector_list in lists]
+            )
+            positions = np.concatenate([vector_list.positions for vector_list in lists])
+            if len(scores) > k:
+                top_k = np.argpartition(-scores, k - 1)[:k]
+                scores, positions = scores[top_k], positions[top_k]
+            order = np.argsort(-scores, kind="stable")
+            results.append([(float(scores[i]), self._ids[positions[i]]) for i in order])
+        return results
+
+    def merge(self, other: "IVFIndex") -> None:
+        # Adds all of other's vectors (rebucketed with this index's centroids)
+        assert other.dim == self.dim
+        for vector_list in other._lists:
+            self.add(
+                vector_list.vectors, [other._ids[p] for p in vector_list.positions]
+            )
+
+    def save(self, path: Union[str, BinaryIO]) -> None:
+        # np.savez would append ".npz" to a path without it, so open it ourselves
+        if isinstance(path, str):
+            with open(path, "wb") as f:
+                self.save(f)
+            return
+
+        sizes = np.array(
+            [vector_list.size for vector_list in self._lists], dtype=np.int64
+        )
+        np.savez(
+            path,
+            config=np.array(
+                [self.dim, self.n_lists, self.train_size, self.n_iter, self.seed]
+            ),
+            centroids=(
+                self.centroids
+                if self.is_trained
+                else np.empty((0, self.dim), dtype=np.float32)
+            ),
+            list_sizes=sizes,
+            vectors=np.concatenate(
+                [vector_list.vectors for vector_list in self._lists]
+            ),
+            positions=np.concatenate(
+                [vector_list.positions for vector_list in self._lists]
+            ),
+            ids=np.frombuffer(json.dumps(self._ids).encode("utf-8"), dtype=np.uint8),
+        )
+
+    @classmethod
+    def load(cls, path: Union[str, BinaryIO]) -> "IVFIndex":
+        with np.load(path) as data:
+            dim, n_lists, train_size, n_iter, seed = (int(x) for x in data["config"])
+            index = cls(dim, n_lists, train_size=train_size, n_iter=n_iter, seed=seed)
+            if len(data["centroids"]):
+                index.centroids = data["centroids"]
+            index._ids = json.loads(data["ids"].tobytes().decode("utf-8"))
+
+            offsets = np.concatenate([[0], np.cumsum(data["list_sizes"])])
+            vectors, positions = data["vectors"], data["positions"]
+            index._lists = []
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                vector_list = _VectorList(dim)
+                vector_list.extend(vectors[start:end], positions[start:end])
+                index._lists.append(vector_list)
+        return index
+
+    # INTERNAL
+
+    def _assign(self, vectors: np.ndarray, positions: np.ndarray) -> None:
+        for start in range(0, len(vectors), BLOCK_SIZE):
+            block = vectors[start : start + BLOCK_SIZE]
+            block_positions = positions[start : start + BLOCK_SIZE]
+            assignments = np.argmax(block @ self.centroids.T, axis=1)
+
+            # Group by list so each one is extended once per block
+            order = np.argsort(assignments, kind="stable")
+            lists, starts = np.unique(assignments[order], return_index=True)
+            ends = np.append(starts[1:], len(order))
+            for i, list_start, list_end in zip(lists, starts, ends):
+                rows = order[list_start:list_end]
+                self._lists[i].extend(block[rows], block_positions[rows])
+
+    def _spherical_kmeans(
+        self, sample: np.ndarray, rng: np.random.RandomState
+    ) -> np.ndarray:
+        def normalize(x):
+            return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+        sample = normalize(sample)
+        centroids = sample[rng.choice(len(sample), self.n_lists, replace=False)]
+        for _ in range(self.n_iter):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=self.n_lists)
+
+            # Reseed empty lists with random points
+            empty = np.flatnonzero(counts == 0)
+            sums[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+            centroids = normalize(sums)
+        return centroids.astype(np.float32)
@@ -0,0 +1,366 @@
+import json
+
+import numpy as np
+
+from typing import BinaryIO, Dict, List, Optional, Sequence, Tuple, Union
+
+from knn.utils import JSONType
+
+from .ivf import BLOCK_SIZE
+
+
+class ProductQuantizer:
+    # Compresses dim-dimensional float32 vectors to n_subvectors bytes each: every
+    # vector is split into n_subvectors slices, and each slice is replaced by the
+    # index of its closest centroid in that slice's codebook (k-means, 2 ** n_bits
+    # centroids). Inner products with an uncompressed query are computed directly
+    # from the codes ("asymmetric distance computation"): one lookup table per
+    # query, then n_subvectors table lookups per vector.
+
+    def __init__(
+        self,
+        dim: int,
+        n_subvectors: int,
+        n_bits: int = 8,
+        *,
+        n_iter: int = 20,
+        seed: int = 0,
+    ) -> None:
+        assert dim % n_subvectors == 0 and 1 <= n_bits <= 8
+        self.dim = dim
+        self.n_subvectors = n_subvectors
+        self.n_bits = n_bits
+        self.n_iter = n_iter
+        self.seed = seed
+
+        self.codebooks: Optional[np.ndarray] = None  # subvector, centroid, dim
+
+    @property
+    def n_centroids(self) -> int:
+        return 2 ** self.n_bits
+
+    @property
+    def subvector_dim(self) -> int:
+        return self.dim // self.n_subvectors
+
+    @property
+    def is_trained(self) -> bool:
+        return self.codebooks is not None
+
+    def train(self, vectors: np.ndarray) -> None:
+        vectors = self._prepare(vectors)
+        assert len(vectors) >= self.n_centroids
+        rng = np.random.RandomState(self.seed)
+        self.codebooks = np.stack(
+            [
+                _kmeans(subvectors, self.n_centroids, self.n_iter, rng)
+                for subvectors in self._split(vectors)
+            ]
+        )
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        # -> (n, n_subvectors) uint8 codes
+        return self._encode(self._prepare(vectors))
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        # Approximate reconstruction of the encoded vectors
+        return self._reconstruct(codes)
+
+    def score_table(self, query: np.ndarray) -> np.ndarray:
+        # -> (n_subvectors, n_centroids) inner products of each query slice with
+        # each centroid
+        query_slices = self._prepare(query).reshape(self.n_subvectors, 1, -1)
+        return (query_slices * self.codebooks).sum(axis=2)
+
+    def score(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        # -> approximate inner product of query with each encoded vector
+        # One gather per subvector, accumulated in place: much faster than a single
+        # fancy-indexed gather over (n, n_subvectors) and needs no temporaries
+        table = self.score_table(query)
+        scores = np.zeros(len(codes), dtype=np.float32)
+        for m in range(self.n_subvectors):
+            scores += table[m].take(codes[:, m])
+        return scores
+
+    def state(self) -> Dict[str, np.ndarray]:
+        # Codebooks are empty if untrained
+        return {
+            "config": np.array(
+                [self.dim, self.n_subvectors, self.n_bits, self.n_iter, self.seed]
+            ),
+            "codebooks": (
+                self.codebooks
+                if self.is_trained
+                else np.empty((0, self.n_centroids, self.subvector_dim), np.float32)
+            ),
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, np.ndarray]) -> "ProductQuantizer":
+        dim, n_subvectors, n_bits, n_iter, seed = (int(x) for x in state["config"])
+        quantizer = cls(dim, n_subvectors, n_bits, n_iter=n_iter, seed=seed)
+        if len(state["codebooks"]):
+            quantizer.codebooks = np.array(state["codebooks"])
+        return quantizer
+
+    # INTERNAL
+
+    def _prepare(self, vectors: np.ndarray) -> np.ndarray:
+        # Hook for transforms applied before quantization
+        return np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+
+    def _reconstruct(self, codes: np.ndarray) -> np.ndarray:
+        # In the space vectors are quantized in, i.e., after _prepare()
+        return np.concatenate(
+            [self.codebooks[m][codes[:, m]] for m in range(self.n_subvectors)], axis=1
+        )
+
+    def _split(self, vectors: np.ndarray) -> List[np.ndarray]:
+        return np.split(vectors, self.n_subvectors, axis=1)
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(vectors), self.n_subvectors), dtype=np.uint8)
+        for m, subvectors in enumerate(self._split(vectors)):
+            for start in range(0, len(vectors), BLOCK_SIZE):
+                block = subvectors[start : start + BLOCK_SIZE]
+                codes[start : start + BLOCK_SIZE, m] = _nearest(
+                    block, self.codebooks[m]
+                )
+        return codes
+
+
+class OptimizedProductQuantizer(ProductQuantizer):
+    # PQ after a learned rotation (OPQ), which spreads variance evenly across the
+    # slices and lowers quantization error, especially when a few dimensions carry
+    # most of the signal. Rotations preserve inner products, so queries are simply
+    # rotated the same way. Training alternates between fitting the codebooks and
+    # solving for the rotation that best maps vectors onto their reconstructions.
+
+    def __init__(
+        self,
+        dim: int,
+        n_subvectors: int,
+        n_bits: int = 8,
+        *,
+        n_iter: int = 20,
+        n_rotation_iter: int = 5,
+        seed: int = 0,
+    ) -> None:
+        super().__init__(dim, n_subvectors, n_bits, n_iter=n_iter, seed=seed)
+        self.n_rotation_iter = n_rotation_iter
+        self.rotation = np.eye(dim, dtype=np.float32)
+
+    def train(self, vectors: np.ndarray) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        self.rotation = np.eye(self.dim, dtype=np.float32)
+        for _ in range(self.n_rotation_iter):
+            super().train(vectors)
+            reconstructions = self._reconstruct(self.encode(vectors))  # rotated
+            # Orthogonal Procrustes: argmin_R ||X R - Y|| is U V^T for X^T Y = U S V^T
+            u, _, vt = np.linalg.svd(vectors.T @ reconstructions)
+            self.rotation = (u @ vt).astype(np.float32)
+        super().train(vectors)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return self._reconstruct(codes) @ self.rotation.T  # undo the rotation
+
+    def state(self) -> Dict[str, np.ndarray]:
+        return {**super().state(), "rotation": self.rotation}
+
+    @classmethod
+    def from_state(cls, state: Dict[str, np.ndarray]) -> "OptimizedProductQuantizer":
+        quantizer = super().from_state(state)
+        quantizer.rotation = np.array(state["rotation"])
+        return quantizer
+
+    def _prepare(self, vectors: np.ndarray) -> np.ndarray:
+        return super()._prepare(vectors) @ self.rotation
+
+
+class PQIndex:
+    # Flat index of PQ codes: n_subvectors bytes per vector instead of 4 * dim, and
+    # each query scans all the codes with asymmetric distance computation. Like
+    # IVFIndex, vectors can be added at any time; the first train_size of them are
+    # kept uncompressed until the quantizer is trained on them (if it isn't already),
+    # and are saved that way if it hasn't been by then.
+
+    def __init__(
+        self, quantizer: ProductQuantizer, *, train_size: Optional[int] = None
+    ) -> None:
+        self.quantizer = quantizer
+        self.train_size = train_size or 64 * quantizer.n_centroids
+
+        self._codes = np.empty((0, quantizer.n_subvectors), dtype=np.uint8)
+        self._size = 0
+        self._pending: List[np.ndarray] = []  # uncompressed, until trained
+        self._ids: List[JSONType] = []
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.quantizer.is_trained
+
+    @property
+    def codes(self) -> np.ndarray:
+        return self._codes[: self._size]
+
+    @property
+    def nbytes(self) -> int:
+        # Memory taken by the stored vectors (not counting ids)
+        return self.codes.nbytes + sum(v.nbytes for v in self._pending)
+
+    def add(self, vectors: np.ndarray, ids: Sequence[JSONType]) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.quantizer.dim)
+        assert len(vectors) == len(ids)
+        self._ids.extend(ids)
+
+        if self.quantizer.is_trained:
+            self._append_codes(self.quantizer.encode(vectors))
+            return
+
+        self._pending.append(vectors)
+        if sum(len(v) for v in self._pending) >= self.train_size:
+            self.train()
+
+    def train(self) -> None:
+        # Trains the quantizer on the vectors added so far, then compresses them.
+        # With fewer vectors than centroids (e.g., none) there's nothing to train on,
+        # so they stay uncompressed and are searched exactly.
+        if sum(len(v) for v in self._pending) < self.quantizer.n_centroids:
+            return
+
+        pending = np.concatenate(self._pending)
+        self.quantizer.train(pending)
+        self._pending = []
+        self._append_codes(self.quantizer.encode(pending))
+
+    def search(self, queries: np.ndarray, k: int) -> List[List[Tuple[float, JSONType]]]:
+        # -> for each query, up to k (score, id) pairs, best first
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.quantizer.dim)
+        results = []
+        for query in queries:
+            parts = []
+            if self._size:
+                parts.append(self.quantizer.score(query, self.codes))
+            if self._pending:  # exact scores for not-yet-compressed vectors
+                parts.append(np.concatenate(self._pending) @ query)
+            if not parts:
+                results.append([])
+                continue
+
+            scores = np.concatenate(parts)
+            positions = np.arange(len(scores))
+            if len(scores) > k:
+                positions = np.argpartition(-scores, k - 1)[:k]
+            order = positions[np.argsort(-scores[positions], kind="stable")]
+            results.append([(float(scores[i]), self._ids[i]) for i in order])
+        return results
+
+    def merge(self, other: "PQIndex") -> None:
+        # Codes are reused as-is if both indexes share codebooks; otherwise other's
+        # vectors are reconstructed from its codes and re-encoded (lossy)
+        assert other.quantizer.dim == self.quantizer.dim
+        n_coded = other._size
+        if n_coded and self._same_quantizer(other.quantizer):
+            self._ids.extend(other._ids[:n_coded])
+            self._append_codes(other.codes)
+        elif n_coded:
+            self.add(other.quantizer.decode(other.codes), other._ids[:n_coded])
+        if other._pending:
+            self.add(np.concatenate(other._pending), other._ids[n_coded:])
+
+    def save(self, path: Union[str, BinaryIO]) -> None:
+        # Saves the index as it is, so untrained indexes stay untrained. np.savez
+        # would append ".npz" to a path without it, so open it ourselves.
+        if isinstance(path, str):
+            with open(path, "wb") as f:
+                self.save(f)
+            return
+
+        state = {f"quantizer_{k}": v for k, v in self.quantizer.state().items()}
+        pending = (
+            np.concatenate(self._pending)
+            if self._pending
+            else np.empty((0, self.quantizer.dim), dtype=np.float32)
+        )
+        np.savez(
+            path,
+            **state,
+            train_size=np.array(self.train_size),
+            codes=self.codes,
+            pending=pending,
+            ids=np.frombuffer(json.dumps(self._ids).encode("utf-8"), dtype=np.uint8),
+        )
+
+    @classmethod
+    def load(cls, path: Union[str, BinaryIO]) -> "PQIndex":
+        with np.load(path) as data:
+            state = {
+                k[len("quantizer_") :]: data[k]
+                for k in data.files
+                if k.startswith("quantizer_")
+            }
+            quantizer_cls = (
+                OptimizedProductQuantizer if "rotation" in state else ProductQuantizer
+            )
+            index = cls(
+                quantizer_cls.from_state(state), train_size=int(data["train_size"])
+            )
+            index._append_codes(data["codes"])
+            if len(data["pending"]):
+                index._pending = [np.array(data["pending"])]
+            index._ids = json.loads(data["ids"].tobytes().decode("utf-8"))
+        return index
+
+    # INTERNAL
+
+    def _same_quantizer(self, other: ProductQuantizer) -> bool:
+        if not (self.quantizer.is_trained and other.is_trained):
+            return False
+        state, other_state = self.quantizer.state(), other.state()
+        return state.keys() == other_state.keys() and all(
+            np.array_equal(state[k], other_state[k]) for k in state
+        )
+
+    def _append_codes(self, codes: np.ndarray) -> None:
+        new_size = self._size + len(codes)
+        if new_size > len(self._codes):  # amortized O(1) appends
+            buffer = np.empty(
+                (max(new_size, 2 * len(self._codes)), self._codes.shape[1]),
+                dtype=np.uint8,
+            )
+            buffer[: self._size] = self.codes
+            self._codes = buffer
+        self._codes[self._size : new_size] = codes
+        self._size = new_size
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # Index of the closest centroid (in L2) for each vector; ||v||^2 is the same for
+    # every centroid, so it's left out
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    return np.argmin(centroid_norms - 2 * vectors @ centroids.T, axis=1)
+
+
+def _kmeans(
+    vectors: np.ndarray, k: int, n_iter: int, rng: np.random.RandomState
+) -> np.ndarray:
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = _nearest(vectors, centroids)
+        counts = np.bincount(assignments, minlength=k)
+
+        # Sum each cluster's points: sort by cluster, then add up contiguous runs
+        order = np.argsort(assignments, kind="stable")
+        clusters, starts = np.unique(assignments[order], return_index=True)
+        sums = np.zeros_like(centroids)
+        sums[clusters] = np.add.reduceat(vectors[order], starts, axis=0)
+
+        # Reseed empty clusters with random points
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum(), replace=False)]
+        counts[empty] = 1
+        centroids = sums / counts[:, np.newaxis]
+    return centroids.astype(np.float32)
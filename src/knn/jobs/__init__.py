@@ -1 +1,7 @@
 from .jobs import MapReduceJob
+from .sharded import ShardedMapReduceJob
+from .concurrency import AdaptiveConcurrencyController
+from .chunking import AdaptiveChunkSizeController
+from .retries import RetryPolicy
+from .scheduler import JobScheduler
+from .shared_scan import SharedScanJob, SharedScanQuery, SharedScans
@@ -0,0 +1,274 @@
+import bisect
+import contextlib
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+from knn import wire
+from knn.datasets import Dataset
+from knn.utils import JSONType
+
+from . import defaults
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# On-disk progress of a MapReduceJob, so a job can pick up where it left off after
+# the coordinator dies. The log is a sequence of records, each
+#
+#   length (uint64 LE) | CRC-32 (uint32 LE) | wire frame
+#
+# where the frame holds the input positions finished since the previous record (as
+# [start, stop) ranges), the job's progress counts and a sequence number. Appending
+# is cheap, since only new ranges are written; the log is rewritten as a single
+# record every so often so it doesn't grow without bound. A torn record at the end
+# (e.g., from a crash mid-write) is ignored.
+#
+# The reducer's state, which may be large (e.g., a whole index), isn't logged but
+# kept in a file next to the log, in records of the same format: the full state,
+# then (for reducers that support it, see Reducer.track_changes) only what changed
+# since the previous record. A full state is written to a temporary file before the
+# log record is appended and moved into place after, so whichever of the two has a
+# record carrying the log's last sequence number matches it; changes are appended
+# to the reducer file before the log record, and ones past the log's last record
+# are ignored. A full state is due first, after every failed or resumed append, and
+# whenever the log is compacted, so the file of changes doesn't grow without bound
+# either.
+
+_RECORD_HEADER = struct.Struct("<QI")
+REDUCER_SUFFIX = ".reducer"
+
+
+class RangeSet:
+    # Set of non-negative integers stored as sorted, disjoint, non-adjacent
+    # [start, stop) ranges; cheap when members mostly arrive in contiguous runs
+
+    def __init__(self, ranges: Iterable[Tuple[int, int]] = ()) -> None:
+        self._starts: List[int] = []
+        self._stops: List[int] = []
+        for start, stop in ranges:
+            self.add(start, stop)
+
+    def add(self, start: int, stop: int) -> None:
+        if start >= stop:
+            return
+        # Ranges i, ..., j - 1 overlap or touch [start, stop), so merge them
+        i = bisect.bisect_left(self._stops, start)
+        j = bisect.bisect_right(self._starts, stop)
+        if i < j:
+            start = min(start, self._starts[i])
+            stop = max(stop, self._stops[j - 1])
+        self._starts[i:j] = [start]
+        self._stops[i:j] = [stop]
+
+    def add_all(self, positions: Iterable[int]) -> None:
+        # Adds each run of consecutive positions as one range
+        run_start = run_stop = None
+        for position in sorted(positions):
+            if position != run_stop:
+                if run_start is not None:
+                    self.add(run_start, run_stop)
+                run_start = position
+            run_stop = position + 1
+        if run_start is not None:
+            self.add(run_start, run_stop)
+
+    def __contains__(self, position: int) -> bool:
+        i = bisect.bisect_right(self._starts, position) - 1
+        return i >= 0 and position < self._stops[i]
+
+    def __len__(self) -> int:
+        return sum(stop - start for start, stop in zip(self._starts, self._stops))
+
+    def __bool__(self) -> bool:
+        return bool(self._starts)
+
+    @property
+    def ranges(self) -> List[List[int]]:
+        return [[start, stop] for start, stop in zip(self._starts, self._stops)]
+
+    def gaps(self, stop: int) -> Iterator[Tuple[int, int]]:
+        # Ranges of [0, stop) that aren't in the set
+        position = 0
+        for range_start, range_stop in zip(self._starts, self._stops):
+            if range_start >= stop:
+                break
+            if position < range_start:
+                yield position, range_start
+            position = max(position, range_stop)
+        if position < stop:
+            yield position, stop
+
+
+def enumerate_pending(
+    iterable: Iterable[JSONType], completed: RangeSet
+) -> Iterator[Tuple[int, JSONType]]:
+    # (position, input) for every input whose position isn't in `completed`. Datasets
+    # are only read where there are gaps; other iterables are read in full.
+    if not completed:
+        yield from enumerate(iterable)
+    elif isinstance(iterable, Dataset):
+        for start, stop in completed.gaps(len(iterable)):
+            yield from enumerate(iterable[start:stop], start)
+    else:
+        for position, input in enumerate(iterable):
+            if position not in completed:
+                yield position, input
+
+
+class CheckpointLog:
+    # Reads and appends to the log at `path`. append() does blocking file I/O and
+    # may be called from a worker thread.
+
+    def __init__(
+        self,
+        path: str,
+        compact_interval: int = defaults.CHECKPOINT_COMPACT_INTERVAL,
+    ) -> None:
+        self.path = path
+        self.reducer_path = path + REDUCER_SUFFIX
+        self.compact_interval = compact_interval
+        self.completed = RangeSet()  # union over all records
+
+        self._lock = threading.Lock()
+        self._n_records = 0
+        self._seq = 0  # of the last record
+        self._full_state_due = True
+
+    @property
+    def wants_full_state(self) -> bool:
+        # Whether the next append() must be given the reducer's full state rather
+        # than its changes
+        return self._full_state_due or self._n_records >= self.compact_interval
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        # -> the latest record, with "completed" replaced by the union of all ranges
+        # logged so far, "reducer" holding the matching full reducer state and
+        # "reducer_changes" the changes to apply on top of it, in order (or None if
+        # there's nothing to resume from). A torn record at the end is truncated
+        # away so appends can continue after it.
+        with self._lock:
+            self.completed = RangeSet()
+            self._n_records = 0
+            self._seq = 0
+            self._full_state_due = True
+            if not os.path.exists(self.path):
+                return None
+
+            with open(self.path, "rb") as f:
+                data = f.read()
+            last_record = None
+            position = 0
+            for last_record, position in _read_records(data):
+                for range_start, range_stop in last_record["completed"]:
+                    self.completed.add(range_start, range_stop)
+                self._n_records += 1
+
+            if position < len(data):
+                with open(self.path, "r+b") as f:
+                    f.truncate(position)
+
+            if last_record is None:
+                return None
+            self._seq = last_record["seq"]
+            reducer_state, reducer_changes = self._load_reducer_state(self._seq)
+        return {
+            **last_record,
+            "completed": self.completed,
+            "reducer": reducer_state,
+            "reducer_changes": reducer_changes,
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.completed = RangeSet()
+            self._n_records = 0
+            self._seq = 0
+            self._full_state_due = True
+            with open(self.path, "wb"):
+                pass
+            for path in (self.reducer_path, self.reducer_path + ".tmp"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+
+    def append(
+        self, record: Dict[str, Any], reducer_state: bytes, is_change: bool = False
+    ) -> None:
+        # `record` holds "completed": the ranges finished since the last append.
+        # reducer_state is the reducer's full serialize()d state, or if is_change
+        # (only allowed while not wants_full_state) its serialize_changes().
+        with self._lock:
+            assert not (is_change and self.wants_full_state)
+            seq = self._seq + 1
+            record = {**record, "seq": seq}
+            state = np.frombuffer(reducer_state, dtype=np.uint8)
+            temp_path = self.reducer_path + ".tmp"
+            self._full_state_due = True  # until this append has succeeded
+            if is_change:
+                with open(self.reducer_path, "ab") as f:
+                    self._write(f, {"seq": seq, "changes": state})
+            else:
+                with open(temp_path, "wb") as f:
+                    self._write(f, {"seq": seq, "state": state})
+
+            for start, stop in record["completed"]:
+                self.completed.add(start, stop)
+            if self._n_records >= self.compact_interval:
+                log_temp_path = f"{self.path}.{os.getpid()}.tmp"
+                with open(log_temp_path, "wb") as f:
+                    self._write(f, {**record, "completed": self.completed.ranges})
+                os.replace(log_temp_path, self.path)
+                self._n_records = 1
+            else:
+                with open(self.path, "ab") as f:
+                    self._write(f, record)
+                self._n_records += 1
+            self._seq = seq
+
+            if not is_change:
+                os.replace(temp_path, self.reducer_path)
+            self._full_state_due = False
+
+    # INTERNAL
+
+    def _load_reducer_state(self, seq: int) -> Tuple[bytes, List[bytes]]:
+        # -> the last full state up to record seq, and the changes after it
+        for path in (self.reducer_path, self.reducer_path + ".tmp"):
+            with contextlib.suppress(OSError, ValueError, KeyError, struct.error):
+                with open(path, "rb") as f:
+                    data = f.read()
+                state: Optional[bytes] = None
+                changes: List[bytes] = []
+                for saved, _ in _read_records(data):
+                    if saved["seq"] > seq:
+                        break
+                    if "state" in saved:
+                        state, changes = saved["state"].tobytes(), []
+                    else:
+                        changes.append(saved["changes"].tobytes())
+                    if saved["seq"] == seq and state is not None:
+                        return state, changes
+        raise ValueError(f"no reducer state matches {self.path}, record {seq}")
+
+    @staticmethod
+    def _write(f, record: Dict[str, Any]) -> None:
+        frame = wire.dumps(record)
+        f.write(_RECORD_HEADER.pack(len(frame), zlib.crc32(frame)))
+        f.write(frame)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_records(data: bytes) -> Iterator[Tuple[Dict[str, Any], int]]:
+    # -> each intact record, and the position just past it; stops at a torn one
+    position = 0
+    while position + _RECORD_HEADER.size <= len(data):
+        length, crc = _RECORD_HEADER.unpack_from(data, position)
+        start = position + _RECORD_HEADER.size
+        frame = data[start : start + length]
+        if len(frame) < length or zlib.crc32(frame) != crc:
+            break
+        position = start + length
+        yield wire.loads(frame), position
@@ -0,0 +1,73 @@
+from typing import Optional
+
+from . import defaults
+
+
+class AdaptiveChunkSizeController:
+    # Resizes chunks so that each mapper request takes roughly
+    # `target_request_time` seconds. Elements within a chunk are processed
+    # concurrently, so we model a request as a fixed cost (mostly overlapped I/O)
+    # plus a per-element compute cost, and estimate both from the request_time and
+    # compute_time profiling the mappers return.
+
+    def __init__(
+        self,
+        target_request_time: float,
+        initial_chunk_size: int = defaults.CHUNK_SIZE,
+        min_chunk_size: int = 1,
+        max_chunk_size: int = defaults.MAX_CHUNK_SIZE,
+        *,
+        smoothing: float = 0.2,
+        max_growth: float = 2.0,
+    ) -> None:
+        assert target_request_time > 0.0
+        assert 1 <= min_chunk_size <= initial_chunk_size <= max_chunk_size
+
+        self.target_request_time = target_request_time
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.smoothing = smoothing
+        self.max_growth = max_growth
+
+        self._chunk_size = initial_chunk_size
+
+        # Exponentially weighted moving averages
+        self._fixed_time: Optional[float] = None
+        self._per_element_time: Optional[float] = None
+
+    @property
+    def chunk_size(self) -> int:
+        return self._chunk_size
+
+    def record(
+        self, n_inputs: int, request_time: float, compute_time: Optional[float]
+    ) -> None:
+        if n_inputs <= 0:
+            return
+
+        if compute_time is None:  # mapper doesn't separate compute from I/O
+            fixed_time = 0.0
+            per_element_time = request_time / n_inputs
+        else:
+            fixed_time = max(request_time - compute_time, 0.0)
+            per_element_time = compute_time / n_inputs
+
+        if self._fixed_time is None or self._per_element_time is None:
+            self._fixed_time = fixed_time
+            self._per_element_time = per_element_time
+        else:
+            a = self.smoothing
+            self._fixed_time += a * (fixed_time - self._fixed_time)
+            self._per_element_time += a * (per_element_time - self._per_element_time)
+
+        budget = self.target_request_time - self._fixed_time
+        if self._per_element_time > 0.0:
+            chunk_size = int(max(budget, 0.0) / self._per_element_time)
+        else:
+            chunk_size = self.max_chunk_size
+
+        # Don't overshoot on a few fast responses
+        chunk_size = min(chunk_size, int(self._chunk_size * self.max_growth))
+        self._chunk_size = min(
+            max(chunk_size, self.min_chunk_size), self.max_chunk_size
+        )
@@ -0,0 +1,92 @@
+from . import defaults
+
+
+class AdaptiveConcurrencyController:
+    # AIMD controller for the number of in-flight mapper requests. The window
+    # grows additively while latencies stay near the best observed baseline and
+    # shrinks multiplicatively when latency inflates or requests start failing.
+    # Growth is paused while many responses come from freshly booted containers,
+    # so we don't outrun the autoscaler.
+
+    def __init__(
+        self,
+        initial_window: int = defaults.INITIAL_WINDOW,
+        min_window: int = 1,
+        max_window: int = defaults.N_MAPPERS,
+        *,
+        additive_increase: float = 1.0,
+        multiplicative_decrease: float = 0.5,
+        latency_tolerance: float = 2.0,
+        max_failure_rate: float = 0.05,
+        max_cold_start_rate: float = 0.25,
+        smoothing: float = 0.1,
+    ) -> None:
+        assert 1 <= min_window <= initial_window <= max_window
+        assert 0.0 < multiplicative_decrease < 1.0
+
+        self.min_window = min_window
+        self.max_window = max_window
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.latency_tolerance = latency_tolerance
+        self.max_failure_rate = max_failure_rate
+        self.max_cold_start_rate = max_cold_start_rate
+        self.smoothing = smoothing
+
+        self._window = float(initial_window)
+        self._slow_start = True  # grow by one per response until first congestion
+
+        # Exponentially weighted moving averages
+        self._latency = 0.0
+        self._baseline_latency = 0.0
+        self._failure_rate = 0.0
+        self._cold_start_rate = 0.0
+
+        self._n_since_decrease = 0
+
+    @property
+    def window(self) -> int:
+        return int(self._window)
+
+    def record(
+        self, total_time: float, boot_time: float, n_failed: int, n_inputs: int
+    ) -> None:
+        # boot_time should only be non-zero for the first response from a container
+        a = self.smoothing
+        failure_rate = n_failed / n_inputs if n_inputs else 0.0
+        is_cold_start = boot_time > 0.0
+
+        self._failure_rate += a * (failure_rate - self._failure_rate)
+        self._cold_start_rate += a * (is_cold_start - self._cold_start_rate)
+        self._n_since_decrease += 1
+
+        if failure_rate < 1.0:  # got a real response, so latency is meaningful
+            latency = max(total_time - boot_time, 0.0)
+            if not self._baseline_latency or latency < self._baseline_latency:
+                self._baseline_latency = latency
+            else:  # let the baseline drift up slowly in case the mapper got slower
+                self._baseline_latency += a / 10 * (latency - self._baseline_latency)
+            if not self._latency:
+                self._latency = latency
+            else:
+                self._latency += a * (latency - self._latency)
+
+        is_congested = (
+            self._failure_rate > self.max_failure_rate
+            or self._latency > self.latency_tolerance * self._baseline_latency
+        )
+
+        if is_congested:
+            # Back off at most once per window's worth of responses
+            if self._n_since_decrease >= self._window:
+                self._window *= self.multiplicative_decrease
+                self._slow_start = False
+                self._n_since_decrease = 0
+        elif self._cold_start_rate > self.max_cold_start_rate:
+            pass  # hold steady until the new containers are warm
+        elif self._slow_start:
+            self._window += self.additive_increase
+        else:
+            self._window += self.additive_increase / self._window
+
+        self._window = min(max(self._window, self.min_window), self.max_window)
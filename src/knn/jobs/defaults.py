@@ -2,3 +2,34 @@ N_MAPPERS = 500
 N_RETRIES = 3
 CHUNK_SIZE = 3
 DESIRED_ULIMIT = 8192
+
+# Adaptive concurrency
+INITIAL_WINDOW = 50
+
+# Adaptive chunk sizing
+MAX_CHUNK_SIZE = 64
+
+# Hedged requests
+HEDGE_HISTORY = 1000  # number of recent latencies to take percentiles over
+HEDGE_MIN_SAMPLES = 20
+HEDGE_UPDATE_INTERVAL = 20
+
+# Retries
+N_ELEMENT_RETRIES = 2  # total attempts for elements a mapper returned no output for
+RETRY_BASE_DELAY = 0.1  # seconds
+RETRY_MAX_DELAY = 10.0  # seconds
+RETRY_BUDGET = 0.2  # retried elements as a fraction of elements sent
+RETRY_MIN_BUDGET = 10
+
+# Sharded jobs
+SHARD_SNAPSHOT_INTERVAL = 1.0  # seconds between progress reports from each shard
+
+# Shared scheduling
+SCHEDULER_THROUGHPUT_WINDOW = 10.0  # seconds over which per-job throughput is measured
+
+# Checkpointing
+CHECKPOINT_INTERVAL = 10.0  # seconds between checkpoints
+CHECKPOINT_COMPACT_INTERVAL = 100  # records appended before the log is rewritten
+
+# Result snapshots
+SNAPSHOT_MAX_REMOVALS = 10000  # removed result items remembered for deltas
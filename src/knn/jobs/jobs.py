@@ -1,17 +1,25 @@
 import asyncio
 import collections
+import contextlib
 import resource
 import time
 import uuid
 
 import aiohttp
+import numpy as np
 from runstats import Statistics
 
-from knn import utils
+from knn import utils, wire
 from knn.utils import JSONType
 from knn.reducers import Reducer
 
 from . import defaults
+from .checkpoint import CheckpointLog, RangeSet, enumerate_pending
+from .concurrency import AdaptiveConcurrencyController
+from .chunking import AdaptiveChunkSizeController
+from .retries import RetryPolicy, parse_retry_after
+from .scheduler import JobScheduler
+from .snapshots import ResultHistory
 
 from typing import (
     Optional,
@@ -19,8 +27,13 @@ from typing import (
     Tuple,
     List,
     Dict,
+    Deque,
     Any,
     Iterable,
+    Iterator,
+    Awaitable,
+    AsyncIterator,
+    Set,
 )
 
 
@@ -30,6 +43,46 @@ new_soft = max(min(defaults.DESIRED_ULIMIT, hard), soft)
 resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
 
 
+class _RequestSource:
+    # Produces one request coroutine per chunk, preferring elements that were
+    # requeued for retry over fresh ones. Unlike a generator, it can produce more
+    # requests after raising StopIteration if elements were requeued since. Each
+    # element travels with its position in the iterable, and positions in
+    # `completed` (e.g., finished before a resume) are skipped.
+
+    def __init__(
+        self,
+        iterable: Iterable[JSONType],
+        chunk_size: Callable[[], int],
+        make_request: Callable[[List[JSONType], List[int], int], Awaitable[Any]],
+        completed: Optional[RangeSet] = None,
+    ) -> None:
+        self._chunks = utils.chunk(
+            enumerate_pending(iterable, completed or RangeSet()), chunk_size
+        )
+        self._chunk_size = chunk_size
+        self._make_request = make_request
+        self._requeued: Deque[Tuple[JSONType, int, int]] = collections.deque()
+
+    def requeue(self, input: JSONType, position: int, attempt: int) -> None:
+        self._requeued.append((input, position, attempt))
+
+    def __iter__(self) -> Iterator[Awaitable[Any]]:
+        return self
+
+    def __next__(self) -> Awaitable[Any]:
+        if self._requeued:
+            n = min(self._chunk_size(), len(self._requeued))
+            requeued = [self._requeued.popleft() for _ in range(n)]
+            chunk = [input for input, _, _ in requeued]
+            positions = [position for _, position, _ in requeued]
+            attempt = max(attempt for _, _, attempt in requeued)
+        else:
+            positions, chunk = map(list, zip(*next(self._chunks)))
+            attempt = 0
+        return self._make_request(chunk, positions, attempt)
+
+
 class MapReduceJob:
     def __init__(
         self,
@@ -40,16 +93,35 @@ class MapReduceJob:
         n_mappers: int = defaults.N_MAPPERS,
         n_retries: int = defaults.N_RETRIES,
         chunk_size: int = defaults.CHUNK_SIZE,
+        concurrency_controller: Optional[AdaptiveConcurrencyController] = None,
+        chunk_size_controller: Optional[AdaptiveChunkSizeController] = None,
+        hedge_percentile: Optional[float] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        binary_wire_format: bool = True,
+        checkpoint_path: Optional[str] = None,
+        checkpoint_interval: float = defaults.CHECKPOINT_INTERVAL,
+        scheduler: Optional[JobScheduler] = None,
+        weight: float = 1.0,
     ) -> None:
         assert n_mappers < new_soft
+        assert hedge_percentile is None or 0.0 < hedge_percentile < 100.0
 
         self.job_id = str(uuid.uuid4())
 
         self.n_mappers = n_mappers
         self.n_retries = n_retries
         self.chunk_size = chunk_size
+        self.concurrency_controller = concurrency_controller
+        self.chunk_size_controller = chunk_size_controller
+        self.hedge_percentile = hedge_percentile
+        self.retry_policy = retry_policy or RetryPolicy(max_attempts=n_retries)
+        self.binary_wire_format = binary_wire_format
         self.mapper_url = mapper_url
         self.mapper_args = mapper_args
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.scheduler = scheduler  # shares in-flight slots with its other jobs
+        self.weight = weight  # relative share of the scheduler's slots
 
         self.reducer = reducer
 
@@ -59,11 +131,37 @@ class MapReduceJob:
         self._n_failed = 0
         self._n_chunks_per_mapper: Dict[str, int] = collections.defaultdict(int)
         self._profiling: Dict[str, Statistics] = collections.defaultdict(Statistics)
+        self._window_history: List[Tuple[float, int]] = []
+        self._chunk_size_history: List[Tuple[float, int]] = []
+        self._n_hedges_issued = 0
+        self._n_hedges_won = 0
+
+        # Recent request latencies, used to decide when to hedge
+        self._latencies: Deque[float] = collections.deque(maxlen=defaults.HEDGE_HISTORY)
+        self._n_latencies_since_update = 0
+        self._hedge_delay: Optional[float] = None
 
         # Will be initialized later
         self._n_total: Optional[int] = None
         self._start_time: Optional[float] = None
         self._task: Optional[asyncio.Task] = None
+        self._request_source: Optional[_RequestSource] = None
+        self._mapper_accepts_frames = False  # until it answers with one
+
+        # Checkpointing: positions finished since the last checkpoint was written
+        self._checkpoint = CheckpointLog(checkpoint_path) if checkpoint_path else None
+        self._unlogged = RangeSet()
+        self._resumed_from: Optional[RangeSet] = None
+        self._last_checkpoint_time = 0.0
+        self._checkpoint_write: Optional[Tuple[asyncio.Task, Dict[str, Any]]] = None
+        self._reducer_tracks_changes = False  # since the last full checkpoint
+
+        # Streaming and snapshots: the version counts handled chunk results
+        self._version = 0
+        self._result_history = ResultHistory()
+        self._performance_cache: Optional[Tuple[int, Dict[str, Any]]] = None
+        self._result_streams: Set[asyncio.Queue] = set()
+        self._running = False
 
     # REQUEST LIFECYCLE
 
@@ -81,27 +179,75 @@ class MapReduceJob:
                 if callback is not None:
                     callback(result)
 
-        self.task = asyncio.create_task(task())
+        self._task = asyncio.create_task(task())
 
     async def run_until_complete(self, iterable: Iterable[JSONType]) -> Dict[str, Any]:
         assert self._start_time is None  # can't reuse Job instances
-        self.start_time = time.time()
+        if self._checkpoint is not None:
+            self._checkpoint.reset()
+        return await self._run(iterable)
+
+    async def resume(self, iterable: Iterable[JSONType]) -> Dict[str, Any]:
+        # Like run_until_complete, but continues from the checkpoint at
+        # checkpoint_path if there is one: the job ID, progress counts and reducer
+        # state are restored, and inputs that were already finished are skipped.
+        # `iterable` must produce the same inputs in the same order as before. A
+        # job whose run crashed or was stopped can be resumed on the same instance.
+        assert self._checkpoint is not None
+        assert self._task is None or self._task.done()
+        checkpoint = self._checkpoint.load()
+        if checkpoint is None:
+            return await self.run_until_complete(iterable)
+
+        self.job_id = checkpoint["job_id"]
+        self._n_successful = checkpoint["n_successful"]
+        self._n_failed = checkpoint["n_failed"]
+        self.reducer.deserialize(checkpoint["reducer"])
+        for changes in checkpoint["reducer_changes"]:
+            self.reducer.deserialize_changes(changes)
+        self._resumed_from = RangeSet(checkpoint["completed"].ranges)
+        self._unlogged = RangeSet()
+        self._start_time = None
+        return await self._run(iterable)
+
+    async def _run(self, iterable: Iterable[JSONType]) -> Dict[str, Any]:
+        self._start_time = time.time()
+        self._running = True
+        if self.scheduler is not None:
+            self.scheduler.register(self.job_id, self.weight, self._scheduler_stats)
+        self._record_window()
+        self._record_chunk_size()
 
         try:
             self._n_total = len(iterable)
         except Exception:
             pass
 
-        connector = aiohttp.TCPConnector(limit=0)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            for response_tuple in utils.limited_as_completed(
-                (
-                    self._request(session, chunk)
-                    for chunk in utils.chunk(iterable, self.chunk_size)
-                ),
-                self.n_mappers,
-            ):
-                self._handle_chunk_result(*(await response_tuple))
+        self._last_checkpoint_time = time.time()
+        try:
+            async with self._session() as session:
+                self._request_source = _RequestSource(
+                    iterable,
+                    self._chunk_size,
+                    lambda chunk, positions, attempt: self._process_chunk(
+                        session, chunk, positions, attempt
+                    ),
+                    self._resumed_from,
+                )
+                async for response_tuple in utils.limited_as_completed(
+                    self._request_source, self._window
+                ):
+                    self._handle_chunk_result(*response_tuple)
+                    if self._checkpoint_due():
+                        await self._write_checkpoint(wait=False)
+        finally:
+            if self.scheduler is not None:
+                self.scheduler.unregister(self.job_id)
+            self._running = False
+            for stream in self._result_streams:
+                stream.put_nowait(None)
+            if self._checkpoint is not None:
+                await self._write_checkpoint(wait=True)
 
         if self._n_total is None:
             self._n_total = self._n_successful + self._n_failed
@@ -111,9 +257,9 @@ class MapReduceJob:
         return self.result
 
     async def stop(self) -> None:
-        if self.task is not None and not self.task.done():
-            self.task.cancel()
-            await self.task
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await self._task
 
     # RESULT GETTERS
 
@@ -123,29 +269,48 @@ class MapReduceJob:
 
     @property
     def job_result(self) -> Dict[str, Any]:
-        elapsed_time = (time.time() - self.start_time) if self.start_time else 0.0
-
-        performance = {
-            "profiling": {k: v.mean() for k, v in self._profiling.items()},
-            "mapper_utilization": dict(enumerate(self._n_chunks_per_mapper.values())),
+        return {
+            "performance": self._cached_performance(),
+            "progress": self._progress,
+            "result": self.result,
         }
 
-        progress = {
-            "cost": self.cost,
-            "finished": self.finished,
-            "n_processed": self._n_successful,
-            "n_skipped": self._n_failed,
-            "elapsed_time": elapsed_time,
-        }
-        if self._n_total is not None:
-            progress["n_total"] = self._n_total
-
+    def snapshot(self, since_version: Optional[int] = None) -> Dict[str, Any]:
+        # Like job_result, but the result is only what changed since the snapshot
+        # with version `since_version` (see ResultHistory for the format), or all of
+        # it if that's None. Pass the returned "version" next time.
+        if self._result_history.version < self._version:
+            self._result_history.update(self._version, self.result)
         return {
-            "performance": performance,
-            "progress": progress,
-            "result": self.result,
+            "version": self._version,
+            "performance": self._cached_performance(),
+            "progress": self._progress,
+            "result": self._result_history.since(since_version),
         }
 
+    def stream_results(self) -> AsyncIterator[Tuple[List[JSONType], List[JSONType]]]:
+        # Async iterator of (inputs, outputs) for the successful elements of every
+        # chunk handled from now until the job finishes or is stopped (so it may be
+        # created before the job starts). Chunks are buffered until they're
+        # consumed, so a slow consumer costs memory but never holds up the job.
+        stream: asyncio.Queue = asyncio.Queue()
+        if self._start_time is not None and not self._running:  # already over
+            stream.put_nowait(None)
+        else:
+            self._result_streams.add(stream)
+
+        async def iterator():
+            try:
+                while True:
+                    chunk = await stream.get()
+                    if chunk is None:
+                        return
+                    yield chunk
+            finally:
+                self._result_streams.discard(stream)
+
+        return iterator()
+
     @property
     def finished(self) -> bool:
         return self._n_total == self._n_successful + self._n_failed
@@ -155,67 +320,442 @@ class MapReduceJob:
         total_billed_time = self._profiling["billed_time"].mean() * len(
             self._profiling["billed_time"]
         )
+        n_requests = (
+            self._n_requests
+            + self._n_hedges_issued
+            + self.retry_policy.n_request_retries
+        )
         return (
             0.00002400 * total_billed_time
             + 2 * 0.00000250 * total_billed_time
-            + 0.40 / 1000000 * self._n_requests
+            + 0.40 / 1000000 * n_requests
         )
 
     # INTERNAL
 
-    def _construct_request(self, chunk: List[JSONType]) -> JSONType:
+    @property
+    def _performance(self) -> Dict[str, Any]:
+        performance = {
+            "profiling": {k: v.mean() for k, v in self._profiling.items()},
+            "mapper_utilization": dict(enumerate(self._n_chunks_per_mapper.values())),
+            "window_size": self._window_history,
+            "chunk_size": self._chunk_size_history,
+            "hedging": {
+                "n_issued": self._n_hedges_issued,
+                "n_won": self._n_hedges_won,
+            },
+            "retries": {
+                "n_request_retries": self.retry_policy.n_request_retries,
+                "n_element_retries": self.retry_policy.n_element_retries,
+            },
+        }
+        if self.scheduler is not None and self._running:
+            performance["scheduler"] = self.scheduler.job_stats(self.job_id)
+        return performance
+
+    def _scheduler_stats(self, stats: Dict[str, Any]) -> Dict[str, Any]:
+        # Hook for more entries in this job's scheduler stats
+        return {}
+
+    @property
+    def _progress(self) -> Dict[str, Any]:
+        progress = {
+            "cost": self.cost,
+            "finished": self.finished,
+            "n_processed": self._n_successful,
+            "n_skipped": self._n_failed,
+            "elapsed_time": self._elapsed_time,
+        }
+        if self._n_total is not None:
+            progress["n_total"] = self._n_total
+        return progress
+
+    def _shard_snapshot(self, include_reducer: bool = True) -> Dict[str, Any]:
+        # Everything a parent ShardedMapReduceJob needs to merge this job's state
+        snapshot = {
+            "performance": self._performance,
+            "progress": self._progress,
+            "profiling": {k: v.get_state() for k, v in self._profiling.items()},
+            "n_chunks_per_mapper": dict(self._n_chunks_per_mapper),
+        }
+        if include_reducer:
+            snapshot["reducer"] = self.reducer.serialize()
+        return snapshot
+
+    def _cached_performance(self) -> Dict[str, Any]:
+        # Recomputed only once new results have come in
+        if (
+            self._performance_cache is None
+            or self._performance_cache[0] < self._version
+        ):
+            self._performance_cache = (self._version, self._performance)
+        return self._performance_cache[1]
+
+    @property
+    def _elapsed_time(self) -> float:
+        return (time.time() - self._start_time) if self._start_time else 0.0
+
+    @contextlib.asynccontextmanager
+    async def _session(self) -> AsyncIterator[aiohttp.ClientSession]:
+        if self.scheduler is not None:
+            yield self.scheduler.session  # shared, so left open
+            return
+
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            yield session
+
+    @contextlib.asynccontextmanager
+    async def _request_slot(self, n_inputs: int) -> AsyncIterator[None]:
+        if self.scheduler is None:
+            yield
+            return
+
+        async with self.scheduler.slot(self.job_id, n_inputs):
+            yield
+
+    def _window(self) -> int:
+        if self.concurrency_controller is None:
+            return self.n_mappers
+        return min(self.concurrency_controller.window, self.n_mappers)
+
+    def _record_window(self) -> None:
+        window = self._window()
+        if not self._window_history or self._window_history[-1][1] != window:
+            self._window_history.append((self._elapsed_time, window))
+
+    def _chunk_size(self) -> int:
+        if self.chunk_size_controller is None:
+            return self.chunk_size
+        return self.chunk_size_controller.chunk_size
+
+    def _record_chunk_size(self) -> None:
+        chunk_size = self._chunk_size()
+        if (
+            not self._chunk_size_history
+            or self._chunk_size_history[-1][1] != chunk_size
+        ):
+            self._chunk_size_history.append((self._elapsed_time, chunk_size))
+
+    def _construct_request(
+        self, chunk: List[JSONType], positions: List[int]
+    ) -> JSONType:
         return {
             "job_id": self.job_id,
             "job_args": self.mapper_args,
             "inputs": chunk,
         }
 
+    def _encode_request(self, request: JSONType) -> Dict[str, Any]:
+        # Start out with JSON and switch to binary frames once the mapper has shown
+        # it understands them by responding with one
+        if not self.binary_wire_format:
+            return {"json": wire.to_jsonable(request)}
+        elif not self._mapper_accepts_frames:
+            return {
+                "json": wire.to_jsonable(request),
+                "headers": {"Accept": wire.ACCEPT},
+            }
+        return {
+            "data": wire.dumps(request),
+            "headers": {"Content-Type": wire.CONTENT_TYPE, "Accept": wire.ACCEPT},
+        }
+
+    async def _decode_response(self, response: aiohttp.ClientResponse) -> JSONType:
+        if response.content_type == wire.CONTENT_TYPE:
+            self._mapper_accepts_frames = True
+            return wire.loads(await response.read())
+        return await response.json()
+
     async def _request(
-        self, session: aiohttp.ClientSession, chunk: List[JSONType]
+        self,
+        session: aiohttp.ClientSession,
+        chunk: List[JSONType],
+        request: JSONType,
+        is_hedge: bool = False,
     ) -> Tuple[JSONType, Optional[JSONType], float]:
+        # Hedges are never retried; the request they duplicate still is
         result = None
         start_time = 0.0
         end_time = 0.0
 
-        request = self._construct_request(chunk)
-
-        for i in range(self.n_retries):
-            start_time = time.time()
-            end_time = start_time
-
-            try:
-                async with session.post(self.mapper_url, json=request) as response:
-                    end_time = time.time()
-                    if response.status == 200:
-                        result = await response.json()
-                        break
-            except aiohttp.ClientConnectionError:
+        request = self._encode_request(request)
+
+        for i in range(self.retry_policy.max_attempts):
+            status = None  # type: Optional[int]
+            retry_after = None  # type: Optional[float]
+
+            async with self._request_slot(len(chunk)):
+                start_time = time.time()  # not counting time spent waiting for a slot
+                end_time = start_time
+                try:
+                    async with session.post(self.mapper_url, **request) as response:
+                        end_time = time.time()
+                        status = response.status
+                        if response.status == 200:
+                            result = await self._decode_response(response)
+                            break
+                        retry_after = parse_retry_after(
+                            response.headers.get("Retry-After")
+                        )
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    status = None
+                    result = None
+
+            if is_hedge or not self.retry_policy.should_retry_request(
+                i, len(chunk), status
+            ):
                 break
+            await asyncio.sleep(self.retry_policy.backoff(i, retry_after))
 
         return chunk, result, end_time - start_time
 
+    async def _process_chunk(
+        self,
+        session: aiohttp.ClientSession,
+        chunk: List[JSONType],
+        positions: List[int],
+        attempt: int,
+    ) -> Tuple[JSONType, Optional[JSONType], float, int, List[int]]:
+        if attempt == 0:
+            self.retry_policy.record_sent(len(chunk))
+        else:  # resubmitted elements, so back off first
+            await asyncio.sleep(self.retry_policy.backoff(attempt))
+        request = self._construct_request(chunk, positions)  # shared with any hedge
+        chunk, result, elapsed_time = await self._hedged_request(
+            session, chunk, request
+        )
+        return chunk, result, elapsed_time, attempt, positions
+
+    async def _hedged_request(
+        self, session: aiohttp.ClientSession, chunk: List[JSONType], request: JSONType
+    ) -> Tuple[JSONType, Optional[JSONType], float]:
+        # If the request outlives the configured latency percentile, race a
+        # duplicate against it and keep whichever successful response arrives first.
+        # Note that hedges run on top of the usual in-flight window.
+        primary = asyncio.create_task(self._request(session, chunk, request))
+        if self._hedge_delay is None:
+            return await primary
+
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self._hedge_delay)
+            if done:
+                return primary.result()
+
+            hedge = asyncio.create_task(
+                self._request(session, chunk, request, is_hedge=True)
+            )
+            tasks.append(hedge)
+            self._n_hedges_issued += 1
+
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+            winner = primary if primary in done else hedge
+            if winner.result()[1] is None and pending:  # failed, so wait for other
+                await asyncio.wait(pending)
+                winner = pending.pop()
+            if winner is hedge:
+                self._n_hedges_won += 1
+            return winner.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
     def _handle_chunk_result(
-        self, chunk: List[JSONType], result: Optional[JSONType], elapsed_time: float
+        self,
+        chunk: List[JSONType],
+        result: Optional[JSONType],
+        elapsed_time: float,
+        attempt: int,
+        positions: List[int],
     ):
         self._n_requests += 1
+        self._version += 1
 
         if not result:
-            self._n_failed += len(chunk)
+            self._handle_failed_elements(chunk, positions, attempt)
+            self._update_window(elapsed_time, 0.0, len(chunk), len(chunk))
             return
 
         # Validate
         assert len(result["outputs"]) == len(chunk)
         assert "billed_time" in result["profiling"]
 
-        n_successful = sum(1 for r in result["outputs"] if r)
+        is_successful = [self._is_successful(output) for output in result["outputs"]]
+        n_successful = sum(is_successful)
         self._n_successful += n_successful
-        self._n_failed += len(chunk) - n_successful
+        self._handle_failed_elements(
+            [input for input, ok in zip(chunk, is_successful) if not ok],
+            [position for position, ok in zip(positions, is_successful) if not ok],
+            attempt,
+        )
+
+        # Only the first response from a container reflects its boot
+        is_new_worker = result["worker_id"] not in self._n_chunks_per_mapper
+        boot_time = result["profiling"].get("boot_time", 0.0) if is_new_worker else 0.0
+        self._update_window(
+            elapsed_time, boot_time, len(chunk) - n_successful, len(chunk)
+        )
+        self._update_chunk_size(len(chunk), elapsed_time, result["profiling"])
         self._n_chunks_per_mapper[result["worker_id"]] += 1
 
         self._profiling["total_time"].push(elapsed_time)
+        self._update_hedge_delay(elapsed_time)
         for k, v in result["profiling"].items():
             self._profiling[k].push(v)
 
-        for input, output in zip(chunk, result["outputs"]):
-            if output:
-                self.reducer.handle_result(input, output)
+        successful = [
+            (input, output, position)
+            for input, output, position in zip(chunk, result["outputs"], positions)
+            if self._is_successful(output)
+        ]
+        if successful:
+            inputs, outputs, successful_positions = map(list, zip(*successful))
+            self._handle_results(inputs, outputs, successful_positions)
+            self._unlogged.add_all(successful_positions)
+
+    def _handle_results(
+        self, inputs: List[JSONType], outputs: List[JSONType], positions: List[int]
+    ) -> None:
+        # The successful elements of a chunk
+        self.reducer.handle_results(inputs, outputs)
+        for stream in self._result_streams:
+            stream.put_nowait((inputs, outputs))
+
+    @staticmethod
+    def _is_successful(output: JSONType) -> bool:
+        # Mappers return None for elements they failed on; falsy outputs like a
+        # score of 0.0 or an empty list are valid results
+        return output is not None
+
+    def _handle_failed_elements(
+        self, inputs: List[JSONType], positions: List[int], attempt: int
+    ) -> None:
+        if not inputs:
+            return
+
+        if (
+            self._request_source is not None
+            and self.retry_policy.should_retry_elements(attempt, len(inputs))
+        ):
+            for input, position in zip(inputs, positions):
+                self._request_source.requeue(input, position, attempt + 1)
+        else:
+            self._handle_skipped(inputs, positions)
+
+    def _handle_skipped(self, inputs: List[JSONType], positions: List[int]) -> None:
+        # Elements we've given up on
+        self._n_failed += len(inputs)
+        self._unlogged.add_all(positions)
+
+    def _checkpoint_due(self) -> bool:
+        return (
+            self._checkpoint is not None
+            and time.time() - self._last_checkpoint_time >= self.checkpoint_interval
+        )
+
+    def _checkpoint_record(self) -> Dict[str, Any]:
+        record = {
+            "job_id": self.job_id,
+            "completed": self._unlogged.ranges,
+            "n_successful": self._n_successful,
+            "n_failed": self._n_failed,
+        }
+        self._unlogged = RangeSet()
+        return record
+
+    async def _write_checkpoint(self, wait: bool) -> None:
+        # Called between chunk results, and no more are handled until the reducer
+        # has been serialized (on a worker thread), so the reducer state, counts and
+        # finished positions match. The files are then written in the background,
+        # and only waited for if `wait`; a checkpoint that comes due while the
+        # previous one is still being written is put off until it's done.
+        if self._checkpoint_write is not None:
+            if not (wait or self._checkpoint_write[0].done()):
+                return
+            await self._finish_checkpoint_write()
+
+        self._last_checkpoint_time = time.time()
+        record = self._checkpoint_record()
+        is_change = (
+            self._reducer_tracks_changes and not self._checkpoint.wants_full_state
+        )
+        serialized = asyncio.get_event_loop().create_future()
+        write = asyncio.ensure_future(
+            self._save_checkpoint(record, is_change, serialized)
+        )
+        self._checkpoint_write = (write, record)
+        await asyncio.shield(serialized)
+        if wait:
+            await self._finish_checkpoint_write()
+
+    async def _save_checkpoint(
+        self, record: Dict[str, Any], is_change: bool, serialized: asyncio.Future
+    ) -> None:
+        # Reducers that track their changes only save those, except in the full
+        # states the checkpoint log asks for every so often
+        loop = asyncio.get_event_loop()
+        try:
+            state = await loop.run_in_executor(None, self._serialize_reducer, is_change)
+        finally:
+            serialized.set_result(None)
+        await loop.run_in_executor(
+            None, self._checkpoint.append, record, state, is_change
+        )
+
+    def _serialize_reducer(self, is_change: bool) -> bytes:
+        # Runs on a worker thread
+        if is_change:
+            return self.reducer.serialize_changes()
+        state = self.reducer.serialize()
+        self._reducer_tracks_changes = self.reducer.track_changes()
+        return state
+
+    async def _finish_checkpoint_write(self) -> None:
+        # Shielded, so a cancelled job still knows the write is in flight and waits
+        # for it before writing its final checkpoint
+        write, record = self._checkpoint_write
+        try:
+            await asyncio.shield(write)
+        except OSError:  # keep the ranges for the next attempt
+            for start, stop in record["completed"]:
+                self._unlogged.add(start, stop)
+        self._checkpoint_write = None
+
+    def _update_window(
+        self, elapsed_time: float, boot_time: float, n_failed: int, n_inputs: int
+    ) -> None:
+        if self.concurrency_controller is None:
+            return
+        self.concurrency_controller.record(elapsed_time, boot_time, n_failed, n_inputs)
+        self._record_window()
+
+    def _update_chunk_size(
+        self, n_inputs: int, elapsed_time: float, profiling: Dict[str, float]
+    ) -> None:
+        if self.chunk_size_controller is None:
+            return
+        self.chunk_size_controller.record(
+            n_inputs,
+            profiling.get("request_time", elapsed_time),
+            profiling.get("compute_time"),
+        )
+        self._record_chunk_size()
+
+    def _update_hedge_delay(self, elapsed_time: float) -> None:
+        if self.hedge_percentile is None:
+            return
+        self._latencies.append(elapsed_time)
+        self._n_latencies_since_update += 1
+
+        # Recomputing the percentile is O(n), so only do it periodically
+        if (
+            len(self._latencies) >= defaults.HEDGE_MIN_SAMPLES
+            and self._n_latencies_since_update >= defaults.HEDGE_UPDATE_INTERVAL
+        ):
+            self._hedge_delay = float(
+                np.percentile(self._latencies, self.hedge_percentile)
+            )
+            self._n_latencies_since_update = 0
@@ -0,0 +1,95 @@
+import email.utils
+import random
+import time
+
+from typing import Optional
+
+from . import defaults
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(retry_time - time.time(), 0.0)
+
+
+class RetryPolicy:
+    # Decides when MapReduceJob retries a failed request, or resubmits the failed
+    # elements of an otherwise successful chunk in a later batch, and how long to
+    # wait first. Retries are capped by a budget proportional to the number of
+    # elements sent, so a struggling service doesn't get hit with a flood of
+    # retries on top of regular traffic. Subclass to customize.
+
+    RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        max_attempts: int = defaults.N_RETRIES,
+        max_element_attempts: int = defaults.N_ELEMENT_RETRIES,
+        *,
+        base_delay: float = defaults.RETRY_BASE_DELAY,
+        max_delay: float = defaults.RETRY_MAX_DELAY,
+        budget: float = defaults.RETRY_BUDGET,
+        min_budget: int = defaults.RETRY_MIN_BUDGET,
+    ) -> None:
+        assert max_attempts >= 1 and max_element_attempts >= 1
+
+        self.max_attempts = max_attempts
+        self.max_element_attempts = max_element_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.min_budget = min_budget
+
+        # Counted in elements so request and element retries share one budget
+        self.n_sent = 0
+        self.n_request_retries = 0
+        self.n_element_retries = 0
+        self._n_retried = 0
+
+    def record_sent(self, n_inputs: int) -> None:
+        self.n_sent += n_inputs
+
+    def should_retry_request(
+        self, attempt: int, n_inputs: int, status: Optional[int]
+    ) -> bool:
+        # status is None if we couldn't connect or the response was cut off
+        if attempt + 1 >= self.max_attempts:
+            return False
+        if status is not None and status not in self.RETRYABLE_STATUSES:
+            return False
+        if not self._consume_budget(n_inputs):
+            return False
+        self.n_request_retries += 1
+        return True
+
+    def should_retry_elements(self, attempt: int, n_inputs: int) -> bool:
+        if attempt + 1 >= self.max_element_attempts:
+            return False
+        if not self._consume_budget(n_inputs):
+            return False
+        self.n_element_retries += n_inputs
+        return True
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        # "Full jitter" exponential backoff, but never sooner than the server asked
+        # (up to max_delay)
+        delay = random.uniform(0.0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def _consume_budget(self, n_inputs: int) -> bool:
+        if self._n_retried + n_inputs > self.budget * self.n_sent + self.min_budget:
+            return False
+        self._n_retried += n_inputs
+        return True
@@ -0,0 +1,165 @@
+import asyncio
+import collections
+import contextlib
+import time
+
+import aiohttp
+
+from . import defaults
+
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional, Tuple
+
+
+class JobScheduler:
+    # Shares one budget of in-flight mapper requests, and one connection pool,
+    # between all the jobs given this scheduler (e.g., concurrent queries on a demo
+    # server). A request holds a slot only while it's on the wire. When a slot
+    # frees up, it goes to the waiting job with the fewest requests in flight per
+    # unit of weight, so active jobs converge to weighted fair shares of the budget
+    # and a job that needs less than its share leaves the rest to the others.
+    # Cancelled requests (e.g., from MapReduceJob.stop()) give their slots back
+    # right away. Jobs that serve several clients (e.g., a SharedScanJob's queries)
+    # can add a breakdown by client to their stats.
+
+    def __init__(
+        self,
+        max_in_flight: int = defaults.N_MAPPERS,
+        throughput_window: float = defaults.SCHEDULER_THROUGHPUT_WINDOW,
+    ) -> None:
+        assert max_in_flight >= 1
+        self.max_in_flight = max_in_flight
+        self.throughput_window = throughput_window
+
+        self._weights: Dict[str, float] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {}
+        self._completions: Dict[str, Deque[Tuple[float, int]]] = {}
+        self._n_completed: Dict[str, int] = {}
+        self._extra_stats: Dict[str, Callable[[Dict[str, Any]], Dict[str, Any]]] = {}
+        self._n_in_flight = 0
+        self._session: Optional[aiohttp.ClientSession] = None  # created on the loop
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # JOBS
+
+    def register(
+        self,
+        job_id: str,
+        weight: float = 1.0,
+        extra_stats: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+    ) -> None:
+        # extra_stats(stats), if given, returns more entries for the job's stats
+        assert job_id not in self._weights and weight > 0
+        self._weights[job_id] = weight
+        if extra_stats is not None:
+            self._extra_stats[job_id] = extra_stats
+        self._in_flight[job_id] = 0
+        self._waiters[job_id] = collections.deque()
+        self._completions[job_id] = collections.deque()
+        self._n_completed[job_id] = 0
+
+    def unregister(self, job_id: str) -> None:
+        for waiter in self._waiters.pop(job_id):
+            waiter.cancel()
+        self._n_in_flight -= self._in_flight.pop(job_id)
+        for d in (self._weights, self._completions, self._n_completed):
+            del d[job_id]
+        self._extra_stats.pop(job_id, None)
+        self._dispatch()
+
+    def set_weight(self, job_id: str, weight: float) -> None:
+        assert weight > 0
+        self._weights[job_id] = weight
+
+    @contextlib.asynccontextmanager
+    async def slot(self, job_id: str, n_inputs: int = 0) -> AsyncIterator[None]:
+        # Holds one of the in-flight slots for a request of n_inputs elements
+        await self._acquire(job_id)
+        try:
+            yield
+        finally:
+            self._release(job_id, n_inputs)
+
+    # STATS
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {job_id: self.job_stats(job_id) for job_id in self._weights}
+
+    def job_stats(self, job_id: str) -> Dict[str, Any]:
+        # throughput is in elements per second, over the last throughput_window
+        completions = self._completions[job_id]
+        self._expire(completions)
+        total_weight = sum(self._weights.values())
+        stats = {
+            "weight": self._weights[job_id],
+            "fair_share": self.max_in_flight * self._weights[job_id] / total_weight,
+            "in_flight": self._in_flight[job_id],
+            "waiting": len(self._waiters[job_id]),
+            "n_completed": self._n_completed[job_id],
+            "throughput": sum(n for _, n in completions) / self.throughput_window,
+        }
+        if job_id in self._extra_stats:
+            stats.update(self._extra_stats[job_id](stats))
+        return stats
+
+    # INTERNAL
+
+    async def _acquire(self, job_id: str) -> None:
+        if self._n_in_flight < self.max_in_flight and not any(self._waiters.values()):
+            self._grant(job_id)
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters[job_id].append(waiter)
+        try:
+            await waiter  # resolved by _dispatch(), which grants the slot
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():  # granted, but too late
+                self._release(job_id, 0)
+            else:  # may have been dropped by _dispatch() or unregister() already
+                with contextlib.suppress(KeyError, ValueError):
+                    self._waiters[job_id].remove(waiter)
+            raise
+
+    def _release(self, job_id: str, n_inputs: int) -> None:
+        if job_id in self._in_flight:  # else already unregistered
+            self._in_flight[job_id] -= 1
+            self._n_in_flight -= 1
+            self._n_completed[job_id] += n_inputs
+            self._completions[job_id].append((time.time(), n_inputs))
+            self._expire(self._completions[job_id])
+        self._dispatch()
+
+    def _grant(self, job_id: str) -> None:
+        self._in_flight[job_id] += 1
+        self._n_in_flight += 1
+
+    def _dispatch(self) -> None:
+        while self._n_in_flight < self.max_in_flight:
+            waiting = [job_id for job_id, w in self._waiters.items() if w]
+            if not waiting:
+                break
+            job_id = min(
+                waiting, key=lambda j: (self._in_flight[j] + 1) / self._weights[j]
+            )
+            waiter = self._waiters[job_id].popleft()
+            if waiter.cancelled():  # its request was cancelled while waiting
+                continue
+            self._grant(job_id)
+            waiter.set_result(None)
+
+    def _expire(self, completions: Deque[Tuple[float, int]]) -> None:
+        cutoff = time.time() - self.throughput_window
+        while completions and completions[0][0] < cutoff:
+            completions.popleft()
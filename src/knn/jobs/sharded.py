@@ -0,0 +1,313 @@
+import asyncio
+import collections
+import concurrent.futures
+import copy
+import multiprocessing
+import os
+import queue
+import time
+
+from runstats import Statistics
+
+from knn.datasets import Dataset
+from knn.utils import JSONType
+from knn.reducers import Reducer
+
+from . import defaults
+from .jobs import MapReduceJob
+
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+
+def _run_shard(
+    job: MapReduceJob,
+    inputs: Sequence[JSONType],
+    shard_index: int,
+    messages: multiprocessing.Queue,
+    snapshot_interval: float,
+    streaming,  # multiprocessing.Event
+    reducer_requested,  # multiprocessing.Event
+    resume: bool,
+) -> None:
+    # Entry point of each worker process. Messages are (shard index, kind, payload):
+    # "snapshot" and "final" carry a _shard_snapshot(), and "results" the (inputs,
+    # outputs) of a chunk, sent once the parent has a result stream open. Snapshots
+    # only include the serialized reducer if the parent asked for it since the last
+    # one (and the final one always does).
+    async def main():
+        async def report_progress():
+            while True:
+                await asyncio.sleep(snapshot_interval)
+                include_reducer = reducer_requested.is_set()
+                if include_reducer:
+                    reducer_requested.clear()
+                messages.put(
+                    (shard_index, "snapshot", job._shard_snapshot(include_reducer))
+                )
+
+        async def forward_results(stream):
+            async for chunk in stream:
+                if streaming.is_set():
+                    messages.put((shard_index, "results", chunk))
+
+        reporter = asyncio.create_task(report_progress())
+        forwarder = asyncio.create_task(forward_results(job.stream_results()))
+        try:
+            if resume:
+                await job.resume(inputs)
+            else:
+                await job.run_until_complete(inputs)
+            await forwarder  # so every chunk is sent before the final snapshot
+        finally:
+            reporter.cancel()
+            forwarder.cancel()
+        messages.put((shard_index, "final", job._shard_snapshot()))
+
+    asyncio.run(main())
+
+
+class ShardedMapReduceJob(MapReduceJob):
+    # Splits one job across `n_processes` worker processes, each running its own
+    # MapReduceJob (event loop, connection pool, slice of the in-flight window and
+    # partial reducer) over a slice of the inputs: a contiguous range of a Dataset
+    # (which workers read themselves), or else round-robin. Workers periodically
+    # send their progress back, and this process combines it. Reducers are only
+    # shipped and merged when needed: workers send their serialized reducer at the
+    # end, and before that only once the result has been read (result, job_result
+    # and snapshot() ask every worker for it, and report the latest merged view,
+    # which lags by up to one snapshot_interval). The reducer must support the
+    # merge/serialize/deserialize protocol.
+    #
+    # Workers are forked so the reducer and any controllers don't need to be
+    # picklable; each worker gets its own copy of them. Once stream_results() has
+    # been called, workers also send back the outputs of every chunk they handle
+    # (which must be picklable), so only pay for that if you use it.
+    #
+    # With a checkpoint_path, each worker checkpoints its own slice to
+    # "{checkpoint_path}.shard-{i}", and resume() resumes every worker from its own
+    # log (so n_processes must not change in between).
+
+    def __init__(
+        self,
+        mapper_url: str,
+        reducer: Reducer,
+        mapper_args: JSONType = {},
+        *,
+        n_processes: int = os.cpu_count() or 1,
+        snapshot_interval: float = defaults.SHARD_SNAPSHOT_INTERVAL,
+        **kwargs,
+    ) -> None:
+        super().__init__(mapper_url, reducer, mapper_args, **kwargs)
+        assert n_processes >= 1
+        assert self.scheduler is None, "shards run in other processes"
+
+        self.n_processes = n_processes
+        self.snapshot_interval = snapshot_interval
+        self._job_kwargs = kwargs
+
+        self._empty_reducer = copy.deepcopy(reducer)
+        context = multiprocessing.get_context("fork")
+        self._streaming = context.Event()
+        self._reducer_requested = [context.Event() for _ in range(n_processes)]
+        self._snapshots: Dict[int, Dict[str, Any]] = {}
+        self._reducer_states: Dict[int, bytes] = {}
+        self._finished_shards: Set[int] = set()
+        self._merged_reducer: Optional[Reducer] = None  # cached until next snapshot
+
+    # REQUEST LIFECYCLE
+
+    async def run_until_complete(self, iterable: Iterable[JSONType]) -> Dict[str, Any]:
+        return await self._run_shards(iterable, resume=False)
+
+    async def resume(self, iterable: Iterable[JSONType]) -> Dict[str, Any]:
+        assert self.checkpoint_path is not None
+        return await self._run_shards(iterable, resume=True)
+
+    async def _run_shards(
+        self, iterable: Iterable[JSONType], resume: bool
+    ) -> Dict[str, Any]:
+        assert self._start_time is None  # can't reuse Job instances
+        self._start_time = time.time()
+        self._running = True
+
+        if isinstance(iterable, Dataset):
+            shards = [
+                iterable.shard(i, self.n_processes) for i in range(self.n_processes)
+            ]
+        else:
+            inputs = list(iterable)
+            shards = [inputs[i :: self.n_processes] for i in range(self.n_processes)]
+        self._n_total = sum(len(shard) for shard in shards)
+
+        context = multiprocessing.get_context("fork")
+        messages = context.Queue()
+        processes = [
+            context.Process(
+                target=_run_shard,
+                args=(
+                    self._make_shard_job(i),
+                    shards[i],
+                    i,
+                    messages,
+                    self.snapshot_interval,
+                    self._streaming,
+                    self._reducer_requested[i],
+                    resume,
+                ),
+                daemon=True,
+            )
+            for i in range(self.n_processes)
+        ]
+        for process in processes:
+            process.start()
+
+        # Block on the queue in a thread so this event loop stays responsive
+        loop = asyncio.get_event_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            while len(self._finished_shards) < self.n_processes:
+                message = await loop.run_in_executor(
+                    executor, self._get_message, messages
+                )
+                if message is None:
+                    for i, process in enumerate(processes):
+                        if i not in self._finished_shards and not process.is_alive():
+                            raise RuntimeError(f"Shard {i} exited unexpectedly")
+                    continue
+
+                shard_index, kind, payload = message
+                if kind == "results":
+                    for stream in self._result_streams:
+                        stream.put_nowait(payload)
+                    continue
+
+                reducer_state = payload.pop("reducer", None)
+                if reducer_state is not None:
+                    self._reducer_states[shard_index] = reducer_state
+                    self._merged_reducer = None
+                self._snapshots[shard_index] = payload
+                self._version += 1
+                if kind == "final":
+                    self._finished_shards.add(shard_index)
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            executor.shutdown(wait=False)
+            self._running = False
+            for stream in self._result_streams:
+                stream.put_nowait(None)
+
+        self.reducer = self._merge_reducers()
+        return self.result
+
+    # RESULT GETTERS
+
+    @property
+    def result(self) -> Any:
+        return self._merge_reducers().result
+
+    @property
+    def finished(self) -> bool:
+        return len(self._finished_shards) == self.n_processes
+
+    def stream_results(self) -> AsyncIterator[Tuple[List[JSONType], List[JSONType]]]:
+        # See MapReduceJob.stream_results; chunks come from all shards, interleaved
+        self._streaming.set()
+        return super().stream_results()
+
+    @property
+    def cost(self) -> float:
+        return sum(s["progress"]["cost"] for s in self._snapshots.values())
+
+    # INTERNAL
+
+    def _make_shard_job(self, shard_index: int) -> MapReduceJob:
+        # Split the in-flight window as evenly as possible
+        n_mappers, remainder = divmod(self.n_mappers, self.n_processes)
+        n_mappers += shard_index < remainder
+
+        kwargs = {**self._job_kwargs, "n_mappers": max(n_mappers, 1)}
+        if self.checkpoint_path is not None:
+            kwargs["checkpoint_path"] = f"{self.checkpoint_path}.shard-{shard_index}"
+        job = MapReduceJob(
+            self.mapper_url,
+            copy.deepcopy(self._empty_reducer),
+            self.mapper_args,
+            **kwargs,
+        )
+        job.job_id = self.job_id  # so mappers can memoize job args across shards
+        return job
+
+    def _get_message(self, messages: multiprocessing.Queue) -> Optional[Any]:
+        try:
+            return messages.get(timeout=self.snapshot_interval)
+        except queue.Empty:
+            return None
+
+    def _merge_reducers(self) -> Reducer:
+        # Merges the latest reducer states, and asks running workers for new ones
+        for i, requested in enumerate(self._reducer_requested):
+            if i not in self._finished_shards:
+                requested.set()
+
+        if self._merged_reducer is None:
+            merged = copy.deepcopy(self._empty_reducer)
+            for state in self._reducer_states.values():
+                partial = copy.deepcopy(self._empty_reducer)
+                partial.deserialize(state)
+                merged.merge(partial)
+            self._merged_reducer = merged
+        return self._merged_reducer
+
+    @property
+    def _performance(self) -> Dict[str, Any]:
+        profiling: Dict[str, Statistics] = collections.defaultdict(Statistics)
+        n_chunks_per_mapper: Dict[str, int] = collections.defaultdict(int)
+        hedging: Dict[str, int] = collections.defaultdict(int)
+        retries: Dict[str, int] = collections.defaultdict(int)
+
+        for snapshot in self._snapshots.values():
+            for k, state in snapshot["profiling"].items():
+                profiling[k] += Statistics.fromstate(state)
+            for worker_id, n in snapshot["n_chunks_per_mapper"].items():
+                n_chunks_per_mapper[worker_id] += n
+            for k, n in snapshot["performance"]["hedging"].items():
+                hedging[k] += n
+            for k, n in snapshot["performance"]["retries"].items():
+                retries[k] += n
+
+        return {
+            "profiling": {k: v.mean() for k, v in profiling.items()},
+            "mapper_utilization": dict(enumerate(n_chunks_per_mapper.values())),
+            "hedging": dict(hedging),
+            "retries": dict(retries),
+            "shards": {i: s["performance"] for i, s in self._snapshots.items()},
+        }
+
+    @property
+    def _progress(self) -> Dict[str, Any]:
+        progress = {
+            "cost": self.cost,
+            "finished": self.finished,
+            "n_processed": sum(
+                s["progress"]["n_processed"] for s in self._snapshots.values()
+            ),
+            "n_skipped": sum(
+                s["progress"]["n_skipped"] for s in self._snapshots.values()
+            ),
+            "elapsed_time": self._elapsed_time,
+        }
+        if self._n_total is not None:
+            progress["n_total"] = self._n_total
+        return progress
@@ -0,0 +1,480 @@
+import asyncio
+import collections
+import json
+import time
+import uuid
+
+from knn import wire
+from knn.datasets import Dataset, open_dataset
+from knn.reducers import Reducer
+from knn.utils import JSONType
+
+from . import defaults
+from .jobs import MapReduceJob
+from .snapshots import ResultHistory
+
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+
+class SharedScanQuery:
+    # One query served by a SharedScanJob, with the same result getters as a
+    # MapReduceJob. It covers scan positions [start_position, stop_position), i.e.,
+    # every element of the dataset once, beginning wherever the scan was when the
+    # query attached.
+
+    def __init__(
+        self,
+        scan: "SharedScanJob",
+        template: JSONType,
+        reducer: Reducer,
+        weight: float,
+        callback: Optional[Callable[[Any], None]],
+    ) -> None:
+        self.job_id = str(uuid.uuid4())
+        self.template = template
+        self.reducer = reducer
+        self.weight = weight
+        self.callback = callback
+
+        self.start_position = scan._cursor
+        self.stop_position = scan._cursor + len(scan.dataset)
+
+        self._scan = scan
+        self._n_successful = 0
+        self._n_failed = 0
+        self._cost_share = 0.0  # elements' worth of the scan's cost charged to us
+        self._completions: Deque[Tuple[float, int]] = collections.deque()  # recent
+        self._start_time = time.time()
+        self._end_time: Optional[float] = None
+
+        self._version = 0  # counts chunk results handled for this query
+        self._result_history = ResultHistory()
+        self._result_streams: Set[asyncio.Queue] = set()
+        self._streams_closed = False
+
+    async def stop(self) -> None:
+        await self._scan.detach(self)
+
+    def stream_results(self) -> AsyncIterator[Tuple[List[JSONType], List[JSONType]]]:
+        # Like MapReduceJob.stream_results, with this query's part of each output;
+        # ends when the query finishes or is stopped, or the scan ends
+        stream: asyncio.Queue = asyncio.Queue()
+        if self._streams_closed:
+            stream.put_nowait(None)
+        else:
+            self._result_streams.add(stream)
+
+        async def iterator():
+            try:
+                while True:
+                    chunk = await stream.get()
+                    if chunk is None:
+                        return
+                    yield chunk
+            finally:
+                self._result_streams.discard(stream)
+
+        return iterator()
+
+    # RESULT GETTERS
+
+    @property
+    def result(self) -> Any:
+        return self.reducer.result
+
+    @property
+    def job_result(self) -> Dict[str, Any]:
+        return {
+            "performance": self._performance,
+            "progress": self._progress,
+            "result": self.result,
+        }
+
+    def snapshot(self, since_version: Optional[int] = None) -> Dict[str, Any]:
+        # See MapReduceJob.snapshot
+        if self._result_history.version < self._version:
+            self._result_history.update(self._version, self.result)
+        return {
+            "version": self._version,
+            "performance": self._performance,
+            "progress": self._progress,
+            "result": self._result_history.since(since_version),
+        }
+
+    @property
+    def finished(self) -> bool:
+        n_total = self.stop_position - self.start_position
+        return self._n_successful + self._n_failed == n_total
+
+    @property
+    def cost(self) -> float:
+        # Each element's cost is split evenly between the queries it was scored for
+        if not self._scan._n_charged:
+            return 0.0
+        return self._scan.cost * self._cost_share / self._scan._n_charged
+
+    # INTERNAL
+
+    def _covers(self, position: int) -> bool:
+        return self.start_position <= position < self.stop_position
+
+    def _close_streams(self) -> None:
+        self._streams_closed = True
+        for stream in self._result_streams:
+            stream.put_nowait(None)
+
+    def _throughput(self, window: float) -> float:
+        # Elements per second handled for this query over the last `window` seconds
+        cutoff = time.time() - window
+        while self._completions and self._completions[0][0] < cutoff:
+            self._completions.popleft()
+        return sum(n for _, n in self._completions) / window
+
+    @property
+    def _performance(self) -> Dict[str, Any]:
+        # The scan's, plus this query's part of it under "query"
+        performance = self._scan._cached_performance()
+        query_stats = self._scan._query_stats(
+            self, self._scan._in_flight_shares(), performance.get("scheduler")
+        )
+        return {**performance, "query": query_stats}
+
+    @property
+    def _progress(self) -> Dict[str, Any]:
+        end_time = self._end_time or time.time()
+        return {
+            "cost": self.cost,
+            "finished": self.finished,
+            "n_processed": self._n_successful,
+            "n_skipped": self._n_failed,
+            "n_total": self.stop_position - self.start_position,
+            "elapsed_time": end_time - self._start_time,
+        }
+
+
+class SharedScanJob(MapReduceJob):
+    # Serves any number of concurrent queries with one scan over `dataset`. Each
+    # request carries the templates of all attached queries that still need any of
+    # its elements (as job_args["templates"], for mappers with a multi-template
+    # mode), and split_func(output, i) picks the part of each output that goes to
+    # the reducer of the query with template i. The scan starts at the first
+    # element and wraps around for as long as some query still needs elements, so
+    # a query that attaches mid-pass gets what it missed at the start of the next
+    # pass, and mapper work per element doesn't grow with the number of queries.
+    #
+    # Once no attached query needs more elements, the scan ends and no more queries
+    # can attach (see SharedScans, which starts a new scan then). Detaching the last
+    # query stops the scan right away.
+    #
+    # Scans can't be checkpointed or resumed: the queries, with their templates and
+    # reducers, only live in this process and come and go, so there's no fixed job
+    # to pick up again. stream_results() gives the raw outputs of every chunk (for
+    # all templates); SharedScanQuery.stream_results() gives one query's part.
+
+    def __init__(
+        self,
+        mapper_url: str,
+        dataset: Dataset,
+        mapper_args: JSONType = {},
+        *,
+        split_func: Optional[Callable[[JSONType, int], JSONType]] = None,
+        **kwargs,
+    ) -> None:
+        assert len(dataset) > 0
+        assert kwargs.get("checkpoint_path") is None, "scans can't be resumed"
+        # No reducer of our own; each query has one
+        super().__init__(mapper_url, None, mapper_args, **kwargs)  # type: ignore
+        self.dataset = dataset
+        self.split_func = split_func or self.split_value
+        self._throughput_window = (
+            self.scheduler.throughput_window
+            if self.scheduler is not None
+            else defaults.SCHEDULER_THROUGHPUT_WINDOW
+        )
+
+        self._queries: Dict[str, SharedScanQuery] = {}  # attached, in attach order
+        self._cursor = 0  # next scan position; position p reads element p % n
+        self._accepting = True  # until we've stopped reading new positions
+        self._n_charged = 0  # elements whose cost has been charged to queries
+
+        # Each distinct list of templates sent is a generation, with its own job ID
+        # on the mappers (which set up each job once); requests in flight remember
+        # theirs so outputs can be matched to the queries they were scored for
+        self._generations: Dict[Tuple[str, ...], int] = {}
+        self._generation_queries: List[List[SharedScanQuery]] = []
+        self._generation_by_position: Dict[int, int] = {}
+
+    @property
+    def accepting(self) -> bool:
+        return self._accepting
+
+    def attach(
+        self,
+        template: JSONType,
+        reducer: Reducer,
+        *,
+        weight: float = 1.0,
+        callback: Optional[Callable[[Any], None]] = None,
+    ) -> SharedScanQuery:
+        # `callback` is called with the query's result once it has seen every
+        # element; `weight` adds to the scan's share of its scheduler's slots
+        assert self._accepting
+        query = SharedScanQuery(self, template, reducer, weight, callback)
+        self._queries[query.job_id] = query
+        self._update_weight()
+        return query
+
+    async def detach(self, query: SharedScanQuery) -> None:
+        if self._queries.pop(query.job_id, None) is None:  # already finished
+            return
+        query._end_time = time.time()
+        query._close_streams()
+        self._update_weight()
+        if not self._queries:  # nobody is waiting for the requests in flight
+            self._accepting = False
+            await self.stop()
+
+    async def start(self, callback: Optional[Callable[[Any], None]] = None) -> None:
+        await super().start(self.dataset, callback)
+
+    async def run_until_complete(
+        self, iterable: Optional[Iterable[JSONType]] = None
+    ) -> Dict[str, Any]:
+        assert iterable is None or iterable is self.dataset
+        assert self._start_time is None  # can't reuse Job instances
+        try:
+            return await self._run(self._scan())
+        finally:
+            self._accepting = False
+            for query in self._queries.values():  # unfinished, e.g., stopped
+                query._close_streams()
+
+    @property
+    def result(self) -> Dict[str, Any]:
+        return {job_id: query.result for job_id, query in self._queries.items()}
+
+    def split_value(self, output: JSONType, template_index: int) -> JSONType:
+        assert isinstance(output, list)
+        return output[template_index]
+
+    # INTERNAL
+
+    @property
+    def _performance(self) -> Dict[str, Any]:
+        return {
+            **super()._performance,
+            "shared_scan": {
+                "n_queries": len(self._queries),
+                "n_passes": self._cursor / len(self.dataset),
+                "n_generations": len(self._generation_queries),
+            },
+        }
+
+    def _scheduler_stats(self, stats: Dict[str, Any]) -> Dict[str, Any]:
+        # The scheduler only sees the scan, so break its stats down by query
+        shares = self._in_flight_shares()
+        return {
+            "queries": {
+                job_id: self._query_stats(query, shares, stats)
+                for job_id, query in self._queries.items()
+            }
+        }
+
+    def _query_stats(
+        self,
+        query: SharedScanQuery,
+        in_flight_shares: Dict[str, float],
+        scheduler_stats: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        # A query's throughput (elements per second) and share of the elements in
+        # flight, and, with the scan's scheduler stats, its parts of the scan's fair
+        # share and requests in flight
+        stats = {
+            "weight": query.weight,
+            "n_completed": query._n_successful + query._n_failed,
+            "throughput": query._throughput(self._throughput_window),
+            "in_flight_share": in_flight_shares.get(query.job_id, 0.0),
+        }
+        if scheduler_stats is not None and query.job_id in self._queries:
+            stats["fair_share"] = (
+                scheduler_stats["fair_share"] * query.weight / self.weight
+            )
+            stats["in_flight"] = scheduler_stats["in_flight"] * stats["in_flight_share"]
+        return stats
+
+    def _in_flight_shares(self) -> Dict[str, float]:
+        # Attached query ID -> fraction of the elements in flight (or waiting to be
+        # retried) that are for it, with each split evenly between the attached
+        # queries it's scored for, like costs
+        shares: Dict[str, float] = collections.defaultdict(float)
+        for position, generation in self._generation_by_position.items():
+            covering = [
+                query
+                for query in self._generation_queries[generation]
+                if query._covers(position) and query.job_id in self._queries
+            ]
+            for query in covering:
+                shares[query.job_id] += 1 / len(covering)
+        n_in_flight = len(self._generation_by_position)
+        return {job_id: share / n_in_flight for job_id, share in shares.items()}
+
+    def _scan(self) -> Iterator[JSONType]:
+        # Read lazily, so queries that attach meanwhile extend the scan
+        while any(self._cursor < q.stop_position for q in self._queries.values()):
+            position = self._cursor
+            self._cursor += 1
+            yield self.dataset[position % len(self.dataset)]
+        self._accepting = False
+
+    def _construct_request(
+        self, chunk: List[JSONType], positions: List[int]
+    ) -> JSONType:
+        queries = [
+            query
+            for query in self._queries.values()
+            if any(query._covers(position) for position in positions)
+        ]
+        key = tuple(query.job_id for query in queries)
+        if key not in self._generations:
+            self._generations[key] = len(self._generation_queries)
+            self._generation_queries.append(queries)
+        generation = self._generations[key]
+        for position in positions:
+            self._generation_by_position[position] = generation
+
+        return {
+            "job_id": f"{self.job_id}-{generation}",
+            "job_args": {
+                **self.mapper_args,
+                "templates": [query.template for query in queries],
+            },
+            "inputs": chunk,
+        }
+
+    def _handle_results(
+        self, inputs: List[JSONType], outputs: List[JSONType], positions: List[int]
+    ) -> None:
+        self._demultiplex(inputs, outputs, positions)
+        for stream in self._result_streams:
+            stream.put_nowait((inputs, outputs))
+
+    def _handle_skipped(self, inputs: List[JSONType], positions: List[int]) -> None:
+        super()._handle_skipped(inputs, positions)
+        self._demultiplex(inputs, None, positions)
+
+    def _demultiplex(
+        self,
+        inputs: List[JSONType],
+        outputs: Optional[List[JSONType]],
+        positions: List[int],
+    ) -> None:
+        # Elements of one request (so one generation); outputs is None if skipped
+        generation = self._generation_by_position[positions[0]]
+        for position in positions:
+            del self._generation_by_position[position]
+
+        queries = self._generation_queries[generation]
+        n_covering = [sum(q._covers(p) for q in queries) for p in positions]
+        self._n_charged += len(positions)
+
+        for template_index, query in enumerate(queries):
+            indices = [i for i, p in enumerate(positions) if query._covers(p)]
+            if not indices or query.job_id not in self._queries:  # or detached
+                continue
+
+            if outputs is None:
+                query._n_failed += len(indices)
+            else:
+                query_inputs = [inputs[i] for i in indices]
+                query_outputs = [
+                    self.split_func(outputs[i], template_index) for i in indices
+                ]
+                query.reducer.handle_results(query_inputs, query_outputs)
+                query._n_successful += len(indices)
+                for stream in query._result_streams:
+                    stream.put_nowait((query_inputs, query_outputs))
+            query._cost_share += sum(1 / n_covering[i] for i in indices)
+            query._completions.append((time.time(), len(indices)))
+            query._version += 1
+
+            if query.finished:
+                self._finish(query)
+
+    def _finish(self, query: SharedScanQuery) -> None:
+        del self._queries[query.job_id]
+        query._end_time = time.time()
+        query._close_streams()
+        self._update_weight()
+        if query.callback is not None:
+            query.callback(query.result)
+
+    def _update_weight(self) -> None:
+        # The scan gets the scheduler share of all of its queries together
+        self.weight = sum(q.weight for q in self._queries.values()) or 1.0
+        if self.scheduler is not None and self._running:
+            self.scheduler.set_weight(self.job_id, self.weight)
+
+
+class SharedScans:
+    # Coalesces queries that run the same mapper, with the same arguments, over the
+    # same dataset: a query that arrives while such a scan is running attaches to
+    # it, and otherwise starts a new SharedScanJob. Datasets are opened (with
+    # open_dataset) once, shared by all scans over them, and kept until close().
+
+    def __init__(self, **job_kwargs) -> None:
+        self.job_kwargs = job_kwargs  # for every SharedScanJob, e.g., scheduler=
+        self._datasets: Dict[str, Dataset] = {}
+        self._scans: Dict[str, SharedScanJob] = {}
+
+    async def attach(
+        self,
+        mapper_url: str,
+        dataset_path: str,
+        mapper_args: JSONType,
+        template: JSONType,
+        reducer: Reducer,
+        *,
+        weight: float = 1.0,
+        callback: Optional[Callable[[Any], None]] = None,
+        **job_kwargs,
+    ) -> SharedScanQuery:
+        # job_kwargs override the constructor's, but only if a new scan is started
+        key = json.dumps(
+            [mapper_url, dataset_path, wire.to_jsonable(mapper_args)], sort_keys=True
+        )
+        scan = self._scans.get(key)
+        if scan is not None and scan.accepting:
+            return scan.attach(template, reducer, weight=weight, callback=callback)
+
+        if dataset_path not in self._datasets:
+            self._datasets[dataset_path] = open_dataset(dataset_path)
+        scan = SharedScanJob(
+            mapper_url,
+            self._datasets[dataset_path],
+            mapper_args,
+            **{**self.job_kwargs, **job_kwargs},
+        )
+        self._scans[key] = scan
+        query = scan.attach(template, reducer, weight=weight, callback=callback)
+        await scan.start()
+        return query
+
+    async def close(self) -> None:
+        for scan in self._scans.values():
+            await scan.stop()
+        self._scans.clear()
+        for dataset in self._datasets.values():
+            dataset.close()
+        self._datasets.clear()
@@ -0,0 +1,68 @@
+import collections
+import json
+
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from knn.utils import JSONType
+
+from . import defaults
+
+
+def _default_key(item: Any) -> str:
+    # Items of a TopKReducer result are identified by their input
+    return json.dumps(getattr(item, "input", item), sort_keys=True, default=str)
+
+
+class ResultHistory:
+    # Tracks how a job's result changes between versions, so a client holding the
+    # result as of some version can be sent only what changed since. List results
+    # (e.g., a top k) are sent as {key: item} mappings, and a delta holds the items
+    # added and the keys of the items removed since that version; a client applies
+    # the removals, then the additions. Only the last max_removals removals are
+    # remembered; clients further behind than that get the full result again.
+    # Other results are always sent in full when they change.
+
+    def __init__(
+        self,
+        key_func: Callable[[Any], str] = _default_key,
+        max_removals: int = defaults.SNAPSHOT_MAX_REMOVALS,
+    ) -> None:
+        self.key_func = key_func
+        self.version = -1  # nothing recorded yet
+
+        self._result: Any = None
+        self._added_at: Dict[str, int] = {}  # key of each current item -> version
+        self._removals: Deque[Tuple[int, str]] = collections.deque(maxlen=max_removals)
+        self._oldest_complete_version = -1  # deltas since older versions are partial
+
+    def update(self, version: int, result: Any) -> None:
+        # Records `result` as of `version`, which must increase with every call
+        assert version > self.version
+        self.version = version
+
+        if isinstance(result, list):
+            keys = {self.key_func(item): item for item in result}
+            for key in self._added_at.keys() - keys.keys():
+                if len(self._removals) == self._removals.maxlen:
+                    self._oldest_complete_version = self._removals[0][0]
+                self._removals.append((version, key))
+                del self._added_at[key]
+            for key in keys.keys() - self._added_at.keys():
+                self._added_at[key] = version
+        self._result = result
+
+    def since(self, version: Optional[int]) -> Dict[str, JSONType]:
+        # -> {"full": True, "items": {key: item}} (or "value" for other results), or
+        # {"full": False, "added": {key: item}, "removed": [key, ...]}
+        if version is not None and version >= self.version:
+            return {"full": False, "added": {}, "removed": []}
+
+        if not isinstance(self._result, list):
+            return {"full": True, "value": self._result}
+        items = {self.key_func(item): item for item in self._result}
+        if version is None or version < self._oldest_complete_version:
+            return {"full": True, "items": items}
+
+        added = {k: item for k, item in items.items() if self._added_at[k] > version}
+        removed = [key for v, key in self._removals if v > version]
+        return {"full": False, "added": added, "removed": removed}
@@ -1,16 +1,19 @@
 import abc
 import asyncio
 import collections
+import concurrent.futures
 from dataclasses import dataclass
 import functools
+import multiprocessing
 import time
 import uuid
 
-from typing import List, Dict, Any, DefaultDict
+from typing import Awaitable, Callable, List, Dict, Any, DefaultDict, Optional, Tuple
 
 from sanic import Sanic
-from sanic.response import json
+from sanic.response import json, raw
 
+from knn import wire
 from knn.utils import JSONType
 
 
@@ -30,6 +33,65 @@ class RequestProfiler:
         )
 
 
+def _configure_compute_worker(n_intra_op_threads: Optional[int]) -> None:
+    # Runs in each compute worker process (and once in this process for threads)
+    if n_intra_op_threads is None:
+        return
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(n_intra_op_threads)
+
+
+# Mappers in this process by worker_id; compute worker processes are forked after
+# the mapper is registered, so each one finds its own copy here
+_mappers: Dict[str, "Mapper"] = {}
+
+
+def _call_mapper_method(worker_id: str, name: str, *args) -> Any:
+    # Runs in a compute worker process
+    return getattr(_mappers[worker_id], name)(*args)
+
+
+def _timed(f: Callable[..., Any], *args) -> Tuple[Any, float]:
+    start_time = time.time()
+    result = f(*args)
+    return result, time.time() - start_time
+
+
+class _Prefetch:
+    # One element's prefetch_element call, started once a slot frees up. The slot
+    # is held until the element's data is handed to process_element, which bounds
+    # how much prefetched data can pile up ahead of compute.
+
+    def __init__(self, slots: asyncio.Semaphore, coro: Awaitable[Any]) -> None:
+        self.slots = slots
+        self.acquired = False
+        self.task = asyncio.ensure_future(self._run(coro))
+
+    async def _run(self, coro):
+        try:
+            await self.slots.acquire()
+        except asyncio.CancelledError:
+            coro.close()
+            raise
+        self.acquired = True
+        return await coro
+
+    def release(self) -> None:
+        if self.acquired:
+            self.slots.release()
+            self.acquired = False
+
+    def discard(self) -> None:
+        if not self.task.done():
+            self.task.cancel()
+        elif not self.task.cancelled():
+            self.task.exception()  # mark as retrieved
+        self.release()
+
+
 class Mapper(abc.ABC):
     # BASE CLASS
 
@@ -60,6 +122,66 @@ class Mapper(abc.ABC):
     ) -> JSONType:
         pass
 
+    # PREFETCHING
+
+    async def prefetch_element(
+        self, input: JSONType, job_id: str, job_args: Any, request_id: str
+    ) -> Any:
+        # Override to start an element's I/O (e.g., downloading its image) as soon
+        # as its request arrives, ahead of process_element. Only used if the mapper
+        # was created with prefetch_depth set.
+        return None
+
+    @property
+    def is_prefetching(self) -> bool:
+        return self._prefetch_depth is not None
+
+    async def prefetched(self, request_id: str, element_index: int) -> Any:
+        # Returns what prefetch_element produced for the given element, waiting for
+        # it if necessary; time spent waiting is reported as io_wait
+        prefetch = self._prefetches.pop((request_id, element_index))
+        try:
+            with self.profiler(request_id, "io_wait"):
+                return await prefetch.task
+        finally:
+            prefetch.release()
+
+    # COMPUTE
+
+    async def run_in_executor(
+        self,
+        f: Callable[..., Any],
+        *args,
+        request_id: Optional[str] = None,
+        category: str = "compute_time",
+    ) -> Any:
+        # Runs f(*args) on the compute executor so CPU-bound work (decoding,
+        # inference) doesn't block the event loop, and I/O for other elements and
+        # requests can proceed in the meantime. If request_id is given, the time
+        # spent inside f (but not waiting for a free worker) is added to `category`.
+        #
+        # With a process executor, args (and the result) must be picklable, and f
+        # must be either a method of this mapper, which runs on the worker's copy of
+        # it as of the fork (so it shouldn't rely on state set up later, like job
+        # args), or a module-level function.
+        if self._compute_processes and getattr(f, "__self__", None) is self:
+            # The mapper itself (server, sessions, executors) doesn't pickle
+            f, args = _call_mapper_method, (self.worker_id, f.__name__, *args)
+        loop = asyncio.get_running_loop()
+        result, elapsed_time = await loop.run_in_executor(
+            self._executor, functools.partial(_timed, f, *args)
+        )
+        if request_id is not None:
+            self.add_profiling(request_id, category, elapsed_time)
+        return result
+
+    # PROFILING
+
+    def add_profiling(self, request_id: str, category: str, value: float) -> None:
+        # For figures that can't be measured with a `with self.profiler(...)` block,
+        # e.g., a share of work done on behalf of several requests at once
+        self._profiling_results_by_request[request_id][category] += value
+
     # DECORATORS
 
     @staticmethod
@@ -88,7 +210,16 @@ class Mapper(abc.ABC):
 
     # INTERNAL
 
-    def __init__(self, *args, start_server=True, **kwargs):
+    def __init__(
+        self,
+        *args,
+        start_server=True,
+        n_compute_workers=1,
+        compute_executor="thread",
+        n_intra_op_threads=None,
+        prefetch_depth=None,
+        **kwargs,
+    ):
         self._init_start_time = time.time()
 
         self.worker_id = str(uuid.uuid4())
@@ -100,8 +231,32 @@ class Mapper(abc.ABC):
             RequestProfiler, results_dict=self._profiling_results_by_request
         )
 
+        # At most prefetch_depth elements (across all requests) are being fetched
+        # or waiting to be processed at once; the rest queue up in arrival order
+        self._prefetch_depth = prefetch_depth
+        self._prefetch_slots: Optional[asyncio.Semaphore] = None  # created on the loop
+        self._prefetches: Dict[Tuple[str, int], _Prefetch] = {}
+
         self.initialize_container(*args, **kwargs)
 
+        # Created after initialize_container so forked workers inherit its state
+        self._compute_processes = compute_executor == "process"
+        if compute_executor == "thread":
+            _configure_compute_worker(n_intra_op_threads)
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=n_compute_workers
+            )
+        elif compute_executor == "process":
+            _mappers[self.worker_id] = self
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_compute_workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_configure_compute_worker,
+                initargs=(n_intra_op_threads,),
+            )
+        else:
+            raise ValueError(f"Unknown compute executor: {compute_executor}")
+
         if start_server:
             self._server = Sanic(self.worker_id)
             self._server.add_route(self._handle_request, "/", methods=["POST"])
@@ -127,21 +282,46 @@ class Mapper(abc.ABC):
             pass
         with self.profiler(request_id, "billed_time", additional=init_time):
             with self.profiler(request_id, "request_time"):
-                job_id = request.json["job_id"]
-                job_args = self._args_by_job.setdefault(
-                    job_id, await self.initialize_job(request.json["job_args"])
-                )  # memoized
-                outputs = await self.process_chunk(
-                    request.json["inputs"], job_id, job_args, request_id
-                )
-
-        return json(
-            {
-                "worker_id": self.worker_id,
-                "profiling": self._profiling_results_by_request.pop(request_id),
-                "outputs": outputs,
-            }
-        )
+                if request.content_type == wire.CONTENT_TYPE:
+                    payload = wire.loads(request.body)
+                else:
+                    payload = request.json
+
+                job_id = payload["job_id"]
+                if job_id not in self._args_by_job:  # memoized
+                    self._args_by_job[job_id] = await self.initialize_job(
+                        payload["job_args"]
+                    )
+                job_args = self._args_by_job[job_id]
+                inputs = payload["inputs"]
+                if self.is_prefetching:
+                    if self._prefetch_slots is None:
+                        self._prefetch_slots = asyncio.Semaphore(self._prefetch_depth)
+                    for i, input in enumerate(inputs):
+                        self._prefetches[(request_id, i)] = _Prefetch(
+                            self._prefetch_slots,
+                            self.prefetch_element(input, job_id, job_args, request_id),
+                        )
+                try:
+                    outputs = await self.process_chunk(
+                        inputs, job_id, job_args, request_id
+                    )
+                finally:
+                    for i in range(len(inputs)):  # never consumed, e.g., skipped
+                        prefetch = self._prefetches.pop((request_id, i), None)
+                        if prefetch is not None:
+                            prefetch.discard()
+
+        response = {
+            "worker_id": self.worker_id,
+            "profiling": self._profiling_results_by_request.pop(request_id),
+            "outputs": outputs,
+        }
+
+        # Answer in the binary frame format if the client told us it understands it
+        if wire.accepts_frames(request.headers.get("accept")):
+            return raw(wire.dumps(response), content_type=wire.CONTENT_TYPE)
+        return json(wire.to_jsonable(response))
 
     async def _sleep(self, request):
         delay = float(request.json["delay"])
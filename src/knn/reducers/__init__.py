@@ -1,2 +1,9 @@
 from .base import Reducer
-from .reducers import TopKReducer, PoolingReducer, StatisticsReducer
+from .reducers import (
+    TopKReducer,
+    MultiTopKReducer,
+    PoolingReducer,
+    StatisticsReducer,
+    EmbeddingWriterReducer,
+    IndexReducer,
+)
@@ -1,6 +1,6 @@
 import abc
 
-from typing import Any
+from typing import Any, List
 
 from knn.utils import JSONType
 
@@ -10,6 +10,43 @@ class Reducer(abc.ABC):
     def handle_result(self, input: JSONType, output: JSONType) -> None:
         pass
 
+    def handle_results(self, inputs: List[JSONType], outputs: List[JSONType]) -> None:
+        # Called once per chunk with its successful results; override to process
+        # them in bulk
+        for input, output in zip(inputs, outputs):
+            self.handle_result(input, output)
+
     @abc.abstractproperty
     def result(self) -> Any:
         pass
+
+    # SHARDING
+    # Reducers that implement these can be split across coordinator processes:
+    # each one reduces a slice of the dataset, ships its state with serialize(), and
+    # the parent loads it into an identically configured reducer with deserialize()
+    # and combines the pieces with merge().
+
+    def merge(self, other: "Reducer") -> None:
+        raise NotImplementedError
+
+    def serialize(self) -> bytes:
+        raise NotImplementedError
+
+    def deserialize(self, data: bytes) -> None:
+        raise NotImplementedError
+
+    # CHECKPOINTING
+    # Checkpoints save serialize()'s full state. Reducers whose state is large and
+    # only grows (e.g., an index) can make most checkpoints save just what changed
+    # since the previous one: track_changes() (re)starts recording changes and
+    # returns True, serialize_changes() returns what was recorded since and starts
+    # over, and deserialize_changes() applies that on top of the state it followed.
+
+    def track_changes(self) -> bool:
+        return False
+
+    def serialize_changes(self) -> bytes:
+        raise NotImplementedError
+
+    def deserialize_changes(self, data: bytes) -> None:
+        raise NotImplementedError
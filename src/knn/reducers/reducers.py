@@ -1,14 +1,18 @@
+import collections
+import concurrent.futures
 from dataclasses import dataclass
 from enum import Enum
-import heapq
+import io
 
 from dataclasses_json import dataclass_json
 import numpy as np
 from runstats import Statistics
 
-from typing import Callable, List, Optional
+from typing import Any, Callable, Deque, Dict, List, Optional, Union
 
-from knn import utils
+from knn import utils, wire
+from knn.embedding_shards import DEFAULT_MAX_SHARD_BYTES, EmbeddingShardWriter
+from knn.index import IVFIndex, PQIndex
 from knn.utils import JSONType
 
 from .base import Reducer
@@ -31,14 +35,38 @@ class TopKReducer(Reducer):
         super().__init__()
         self.k = k
         self.extract_func = extract_func or self.extract_value
-        self._top_k: List[TopKReducer.ScoredResult] = []
+
+        # Candidates are stored by index: scores in an array, inputs and outputs in
+        # parallel lists. We let up to k extra candidates pile up before pruning
+        # back to the top k with argpartition, so pruning is amortized over chunks.
+        self._scores = np.empty(0, dtype=np.float64)
+        self._inputs: List[JSONType] = []
+        self._outputs: List[JSONType] = []
+        self._threshold = -np.inf  # k-th best score as of the last prune
+        self._snapshot: Optional[List[TopKReducer.ScoredResult]] = None
 
     def handle_result(self, input: JSONType, output: JSONType) -> None:
-        result = TopKReducer.ScoredResult(self.extract_func(output), input, output)
-        if len(self._top_k) < self.k:
-            heapq.heappush(self._top_k, result)
-        elif self._top_k[0] < result:
-            heapq.heapreplace(self._top_k, result)
+        self.handle_results([input], [output])
+
+    def handle_results(self, inputs: List[JSONType], outputs: List[JSONType]) -> None:
+        scores = np.fromiter(
+            (self.extract_func(o) for o in outputs),
+            dtype=np.float64,
+            count=len(outputs),
+        )
+        self._add_candidates(scores, inputs, outputs)
+
+    def handle_scored_results(
+        self,
+        scores: Union[np.ndarray, List[float]],
+        inputs: List[JSONType],
+        outputs: List[JSONType],
+    ) -> None:
+        # Like handle_results, for callers that already have each output's score
+        # (skips extract_func)
+        scores = np.asarray(scores, dtype=np.float64)
+        assert len(scores) == len(inputs) == len(outputs)
+        self._add_candidates(scores, inputs, outputs)
 
     def extract_value(self, output: JSONType) -> float:
         assert isinstance(output, float)
@@ -46,34 +74,228 @@ class TopKReducer(Reducer):
 
     @property
     def result(self) -> List[ScoredResult]:
-        return list(reversed(sorted(self._top_k)))
+        if self._snapshot is None:
+            self._prune()
+            order = np.argsort(-self._scores, kind="stable")
+            self._snapshot = [
+                TopKReducer.ScoredResult(
+                    float(self._scores[i]), self._inputs[i], self._outputs[i]
+                )
+                for i in order
+            ]
+        return list(self._snapshot)
+
+    def merge(self, other: Reducer) -> None:
+        assert isinstance(other, TopKReducer)
+        other._prune()
+        self._add_candidates(other._scores, other._inputs, other._outputs)
+
+    def serialize(self) -> bytes:
+        self._prune()
+        return wire.dumps(
+            {"scores": self._scores, "inputs": self._inputs, "outputs": self._outputs}
+        )
+
+    def deserialize(self, data: bytes) -> None:
+        state = wire.loads(data)
+        self._scores = np.array(state["scores"], dtype=np.float64)
+        self._inputs = state["inputs"]
+        self._outputs = state["outputs"]
+        self._threshold = -np.inf
+        self._snapshot = None
+        self._prune()
+
+    def _add_candidates(
+        self, scores: np.ndarray, inputs: List[JSONType], outputs: List[JSONType]
+    ) -> None:
+        accepted = np.flatnonzero(scores > self._threshold)
+        if not len(accepted):
+            return
+
+        self._scores = np.concatenate([self._scores, scores[accepted]])
+        self._inputs.extend(inputs[i] for i in accepted)
+        self._outputs.extend(outputs[i] for i in accepted)
+        self._snapshot = None  # top k may have changed
+
+        if len(self._scores) >= 2 * self.k:
+            self._prune()
+
+    def _prune(self) -> None:
+        if len(self._scores) > self.k:
+            top_k = np.argpartition(-self._scores, self.k - 1)[: self.k]
+            self._scores = self._scores[top_k]
+            self._inputs = [self._inputs[i] for i in top_k]
+            self._outputs = [self._outputs[i] for i in top_k]
+        if len(self._scores) == self.k:
+            self._threshold = self._scores.min()
+
+
+class MultiTopKReducer(Reducer):
+    # A separate top k per template, for jobs that score several templates at once.
+    # extract_func maps each output to its scores, one per template; outputs are
+    # shared (not copied) between the per-template top ks.
+
+    def __init__(
+        self,
+        k: int,
+        n_templates: int,
+        extract_func: Optional[Callable[[JSONType], List[float]]] = None,
+    ) -> None:
+        super().__init__()
+        self.k = k
+        self.n_templates = n_templates
+        self.extract_func = extract_func or self.extract_value
+        self._reducers = [TopKReducer(k) for _ in range(n_templates)]
+
+    def handle_result(self, input: JSONType, output: JSONType) -> None:
+        self.handle_results([input], [output])
+
+    def handle_results(self, inputs: List[JSONType], outputs: List[JSONType]) -> None:
+        scores = np.array(
+            [self.extract_func(o) for o in outputs], dtype=np.float64
+        ).reshape(len(outputs), self.n_templates)
+        for reducer, template_scores in zip(self._reducers, scores.T):
+            reducer.handle_scored_results(template_scores, inputs, outputs)
+
+    def extract_value(self, output: JSONType) -> List[float]:
+        assert isinstance(output, (list, np.ndarray))
+        return output
+
+    @property
+    def result(self) -> List[List[TopKReducer.ScoredResult]]:
+        return [reducer.result for reducer in self._reducers]
+
+    def merge(self, other: Reducer) -> None:
+        assert isinstance(other, MultiTopKReducer)
+        assert other.n_templates == self.n_templates
+        for reducer, other_reducer in zip(self._reducers, other._reducers):
+            reducer.merge(other_reducer)
+
+    def serialize(self) -> bytes:
+        return wire.dumps(
+            [np.frombuffer(r.serialize(), dtype=np.uint8) for r in self._reducers]
+        )
+
+    def deserialize(self, data: bytes) -> None:
+        states = wire.loads(data)
+        assert len(states) == self.n_templates
+        for reducer, state in zip(self._reducers, states):
+            reducer.deserialize(state.tobytes())
 
 
 class PoolingReducer(Reducer):
     class PoolingType(Enum):
-        MAX = np.max
-        AVG = np.mean
+        MAX = "max"
+        AVG = "avg"
+        WEIGHTED_AVG = "weighted_avg"  # weights come from weight_func(input)
+        L2_NORMALIZED_AVG = "l2_normalized_avg"
 
     def __init__(
         self,
         pool_func: PoolingType = PoolingType.AVG,
         extract_func: Optional[Callable[[JSONType], np.ndarray]] = None,
+        weight_func: Optional[Callable[[JSONType], float]] = None,
     ) -> None:
         super().__init__()
+        assert (pool_func == PoolingReducer.PoolingType.WEIGHTED_AVG) == (
+            weight_func is not None
+        )
+
         self.pool_func = pool_func
         self.extract_func = extract_func or self.extract_value
-        self._results = []  # type: List[np.ndarray]
+        self.weight_func = weight_func
+        self._decoder = utils.NumpyDecoder()
+
+        # Running accumulators, so memory stays O(d) however many results we see
+        self._accumulator: Optional[np.ndarray] = None  # elementwise max or sum
+        self._total_weight = 0.0
+        self._dtype: Optional[np.dtype] = None
 
     def handle_result(self, input: JSONType, output: JSONType) -> None:
-        self._results.append(self.extract_func(output))
+        self._accumulate([input], self.extract_func(output)[np.newaxis])
+
+    def handle_results(self, inputs: List[JSONType], outputs: List[JSONType]) -> None:
+        if self.extract_func == self.extract_value:  # decode whole chunk at once
+            assert all(isinstance(o, (str, np.ndarray)) for o in outputs)
+            results = self._decoder.decode_many(outputs)
+        else:
+            results = np.stack([self.extract_func(o) for o in outputs])
+        self._accumulate(inputs, results)
 
     def extract_value(self, output: JSONType) -> np.ndarray:
-        assert isinstance(output, str)
-        return utils.base64_to_numpy(output)
+        assert isinstance(output, (str, np.ndarray))
+        return self._decoder.decode(output)
 
     @property
     def result(self) -> np.ndarray:
-        return self.pool_func(np.stack(self._results), axis=0)
+        assert self._accumulator is not None  # need at least one result
+
+        if self.pool_func == PoolingReducer.PoolingType.MAX:
+            return self._accumulator.copy()
+
+        mean = self._accumulator / self._total_weight
+        if self.pool_func == PoolingReducer.PoolingType.L2_NORMALIZED_AVG:
+            mean /= np.linalg.norm(mean)
+        return mean.astype(self._dtype)
+
+    def merge(self, other: Reducer) -> None:
+        assert isinstance(other, PoolingReducer)
+        assert other.pool_func == self.pool_func
+        if other._accumulator is None:
+            return
+
+        if self._accumulator is None:
+            self._accumulator = other._accumulator.copy()
+            self._dtype = other._dtype
+        elif self.pool_func == PoolingReducer.PoolingType.MAX:
+            np.maximum(self._accumulator, other._accumulator, out=self._accumulator)
+        else:
+            self._accumulator += other._accumulator
+        self._total_weight += other._total_weight
+
+    def serialize(self) -> bytes:
+        return wire.dumps(
+            {
+                "pool_func": self.pool_func.value,
+                "accumulator": self._accumulator,
+                "total_weight": self._total_weight,
+                "dtype": self._dtype.str if self._dtype is not None else None,
+            }
+        )
+
+    def deserialize(self, data: bytes) -> None:
+        state = wire.loads(data)
+        assert state["pool_func"] == self.pool_func.value
+        accumulator = state["accumulator"]
+        self._accumulator = np.array(accumulator) if accumulator is not None else None
+        self._total_weight = state["total_weight"]
+        self._dtype = np.dtype(state["dtype"]) if state["dtype"] is not None else None
+
+    def _accumulate(self, inputs: List[JSONType], results: np.ndarray) -> None:
+        # results is stacked along the first axis, one row per input
+        if self._dtype is None:
+            self._dtype = results.dtype
+
+        if self.pool_func == PoolingReducer.PoolingType.MAX:
+            block = results.max(axis=0)
+            if self._accumulator is None:
+                self._accumulator = block
+            else:
+                np.maximum(self._accumulator, block, out=self._accumulator)
+            return
+
+        if self.weight_func is not None:
+            weights = np.array([self.weight_func(i) for i in inputs], dtype=np.float64)
+            block = np.tensordot(weights, results, axes=1)
+            self._total_weight += float(weights.sum())
+        else:
+            block = results.sum(axis=0, dtype=np.float64)
+            self._total_weight += len(results)
+
+        if self._accumulator is None:
+            self._accumulator = block
+        else:
+            self._accumulator += block
 
 
 class StatisticsReducer(Reducer):
@@ -92,3 +314,172 @@ class StatisticsReducer(Reducer):
     @property
     def result(self) -> Statistics:
         return self._result
+
+    def merge(self, other: Reducer) -> None:
+        assert isinstance(other, StatisticsReducer)
+        self._result += other._result
+
+    def serialize(self) -> bytes:
+        return wire.dumps({"state": list(self._result.get_state())})
+
+    def deserialize(self, data: bytes) -> None:
+        self._result = Statistics.fromstate(tuple(wire.loads(data)["state"]))
+
+
+class EmbeddingWriterReducer(Reducer):
+    # Writes every output array to sharded, memory-mappable files (see
+    # knn.embedding_shards) instead of keeping anything in memory, e.g., to build an
+    # index of backbone feature maps that later jobs read instead of recomputing.
+    # Arrays are keyed by key_func(input), by default the input itself.
+    #
+    # The only state kept here is how many arrays were written; the arrays themselves
+    # are already on disk. So shards of a ShardedMapReduceJob all write into the same
+    # directory and merge() adds up their counts, and resuming from a checkpoint
+    # keeps appending (rewriting any arrays written after the checkpoint, which
+    # readers then take from the later manifest line).
+    #
+    # Chunks are decoded and written in order on a background thread, so the job's
+    # event loop doesn't wait on the disk. At most max_pending_chunks chunks are
+    # buffered; beyond that, handle_results waits for the oldest write. serialize()
+    # and close() wait for every buffered write, so checkpoints never count arrays
+    # that aren't on disk yet. A failed write is raised by the next call.
+
+    def __init__(
+        self,
+        directory: str,
+        key_func: Optional[Callable[[JSONType], str]] = None,
+        max_shard_bytes: int = DEFAULT_MAX_SHARD_BYTES,
+        dtype: np.dtype = np.float16,
+        max_pending_chunks: int = 64,
+    ) -> None:
+        super().__init__()
+        self.key_func = key_func or self.extract_key
+        self.max_pending_chunks = max_pending_chunks
+        self._writer = EmbeddingShardWriter(directory, max_shard_bytes, dtype)
+
+        # Created on first write, so an unused reducer can still be copied
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._pending_writes: Deque[concurrent.futures.Future] = collections.deque()
+
+    def handle_result(self, input: JSONType, output: JSONType) -> None:
+        self.handle_results([input], [output])
+
+    def handle_results(self, inputs: List[JSONType], outputs: List[JSONType]) -> None:
+        while self._pending_writes and (
+            self._pending_writes[0].done()
+            or len(self._pending_writes) >= self.max_pending_chunks
+        ):
+            self._pending_writes.popleft().result()  # raises if the write failed
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        keys = [self.key_func(input) for input in inputs]
+        self._pending_writes.append(self._executor.submit(self._write, keys, outputs))
+
+    def _write(self, keys: List[str], outputs: List[JSONType]) -> None:
+        # Runs on the background thread
+        for key, output in zip(keys, outputs):
+            self._writer.add(key, utils.as_numpy(output))
+        self._writer.flush()  # so readers see whole chunks as soon as possible
+
+    def _wait_for_writes(self) -> None:
+        # May run on several threads at once (e.g., a checkpoint and a shard's
+        # progress report), so finished writes are left for handle_results to drop
+        for write in list(self._pending_writes):
+            write.result()
+
+    def extract_key(self, input: JSONType) -> str:
+        assert isinstance(input, str)
+        return input
+
+    @property
+    def result(self) -> Dict[str, Any]:
+        return {
+            "directory": self._writer.directory,
+            "n_embeddings": self._writer.n_written,
+            "n_shards": self._writer.n_shards,
+        }
+
+    def merge(self, other: Reducer) -> None:
+        assert isinstance(other, EmbeddingWriterReducer)
+        assert other._writer.directory == self._writer.directory
+        self._writer.n_written += other._writer.n_written
+
+    def serialize(self) -> bytes:
+        self._wait_for_writes()
+        return wire.dumps({"n_embeddings": self._writer.n_written})
+
+    def deserialize(self, data: bytes) -> None:
+        self._wait_for_writes()
+        self._writer.n_written = wire.loads(data)["n_embeddings"]
+
+    def close(self) -> None:
+        self._wait_for_writes()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self._writer.close()
+
+
+class IndexReducer(Reducer):
+    # Inserts every output embedding into an approximate nearest neighbor index
+    # (knn.index.IVFIndex, or PQIndex to store compact codes), keyed by its input,
+    # so later queries can search the index instead of scanning the dataset again.
+    # Checkpoints only save the vectors added since the previous one, which are
+    # added again in the same batches on resume.
+
+    def __init__(
+        self,
+        index: Union[IVFIndex, PQIndex],
+        extract_func: Optional[Callable[[JSONType], np.ndarray]] = None,
+    ) -> None:
+        super().__init__()
+        self.index = index
+        self.extract_func = extract_func or self.extract_value
+        self._decoder = utils.NumpyDecoder()
+        self._added: Optional[List[List[Any]]] = None  # [vectors, ids] batches
+
+    def handle_result(self, input: JSONType, output: JSONType) -> None:
+        self.handle_results([input], [output])
+
+    def handle_results(self, inputs: List[JSONType], outputs: List[JSONType]) -> None:
+        if self.extract_func == self.extract_value:  # decode whole chunk at once
+            vectors = self._decoder.decode_many(outputs)
+        else:
+            vectors = np.stack([self.extract_func(o) for o in outputs])
+        self.index.add(vectors, inputs)
+        if self._added is not None:
+            self._added.append([vectors, list(inputs)])
+
+    def extract_value(self, output: JSONType) -> np.ndarray:
+        assert isinstance(output, (str, np.ndarray))
+        return self._decoder.decode(output)
+
+    @property
+    def result(self) -> Union[IVFIndex, PQIndex]:
+        return self.index
+
+    def merge(self, other: Reducer) -> None:
+        assert isinstance(other, IndexReducer)
+        self.index.merge(other.index)
+
+    def serialize(self) -> bytes:
+        with io.BytesIO() as buffer:
+            self.index.save(buffer)
+            return buffer.getvalue()
+
+    def deserialize(self, data: bytes) -> None:
+        with io.BytesIO(data) as buffer:
+            self.index = type(self.index).load(buffer)
+
+    def track_changes(self) -> bool:
+        self._added = []
+        return True
+
+    def serialize_changes(self) -> bytes:
+        added, self._added = self._added, []
+        return wire.dumps({"added": added})
+
+    def deserialize_changes(self, data: bytes) -> None:
+        for vectors, ids in wire.loads(data)["added"]:
+            self.index.add(vectors, ids)
@@ -1,62 +1,90 @@
 import asyncio
 import base64
+import binascii
 import functools
 import io
 import itertools
 
 import numpy as np
 
-from typing import Any, List, Union, Dict, Iterator
+from knn.datasets import Dataset, LineDataset
+
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 JSONType = Union[str, int, float, bool, None, Dict[str, Any], List[Any]]
 
 
-class FileListIterator:
-    def __init__(self, list_path: str) -> None:
-        self._list = open(list_path, "r")
-        self._total = 0
-        for line in self._list:
-            if not line.strip():
-                break
-            self._total += 1
-        self._list.seek(0)
+class FileListIterator(LineDataset):
+    # Kept for backwards compatibility (see knn.datasets for other input formats).
+    # Like the original, it's its own iterator: next() works, and iterating again
+    # continues where the last iteration stopped. Slices iterate from their start.
 
-    def close(self, *args, **kwargs):
-        self._list.close()
+    def __init__(self, list_path: str, **kwargs) -> None:
+        super().__init__(list_path, **kwargs)
+        self._lines: Optional[Iterator[str]] = None
 
-    def __len__(self):
-        return self._total
+    def __getitem__(self, key):
+        item = super().__getitem__(key)
+        if isinstance(key, slice):
+            item._lines = None
+        return item
 
     def __iter__(self) -> Iterator[str]:
         return self
 
     def __next__(self) -> str:
-        elem = self._list.readline().strip()
-        if not elem:
-            raise StopIteration
-        return elem
-
-
-def limited_as_completed(coros, limit):
-    # Based on https://github.com/andybalaam/asyncioplus/blob/master/asyncioplus/limited_as_completed.py  # noqa
-    futures = [asyncio.create_task(c) for c in itertools.islice(coros, 0, limit)]
-    pending = [len(futures)]  # list so that we can modify from first_to_finish
-
-    async def first_to_finish():
-        while True:
-            await asyncio.sleep(0)
-            for i, f in enumerate(futures):
-                if f is not None and f.done():
-                    try:
-                        newf = next(coros)
-                        futures[i] = asyncio.create_task(newf)
-                    except StopIteration:
-                        futures[i] = None
-                        pending[0] -= 1
-                    return f.result()
-
-    while pending[0] > 0:
-        yield first_to_finish()
+        if self._lines is None:
+            self._lines = Dataset.__iter__(self)
+        return next(self._lines)
+
+
+async def limited_as_completed(
+    coros: Iterator[Awaitable[Any]], limit: Union[int, Callable[[], int]]
+) -> AsyncIterator[Any]:
+    # Keeps up to `limit` tasks in flight, pulling new coroutines from `coros` lazily
+    # as earlier ones finish. Tasks report completion through a queue via done
+    # callbacks, so the scheduler sleeps until something actually finishes instead
+    # of polling every in-flight future. `limit` may be a callable, in which case
+    # it's re-evaluated whenever a slot frees up. `coros` is polled again after
+    # raising StopIteration, so iterators that can be refilled (e.g., with retries
+    # enqueued while handling a result) are drained completely.
+    get_limit = limit if callable(limit) else lambda: limit
+    pending: Set[asyncio.Task] = set()
+    completed: asyncio.Queue = asyncio.Queue()
+
+    def fill():
+        while len(pending) < get_limit():
+            try:
+                coro = next(coros)
+            except StopIteration:
+                break
+            task = asyncio.create_task(coro)
+            task.add_done_callback(completed.put_nowait)
+            pending.add(task)
+
+    try:
+        fill()
+        while pending:
+            task = await completed.get()
+            pending.discard(task)
+            fill()  # refill before yielding so the window stays full meanwhile
+            yield task.result()
+            fill()
+    finally:
+        for task in pending:
+            task.cancel()
 
 
 def unasync(f):
@@ -67,10 +95,13 @@ def unasync(f):
     return wrapper
 
 
-def chunk(iterable, chunk_size):
+def chunk(iterable, chunk_size: Union[int, Callable[[], int]]):
+    # As with limited_as_completed, a callable `chunk_size` is re-evaluated lazily
+    # for every chunk, so a feedback loop can resize chunks while we iterate
+    get_chunk_size = chunk_size if callable(chunk_size) else lambda: chunk_size
     it = iter(iterable)
     while True:
-        chunk = tuple(itertools.islice(it, chunk_size))
+        chunk = tuple(itertools.islice(it, get_chunk_size()))
         if not chunk:
             break
         yield chunk
@@ -89,3 +120,93 @@ def base64_to_numpy(nda_base64):
     with io.BytesIO(nda_bytes) as nda_buffer:
         nda = np.load(nda_buffer, allow_pickle=False)
     return nda
+
+
+class NumpyDecoder:
+    # Faster base64_to_numpy for decoding many arrays with the same dtype and shape
+    # (e.g., all results of a job). Parsed .npy headers are cached, and arrays are
+    # built with np.frombuffer directly over the decoded bytes instead of going
+    # through BytesIO and np.load. Returned arrays are read-only.
+
+    def __init__(self) -> None:
+        self._headers: Dict[bytes, Tuple[np.dtype, Tuple[int, ...], int, bool]] = {}
+
+    def decode(self, value) -> np.ndarray:
+        if isinstance(value, np.ndarray):
+            return value
+
+        nda_bytes = base64.b64decode(value)
+        header_length = self._header_length(nda_bytes)
+        dtype, shape, count, fortran_order = self._header(nda_bytes[:header_length])
+
+        nda = np.frombuffer(nda_bytes, dtype=dtype, count=count, offset=header_length)
+        if fortran_order:
+            return nda.reshape(shape[::-1]).T
+        return nda.reshape(shape)
+
+    def decode_many(self, values) -> np.ndarray:
+        # Stacks all arrays into one contiguous array with a new leading axis. If all
+        # values are base64 strings with the same .npy header (the usual case:
+        # arrays with one dtype and shape), each is decoded straight into its row of
+        # a preallocated result without going through decode().
+        values = list(values)
+        if values and all(isinstance(v, str) for v in values):
+            stacked = self._decode_stacked(values)
+            if stacked is not None:
+                return stacked
+        return np.stack([self.decode(v) for v in values])
+
+    def _decode_stacked(self, values: List[str]) -> Optional[np.ndarray]:
+        first_bytes = binascii.a2b_base64(values[0])
+        header_length = self._header_length(first_bytes)
+        header = first_bytes[:header_length]
+        dtype, shape, count, fortran_order = self._header(header)
+        if fortran_order:
+            return None
+
+        n_bytes = count * dtype.itemsize
+        result = np.empty((len(values), *shape), dtype=dtype)
+        rows = result.reshape(len(values), -1).view(np.uint8)
+        for i, value in enumerate(values):
+            nda_bytes = first_bytes if i == 0 else binascii.a2b_base64(value)
+            if (
+                len(nda_bytes) != header_length + n_bytes
+                or nda_bytes[:header_length] != header
+            ):
+                return None
+            rows[i] = np.frombuffer(
+                nda_bytes, dtype=np.uint8, count=n_bytes, offset=header_length
+            )
+        return result
+
+    @staticmethod
+    def _header_length(nda_bytes: bytes) -> int:
+        if nda_bytes[6] == 1:  # .npy format version
+            return 10 + int.from_bytes(nda_bytes[8:10], "little")
+        return 12 + int.from_bytes(nda_bytes[8:12], "little")
+
+    def _header(self, header: bytes) -> Tuple[np.dtype, Tuple[int, ...], int, bool]:
+        try:
+            return self._headers[header]
+        except KeyError:
+            self._headers[header] = self._parse_header(header)
+            return self._headers[header]
+
+    @staticmethod
+    def _parse_header(header: bytes) -> Tuple[np.dtype, Tuple[int, ...], int, bool]:
+        with io.BytesIO(header) as header_buffer:
+            version = np.lib.format.read_magic(header_buffer)
+            if version == (1, 0):
+                read_header = np.lib.format.read_array_header_1_0
+            else:
+                read_header = np.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(header_buffer)
+        assert not dtype.hasobject
+        return dtype, shape, int(np.prod(shape)), fortran_order
+
+
+def as_numpy(value):
+    # Accepts either a decoded ndarray (binary wire format) or a base64 string (JSON)
+    if isinstance(value, np.ndarray):
+        return value
+    return base64_to_numpy(value)
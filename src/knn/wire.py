@@ -0,0 +1,116 @@
+import functools
+import json
+import operator
+import struct
+
+import numpy as np
+
+from typing import Any, List, Tuple
+
+from knn import utils
+
+# Binary frame format used between MapReduceJob and Mapper when both sides support
+# it. A frame is a JSON header followed by the raw bytes of every ndarray in the
+# payload, so arrays skip base64 and are decoded without copying:
+#
+#   MAGIC | header length (uint32 LE) | header (UTF-8 JSON) | padding | buffers
+#
+# The header holds the payload with each ndarray replaced by {"__ndarray__": i}, and
+# a list of (dtype, shape, offset) triples locating array i in the buffer section.
+# Peers that don't understand frames just see JSON, with ndarrays base64-encoded.
+
+CONTENT_TYPE = "application/x-knn-frame"
+ACCEPT = f"{CONTENT_TYPE}, application/json"
+
+MAGIC = b"KNN\x01"
+ALIGNMENT = 16
+ARRAY_KEY = "__ndarray__"
+
+_LENGTH = struct.Struct("<I")
+
+
+def accepts_frames(accept_header: str) -> bool:
+    return CONTENT_TYPE in (accept_header or "")
+
+
+def dumps(obj: Any) -> bytes:
+    arrays: List[np.ndarray] = []
+
+    def replace_arrays(x):
+        if isinstance(x, np.ndarray):
+            arrays.append(np.ascontiguousarray(x))
+            return {ARRAY_KEY: len(arrays) - 1}
+        elif isinstance(x, dict):
+            return {k: replace_arrays(v) for k, v in x.items()}
+        elif isinstance(x, (list, tuple)):
+            return [replace_arrays(v) for v in x]
+        return x
+
+    body = replace_arrays(obj)
+
+    specs: List[Tuple[str, List[int], int]] = []
+    offset = 0
+    for array in arrays:
+        assert not array.dtype.hasobject
+        offset += -offset % ALIGNMENT
+        specs.append((array.dtype.str, list(array.shape), offset))
+        offset += array.nbytes
+
+    header = json.dumps({"body": body, "arrays": specs}, separators=(",", ":"))
+    header_bytes = header.encode("utf-8")
+
+    parts = [MAGIC, _LENGTH.pack(len(header_bytes)), header_bytes]
+    position = len(MAGIC) + _LENGTH.size + len(header_bytes)
+    data_start = position + (-position % ALIGNMENT)
+    parts.append(b"\0" * (data_start - position))
+
+    position = 0
+    for array, (_, _, offset) in zip(arrays, specs):
+        parts.append(b"\0" * (offset - position))
+        parts.append(array.data)
+        position = offset + array.nbytes
+
+    return b"".join(parts)
+
+
+def loads(data: bytes) -> Any:
+    # Arrays are read-only views into `data`; copy them if they need to be modified
+    assert data[: len(MAGIC)] == MAGIC
+    (header_length,) = _LENGTH.unpack_from(data, len(MAGIC))
+    header_start = len(MAGIC) + _LENGTH.size
+    header = json.loads(data[header_start : header_start + header_length])
+
+    position = header_start + header_length
+    data_start = position + (-position % ALIGNMENT)
+    buffer = memoryview(data)
+
+    arrays = []
+    for dtype_str, shape, offset in header["arrays"]:
+        dtype = np.dtype(dtype_str)
+        count = functools.reduce(operator.mul, shape, 1)
+        array = np.frombuffer(
+            buffer, dtype=dtype, count=count, offset=data_start + offset
+        )
+        arrays.append(array.reshape(shape))
+
+    def restore_arrays(x):
+        if isinstance(x, dict):
+            if len(x) == 1 and ARRAY_KEY in x:
+                return arrays[x[ARRAY_KEY]]
+            return {k: restore_arrays(v) for k, v in x.items()}
+        elif isinstance(x, list):
+            return [restore_arrays(v) for v in x]
+        return x
+
+    return restore_arrays(header["body"])
+
+
+def to_jsonable(obj: Any) -> Any:
+    # JSON fallback: ndarrays become base64-encoded .npy strings, as before
+    if isinstance(obj, np.ndarray):
+        return utils.numpy_to_base64(obj)
+    elif isinstance(obj, dict):
+        return {k: to_jsonable(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [to_jsonable(v) for v in obj]
+    return obj
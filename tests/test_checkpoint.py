@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+import pytest
+
+from knn.datasets import ArrayDataset
+from knn.jobs.checkpoint import CheckpointLog, RangeSet, enumerate_pending
+
+
+def test_range_set_merges_ranges():
+    ranges = RangeSet()
+    ranges.add(5, 8)
+    ranges.add(0, 2)
+    ranges.add(10, 12)
+    assert ranges.ranges == [[0, 2], [5, 8], [10, 12]]
+
+    ranges.add(2, 5)  # touches both neighbors
+    assert ranges.ranges == [[0, 8], [10, 12]]
+    ranges.add(7, 11)  # overlaps both
+    assert ranges.ranges == [[0, 12]]
+    ranges.add(3, 3)  # empty
+    assert ranges.ranges == [[0, 12]]
+    assert len(ranges) == 12
+
+
+def test_range_set_membership_and_gaps():
+    ranges = RangeSet([(2, 4), (6, 7)])
+    assert [p for p in range(9) if p in ranges] == [2, 3, 6]
+    assert list(ranges.gaps(9)) == [(0, 2), (4, 6), (7, 9)]
+    assert list(ranges.gaps(3)) == [(0, 2)]
+    assert list(RangeSet().gaps(2)) == [(0, 2)]
+    assert not RangeSet() and ranges
+
+
+def test_range_set_add_all():
+    ranges = RangeSet()
+    ranges.add_all([9, 3, 4, 5, 7, 8, 0])
+    assert ranges.ranges == [[0, 1], [3, 6], [7, 10]]
+
+
+def test_enumerate_pending():
+    completed = RangeSet([(1, 3), (4, 5)])
+    expected = [(0, "a"), (3, "d"), (5, "f")]
+    assert list(enumerate_pending(list("abcdef"), completed)) == expected
+    dataset = ArrayDataset(np.array(list("abcdef")))
+    assert list(enumerate_pending(dataset, completed)) == expected
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    return str(tmp_path / "checkpoint")
+
+
+def test_checkpoint_log_round_trip(log_path):
+    log = CheckpointLog(log_path, compact_interval=3)
+    assert log.load() is None
+    log.reset()
+    for i in range(5):  # compacts along the way
+        log.append({"completed": [[i, i + 1]], "n": i}, f"state {i}".encode())
+
+    checkpoint = CheckpointLog(log_path).load()
+    assert checkpoint["n"] == 4 and checkpoint["seq"] == 5
+    assert checkpoint["completed"].ranges == [[0, 5]]
+    assert checkpoint["reducer"] == b"state 4"
+    assert checkpoint["reducer_changes"] == []
+
+
+def test_checkpoint_log_changes(log_path):
+    log = CheckpointLog(log_path, compact_interval=3)
+    log.reset()
+    assert log.wants_full_state
+    log.append({"completed": [[0, 1]]}, b"full")
+    assert not log.wants_full_state
+    log.append({"completed": [[1, 2]]}, b"change 1", is_change=True)
+    log.append({"completed": [[2, 3]]}, b"change 2", is_change=True)
+    assert log.wants_full_state  # the log is due for compaction
+
+    checkpoint = CheckpointLog(log_path).load()
+    assert checkpoint["reducer"] == b"full"
+    assert checkpoint["reducer_changes"] == [b"change 1", b"change 2"]
+
+    # A resumed log starts over with a full state
+    log = CheckpointLog(log_path)
+    log.load()
+    assert log.wants_full_state
+    log.append({"completed": [[3, 4]]}, b"full again")
+    log.append({"completed": [[4, 5]]}, b"change 3", is_change=True)
+    checkpoint = CheckpointLog(log_path).load()
+    assert checkpoint["completed"].ranges == [[0, 5]]
+    assert checkpoint["reducer"] == b"full again"
+    assert checkpoint["reducer_changes"] == [b"change 3"]
+
+
+def test_checkpoint_log_ignores_torn_records(log_path):
+    log = CheckpointLog(log_path)
+    log.reset()
+    log.append({"completed": [[0, 1]]}, b"full")
+    log.append({"completed": [[1, 2]]}, b"change", is_change=True)
+    size = os.path.getsize(log_path)
+
+    # A change written past the last log record, and a torn log record
+    with open(log_path + ".reducer", "ab") as f:
+        CheckpointLog._write(f, {"seq": 3, "changes": np.zeros(1, np.uint8)})
+    with open(log_path, "ab") as f:
+        f.write(b"\x10\x00")
+
+    checkpoint = CheckpointLog(log_path).load()
+    assert checkpoint["seq"] == 2
+    assert checkpoint["reducer_changes"] == [b"change"]
+    assert os.path.getsize(log_path) == size  # truncated
@@ -0,0 +1,48 @@
+from knn.jobs import AdaptiveConcurrencyController
+
+
+def test_grows_while_latency_is_steady():
+    controller = AdaptiveConcurrencyController(initial_window=10, max_window=50)
+    for _ in range(20):
+        controller.record(1.0, 0.0, 0, 10)
+    assert controller.window == 30  # slow start: one per response
+    for _ in range(100):
+        controller.record(1.0, 0.0, 0, 10)
+    assert controller.window == 50  # capped
+
+
+def test_backs_off_on_failures_once_per_window():
+    controller = AdaptiveConcurrencyController(initial_window=16, max_window=100)
+    for _ in range(16):
+        controller.record(1.0, 0.0, 0, 10)
+    assert controller.window == 32
+
+    windows = []
+    for _ in range(48):
+        controller.record(1.0, 0.0, 10, 10)
+        windows.append(controller.window)
+    # Halved once a window's worth of responses (32) has come in since the start,
+    # then again after another window's worth (16), not on every failure
+    assert windows[14] == 32 and windows[15] == 16
+    assert windows[30] == 16 and windows[31] == 8
+
+
+def test_backs_off_when_latency_inflates():
+    controller = AdaptiveConcurrencyController(initial_window=4, max_window=100)
+    for _ in range(4):
+        controller.record(1.0, 0.0, 0, 10)
+    window = controller.window
+    for _ in range(40):
+        controller.record(10.0, 0.0, 0, 10)
+    assert controller.window < window
+
+
+def test_holds_during_cold_starts():
+    controller = AdaptiveConcurrencyController(initial_window=10, max_window=100)
+    for _ in range(20):  # boot time doesn't count as latency
+        controller.record(11.0, 10.0, 0, 10)
+    assert 10 < controller.window < 30  # grew until most responses were cold
+    window = controller.window
+    for _ in range(5):
+        controller.record(11.0, 10.0, 0, 10)
+    assert controller.window == window
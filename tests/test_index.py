@@ -0,0 +1,87 @@
+import io
+
+import numpy as np
+import pytest
+
+from knn.index import IVFIndex, OptimizedProductQuantizer, PQIndex, ProductQuantizer
+
+DIM = 16
+
+
+def random_vectors(n, seed=0):
+    vectors = np.random.RandomState(seed).randn(n, DIM).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_ivf():
+    return IVFIndex(DIM, n_lists=8, train_size=200)
+
+
+def make_pq():
+    return PQIndex(ProductQuantizer(DIM, 4, n_bits=4), train_size=200)
+
+
+def make_opq():
+    return PQIndex(OptimizedProductQuantizer(DIM, 4, n_bits=4), train_size=200)
+
+
+def search(index, queries):
+    if isinstance(index, IVFIndex):
+        return index.search(queries, 10, n_probe=4)
+    return index.search(queries, 10)
+
+
+@pytest.mark.parametrize("make_index", [make_ivf, make_pq, make_opq])
+@pytest.mark.parametrize("n", [0, 50, 500], ids=lambda n: f"{n}_vectors")
+def test_save_load_round_trip(tmp_path, make_index, n):
+    index = make_index()
+    if n:
+        index.add(random_vectors(n), [f"id-{i}" for i in range(n)])
+    path = str(tmp_path / "index")  # no extension, which np.savez would add
+    index.save(path)
+    loaded = type(index).load(path)
+
+    assert len(loaded) == len(index)
+    assert loaded.is_trained == index.is_trained == (n >= 200)
+    queries = random_vectors(5, seed=1)
+    assert search(loaded, queries) == search(index, queries)
+
+    # Indexes keep working (and training) after a round trip
+    loaded.add(random_vectors(300, seed=2), [f"new-{i}" for i in range(300)])
+    assert loaded.is_trained and len(loaded) == n + 300
+
+
+@pytest.mark.parametrize("make_index", [make_ivf, make_pq])
+def test_save_to_file_object(make_index):
+    index = make_index()
+    index.add(random_vectors(300), list(range(300)))
+    with io.BytesIO() as buffer:
+        index.save(buffer)
+        buffer.seek(0)
+        loaded = type(index).load(buffer)
+    queries = random_vectors(3, seed=1)
+    assert search(loaded, queries) == search(index, queries)
+
+
+@pytest.mark.parametrize("make_index", [make_ivf, make_pq])
+def test_train_without_enough_vectors(make_index):
+    index = make_index()
+    index.train()  # nothing to train on yet
+    assert not index.is_trained
+    assert search(index, random_vectors(1)) == [[]]
+
+    index.add(random_vectors(3), ["a", "b", "c"])
+    index.train()
+    assert not index.is_trained
+    vectors = random_vectors(3)
+    assert search(index, vectors[:1])[0][0][1] == "a"  # searched exactly
+
+
+def test_exhaustive_ivf_search_is_exact():
+    index = make_ivf()
+    vectors = random_vectors(500)
+    index.add(vectors, list(range(500)))
+    queries = random_vectors(5, seed=1)
+    for query, results in zip(queries, index.search(queries, 10, n_probe=8)):
+        expected = np.argsort(-(vectors @ query), kind="stable")[:10]
+        assert [id for _, id in results] == expected.tolist()
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from knn import utils
+
+ARRAYS = [
+    np.arange(5, dtype=np.float32),
+    np.arange(6, dtype=np.float16).reshape(2, 3),
+    np.arange(7, dtype=np.int64),  # 56 bytes, so the base64 is padded
+    np.array([1.5], dtype=">f8"),
+    np.asfortranarray(np.arange(6, dtype=np.float32).reshape(2, 3)),
+    np.empty((0, 3), dtype=np.float32),
+]
+
+
+@pytest.mark.parametrize("array", ARRAYS, ids=lambda a: f"{a.dtype}{a.shape}")
+def test_decode_matches_base64_to_numpy(array):
+    encoded = utils.numpy_to_base64(array)
+    decoded = utils.NumpyDecoder().decode(encoded)
+    expected = utils.base64_to_numpy(encoded)
+    assert decoded.dtype == expected.dtype
+    np.testing.assert_array_equal(decoded, expected)
+    np.testing.assert_array_equal(decoded, array)
+
+
+@pytest.mark.parametrize("array", ARRAYS, ids=lambda a: f"{a.dtype}{a.shape}")
+def test_decode_many_matches_base64_to_numpy(array):
+    arrays = [array + i for i in range(4)]
+    encoded = [utils.numpy_to_base64(a) for a in arrays]
+    decoded = utils.NumpyDecoder().decode_many(encoded)
+    expected = np.stack([utils.base64_to_numpy(e) for e in encoded])
+    assert decoded.dtype == expected.dtype
+    np.testing.assert_array_equal(decoded, expected)
+
+
+def test_decode_many_mixed_inputs():
+    # Already-decoded arrays and differently shaped values take the slow path
+    arrays = [np.arange(3, dtype=np.float32) * i for i in range(3)]
+    values = [utils.numpy_to_base64(arrays[0]), arrays[1], arrays[2]]
+    np.testing.assert_array_equal(
+        utils.NumpyDecoder().decode_many(values), np.stack(arrays)
+    )
+
+    with pytest.raises(ValueError):
+        utils.NumpyDecoder().decode_many(
+            [utils.numpy_to_base64(np.zeros(3)), utils.numpy_to_base64(np.zeros(4))]
+        )
+
+
+def test_decoder_reuse_across_formats():
+    decoder = utils.NumpyDecoder()
+    for array in ARRAYS:
+        encoded = utils.numpy_to_base64(array)
+        np.testing.assert_array_equal(decoder.decode(encoded), array)
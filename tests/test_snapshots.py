@@ -0,0 +1,64 @@
+from knn.jobs.snapshots import ResultHistory
+
+
+def apply(items, delta):
+    # What a client does with a snapshot's result
+    if delta["full"]:
+        return dict(delta["items"])
+    items = {k: v for k, v in items.items() if k not in delta["removed"]}
+    items.update(delta["added"])
+    return items
+
+
+def test_deltas_reconstruct_result():
+    history = ResultHistory(key_func=str)
+    results = [[1, 2, 3], [1, 2, 3], [2, 3, 4], [4, 5], [], [6]]
+    client_items, client_version = {}, None
+    for version, result in enumerate(results):
+        history.update(version, result)
+        delta = history.since(client_version)
+        client_items, client_version = apply(client_items, delta), history.version
+        assert client_items == {str(x): x for x in result}
+
+
+def test_delta_contents():
+    history = ResultHistory(key_func=str)
+    history.update(0, [1, 2, 3])
+    assert history.since(None) == {"full": True, "items": {"1": 1, "2": 2, "3": 3}}
+
+    history.update(1, [2, 3, 4])
+    history.update(2, [3, 4, 5])
+    assert history.since(1) == {"full": False, "added": {"5": 5}, "removed": ["2"]}
+    assert history.since(0) == {
+        "full": False,
+        "added": {"4": 4, "5": 5},
+        "removed": ["1", "2"],
+    }
+    assert history.since(2) == {"full": False, "added": {}, "removed": []}
+
+
+def test_readded_item():
+    history = ResultHistory(key_func=str)
+    history.update(0, [1, 2])
+    history.update(1, [2])
+    history.update(2, [1, 2])
+    delta = history.since(0)
+    assert apply({"1": 1, "2": 2}, delta) == {"1": 1, "2": 2}
+
+
+def test_old_versions_get_full_result():
+    history = ResultHistory(key_func=str, max_removals=2)
+    history.update(0, [1, 2, 3])
+    history.update(1, [4])  # three removals, one more than remembered
+    assert history.since(0) == {"full": True, "items": {"4": 4}}
+    history.update(2, [5])
+    assert history.since(1) == {"full": False, "added": {"5": 5}, "removed": ["4"]}
+
+
+def test_non_list_results():
+    history = ResultHistory()
+    history.update(0, {"mean": 1.0})
+    assert history.since(None) == {"full": True, "value": {"mean": 1.0}}
+    assert history.since(0) == {"full": False, "added": {}, "removed": []}
+    history.update(1, {"mean": 2.0})
+    assert history.since(0) == {"full": True, "value": {"mean": 2.0}}
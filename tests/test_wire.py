@@ -0,0 +1,54 @@
+import numpy as np
+
+from knn import utils, wire
+
+
+def test_round_trip():
+    payload = {
+        "job_id": "job",
+        "inputs": ["a", "b"],
+        "nested": [{"x": np.arange(6, dtype=np.float32).reshape(2, 3)}, 1.5, None],
+        "scalar": np.array(3, dtype=np.int64),
+        "empty": np.empty((0, 4), dtype=np.float16),
+    }
+    loaded = wire.loads(wire.dumps(payload))
+
+    assert loaded["job_id"] == "job"
+    assert loaded["inputs"] == ["a", "b"]
+    assert loaded["nested"][1:] == [1.5, None]
+    for original, restored in [
+        (payload["nested"][0]["x"], loaded["nested"][0]["x"]),
+        (payload["scalar"], loaded["scalar"]),
+        (payload["empty"], loaded["empty"]),
+    ]:
+        assert restored.dtype == original.dtype
+        np.testing.assert_array_equal(restored, original)
+
+
+def test_arrays_are_aligned():
+    # Odd-sized arrays in between mustn't misalign the ones after them
+    arrays = [np.arange(n, dtype=np.uint8) for n in (1, 3, 7)] + [np.ones(5)]
+    data = wire.dumps(arrays)
+    start = np.frombuffer(data, dtype=np.uint8).__array_interface__["data"][0]
+    for original, restored in zip(arrays, wire.loads(data)):
+        np.testing.assert_array_equal(restored, original)
+        offset = restored.__array_interface__["data"][0] - start
+        assert offset % wire.ALIGNMENT == 0
+
+
+def test_non_contiguous_arrays():
+    array = np.arange(12, dtype=np.int32).reshape(3, 4)[:, ::2]
+    np.testing.assert_array_equal(wire.loads(wire.dumps(array)), array)
+
+
+def test_to_jsonable():
+    array = np.arange(4, dtype=np.float32)
+    jsonable = wire.to_jsonable({"a": [array, (1, 2)]})
+    np.testing.assert_array_equal(utils.base64_to_numpy(jsonable["a"][0]), array)
+    assert jsonable["a"][1] == [1, 2]
+
+
+def test_accepts_frames():
+    assert wire.accepts_frames(wire.ACCEPT)
+    assert not wire.accepts_frames("application/json")
+    assert not wire.accepts_frames(None)